@@ -0,0 +1 @@
+# SPDX-License-Identifier: GPL-3.0
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-3.0
+"""Benchmark the REST requests of the reaction and the button control path.
+
+Posts the control message and lets users create and delete their stages, once by reactions and once by buttons.
+Counts the requests which count against the bot's rate limits, per endpoint. Button presses are answered through the
+interaction endpoints instead (a deferral and a followup), which do not count against them. Runs against the
+in-process fake discord backend.
+
+Run with: python -m benchmarks.controls [--users 100] [--latency 0.05]
+"""
+
+import argparse
+import asyncio
+import logging
+from types import SimpleNamespace
+
+from benchmarks.fake_discord import FakeDiscord
+from benchmarks.suite import Setup
+
+
+async def measure(controls, user_count, latency):
+    setup = Setup(FakeDiscord(latency=latency))
+    if controls == "buttons":
+        # the fake backend does not render views, any object will do
+        setup.bot.control_view = SimpleNamespace()
+    await setup.bootstrap()
+    control_message = await (await setup.dyn_category.control_channel).control_message
+    posting = sum(setup.backend.requests.values())
+
+    users = setup.add_members(user_count)
+    setup.backend.requests.clear()
+    interaction_responses = 0
+    for emoji in ("🆕", "❌"):
+        if controls == "buttons":
+            await asyncio.gather(*(control_message.on_interaction(emoji, user) for user in users))
+            interaction_responses += 2 * len(users)
+        else:
+            await asyncio.gather(
+                *(control_message.on_reaction(SimpleNamespace(emoji=emoji, member=user)) for user in users)
+            )
+    # let the debounced control message edits run
+    await asyncio.sleep(2 * setup.dyn_category.category_info.control_message_edit_interval)
+    return posting, dict(setup.backend.requests), interaction_responses
+
+
+async def run(user_count, latency):
+    for controls in ("reactions", "buttons"):
+        posting, requests, interaction_responses = await measure(controls, user_count, latency)
+        actions = 2 * user_count
+        print(f"{controls}: posting the control message took {posting} requests")
+        print(f"  {actions} actions took {sum(requests.values())} rate limited requests:")
+        for endpoint, count in sorted(requests.items()):
+            print(f"    {count:>6}  {endpoint}")
+        print(f"  and {interaction_responses} interaction responses")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated REST latency in seconds")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(run(args.users, args.latency))
+
+
+if __name__ == "__main__":
+    main()
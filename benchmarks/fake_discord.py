@@ -0,0 +1,312 @@
+# SPDX-License-Identifier: GPL-3.0
+"""In-process fake of the discord objects used by DynCategory, DynChannel, ControlChannel and ReactMessage.
+
+Every REST call of the fakes goes through a FakeDiscord backend, which simulates latency and per-bucket rate limits
+and counts requests. Only the parts of the discord.py API which the bot uses are implemented.
+"""
+
+import asyncio
+import itertools
+import time
+from collections import Counter, deque
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+from discord import CategoryChannel, NotFound, StageChannel, TextChannel
+
+
+class RateLimit:
+    """Allows `limit` requests per `period` seconds in every bucket (sliding window), like discord's route buckets."""
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self._grants: Dict = {}  # bucket -> times of the last `limit` granted requests
+
+    def delay(self, bucket, now: float) -> float:
+        """Reserve a request in bucket and return how long it has to wait."""
+        grants = self._grants.setdefault(bucket, deque())
+        granted_at = now if len(grants) < self.limit else max(now, grants[0] + self.period)
+        grants.append(granted_at)
+        if len(grants) > self.limit:
+            grants.popleft()
+        return granted_at - now
+
+    def acquire(self, bucket, now: float) -> float:
+        """Grant a request in bucket if there is room, like discord does. Returns 0, or how long to wait before
+        retrying."""
+        grants = self._grants.setdefault(bucket, deque())
+        while grants and grants[0] <= now - self.period:
+            grants.popleft()
+        if len(grants) < self.limit:
+            grants.append(now)
+            return 0.0
+        return grants[0] + self.period - now
+
+    def state(self, bucket, now: float) -> Tuple[int, float]:
+        """Number of requests acquire() would still grant in bucket, and seconds until it grants one more."""
+        grants = self._grants.get(bucket) or deque()
+        live = [granted_at for granted_at in grants if granted_at > now - self.period]
+        return self.limit - len(live), (live[0] + self.period - now if live else 0.0)
+
+
+class FakeDiscord:
+    """Simulated REST backend: every request takes `latency` seconds and is subject to the rate limits."""
+
+    def __init__(self, latency: float = 0.0, rate_limit: Optional[RateLimit] = None):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.requests = Counter()  # by endpoint
+        self.rate_limited = 0
+        self._ids = itertools.count(10**17)
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    async def request(self, endpoint: str, bucket):
+        self.requests[endpoint] += 1
+        delay = self.latency
+        if self.rate_limit is not None:
+            wait = self.rate_limit.delay(bucket, time.monotonic())
+            if wait > 0:
+                self.rate_limited += 1
+                delay += wait
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+
+
+class FakeMember:
+    def __init__(self, guild, member_id: int, name: str, manage_channels=False):
+        self.guild = guild
+        self.id = member_id
+        self.name = name
+        self.display_name = name
+        self.guild_permissions = SimpleNamespace(manage_channels=manage_channels)
+
+    def __str__(self):
+        return self.name
+
+    # like discord.py, members with the same ID are equal
+    def __eq__(self, other):
+        return isinstance(other, FakeMember) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeRole:
+    def __init__(self, role_id: int, name: str):
+        self.id = role_id
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content: str, view=None):
+        self.backend = channel.backend
+        self.id = self.backend.next_id()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.reactions: List = []
+        self.components: List = [view] if view is not None else []
+
+    async def edit(self, content=None, view=None):
+        await self.backend.request("PATCH /channels/{channel_id}/messages/{message_id}", self.channel.id)
+        if content is not None:
+            self.content = content
+        if view is not None:
+            self.components = [view]
+
+    async def delete(self):
+        await self.backend.request("DELETE /channels/{channel_id}/messages/{message_id}", self.channel.id)
+        self.channel.messages.pop(self.id, None)
+
+    async def add_reaction(self, emoji):
+        await self.backend.request("PUT /channels/{channel_id}/messages/{message_id}/reactions", self.channel.id)
+        self.reactions.append(SimpleNamespace(emoji=emoji, me=True))
+
+    async def remove_reaction(self, emoji, member):
+        await self.backend.request("DELETE /channels/{channel_id}/messages/{message_id}/reactions", self.channel.id)
+
+
+class _FakeGuildChannel:
+    def _init(self, guild, name: str, category):
+        self.backend = guild.backend
+        self.id = self.backend.next_id()
+        self.name = name
+        self.guild = guild
+        self.category_id = category.id if category is not None else None
+        self.topic = None
+        self.overwrites = {}
+        self.created_at = datetime.utcnow()
+
+    def __repr__(self):
+        return f"<{type(self).__name__} id={self.id} name={self.name!r}>"
+
+    # discord.py computes these from private state or the ID, the fakes just store them
+    @property
+    def overwrites(self):
+        return self._fake_overwrites
+
+    @overwrites.setter
+    def overwrites(self, overwrites):
+        self._fake_overwrites = overwrites
+
+    @property
+    def created_at(self):
+        return self._fake_created_at
+
+    @created_at.setter
+    def created_at(self, created_at):
+        self._fake_created_at = created_at
+
+    async def edit(self, **fields):
+        await self.backend.request("PATCH /channels/{channel_id}", self.id)
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    async def delete(self):
+        await self.backend.request("DELETE /channels/{channel_id}", self.id)
+        self.guild.remove_channel(self)
+
+
+class FakeTextChannel(_FakeGuildChannel, TextChannel):
+    def __init__(self, guild, name: str, category=None, topic=None):
+        self._init(guild, name, category)
+        self.topic = topic
+        self.messages: Dict[int, FakeMessage] = {}
+
+    async def send(self, content, view=None):
+        await self.backend.request("POST /channels/{channel_id}/messages", self.id)
+        message = FakeMessage(self, self.guild.me, content, view)
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, message_id):
+        await self.backend.request("GET /channels/{channel_id}/messages/{message_id}", self.id)
+        if message_id not in self.messages:
+            raise NotFound(SimpleNamespace(status=404, reason="Not Found"), "Unknown Message")
+        return self.messages[message_id]
+
+    def history(self, limit=100, before=None, after=None):
+        return FakeHistoryIterator(self, limit, before, after)
+
+    async def delete_messages(self, messages):
+        await self.backend.request("POST /channels/{channel_id}/messages/bulk-delete", self.id)
+        for message in messages:
+            self.messages.pop(message.id, None)
+
+
+class FakeHistoryIterator:
+    def __init__(self, channel, limit, before, after):
+        self.channel = channel
+        self.limit = limit
+        self.before = before
+        self.after = after
+
+    async def flatten(self):
+        await self.channel.backend.request("GET /channels/{channel_id}/messages", self.channel.id)
+        messages = [
+            m
+            for m in self.channel.messages.values()
+            if (self.before is None or m.id < self.before.id) and (self.after is None or m.id > self.after.id)
+        ]
+        return messages[-self.limit :] if self.limit else messages
+
+    async def __aiter__(self):
+        for message in await self.flatten():
+            yield message
+
+
+class FakeStageChannel(_FakeGuildChannel, StageChannel):
+    def __init__(self, guild, name: str, category=None, overwrites=None):
+        self._init(guild, name, category)
+        self.overwrites = overwrites or {}
+        self.voice_members: List[FakeMember] = []
+
+    @property
+    def members(self):
+        return self.voice_members
+
+
+class FakeCategoryChannel(_FakeGuildChannel, CategoryChannel):
+    def __init__(self, guild, name: str, overwrites=None):
+        self._init(guild, name, None)
+        self.overwrites = overwrites or {}
+
+    @property
+    def channels(self):
+        return [c for c in self.guild.channels if c.category_id == self.id]
+
+    async def create_text_channel(self, name, topic=None, overwrites=None):
+        return await self.guild.create_text_channel(name=name, category=self, topic=topic)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, backend: FakeDiscord, name: str = "guild", bot_user_id: int = 1):
+        self.backend = backend
+        self.id = backend.next_id()
+        self.name = name
+        self.shard_id = 0
+        self.me = FakeMember(self, bot_user_id, "bot", manage_channels=True)
+        self.default_role = FakeRole(self.id, "@everyone")
+        self.categories: List[FakeCategoryChannel] = []
+        self._channels: Dict[int, _FakeGuildChannel] = {}
+        self._members: Dict[int, FakeMember] = {self.me.id: self.me}
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def channels(self):
+        return list(self._channels.values())
+
+    def add_member(self, name: str, manage_channels=False) -> FakeMember:
+        member = FakeMember(self, self.backend.next_id(), name, manage_channels=manage_channels)
+        self._members[member.id] = member
+        return member
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    async def fetch_member(self, member_id):
+        await self.backend.request("GET /guilds/{guild_id}/members/{user_id}", self.id)
+        return self._members[member_id]
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def remove_channel(self, channel):
+        self._channels.pop(channel.id, None)
+        if channel in self.categories:
+            self.categories.remove(channel)
+
+    async def create_category(self, name, overwrites=None):
+        await self.backend.request("POST /guilds/{guild_id}/channels", self.id)
+        category = FakeCategoryChannel(self, name, overwrites=overwrites)
+        self.categories.append(category)
+        # like in discord.py, categories are channels of the guild, too
+        self._channels[category.id] = category
+        return category
+
+    async def create_text_channel(self, name, category=None, topic=None, overwrites=None):
+        await self.backend.request("POST /guilds/{guild_id}/channels", self.id)
+        channel = FakeTextChannel(self, name, category=category, topic=topic)
+        self._channels[channel.id] = channel
+        return channel
+
+    async def create_stage_channel(self, name, category=None, overwrites=None):
+        await self.backend.request("POST /guilds/{guild_id}/channels", self.id)
+        channel = FakeStageChannel(self, name, category=category, overwrites=overwrites)
+        self._channels[channel.id] = channel
+        return channel
@@ -0,0 +1,677 @@
+# SPDX-License-Identifier: GPL-3.0
+"""Local stand-in for discord's REST API and gateway, which an unmodified DynChannelBot can connect to.
+
+Unlike benchmarks/fake_discord.py, the bot talks to it over HTTP and a websocket, through discord.py, so the whole
+stack is exercised: request serialization, discord.py's rate limit handling, gateway parsing, the discord cache and
+the event callbacks. Point discord.py at the server with routed_to(server) and log in with any token.
+
+Every request takes `latency` seconds. Requests beyond the rate limit of their bucket (endpoint and major parameter,
+like discord's route buckets) are answered with 429 and the rate limit headers discord sends. Channels beyond
+discord's category and guild limits are rejected. Changes made through the REST API are dispatched to the gateway
+sessions, like discord does. Users are simulated by react(), press_button(), edit_channel() and move_member(), which
+change the state and dispatch the matching gateway events.
+
+Only the endpoints and events the bot uses are implemented.
+"""
+
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Set
+
+import discord.http
+from aiohttp import WSMsgType, web
+
+from benchmarks.fake_discord import RateLimit
+from dynamic_channel.capacity import CATEGORY_CHANNEL_LIMIT, GUILD_CHANNEL_LIMIT
+
+DISCORD_EPOCH = 1420070400000
+
+# gateway opcodes
+DISPATCH = 0
+HEARTBEAT = 1
+IDENTIFY = 2
+RESUME = 6
+REQUEST_MEMBERS = 8
+INVALID_SESSION = 9
+HELLO = 10
+HEARTBEAT_ACK = 11
+
+GUILD_MEMBERS_INTENT = 1 << 1
+
+# interaction and component types
+MESSAGE_COMPONENT = 3
+BUTTON = 2
+
+# channel types
+TEXT = 0
+CATEGORY = 4
+STAGE = 13
+
+# route parameters which get their own rate limit bucket, like on discord
+MAJOR_PARAMETERS = ("channel_id", "guild_id")
+
+
+@contextmanager
+def routed_to(server: "FakeDiscordServer"):
+    """Send the REST requests of discord.py to the server instead of discord."""
+    base = discord.http.Route.BASE
+    version = base.rsplit("/v", 1)[1]
+    discord.http.Route.BASE = f"{server.url}/api/v{version}"
+    try:
+        yield
+    finally:
+        discord.http.Route.BASE = base
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _json(data, status=200, headers=None) -> web.Response:
+    # discord.py only decodes responses whose content type is exactly application/json
+    return web.Response(body=json.dumps(data).encode(), status=status, content_type="application/json", headers=headers)
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, code: int, message: str):
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class GatewaySession:
+    """A websocket connection of one shard. Events are sent in order by a single task."""
+
+    def __init__(self, ws: web.WebSocketResponse):
+        self.ws = ws
+        self.shard_id = 0
+        self.shard_count = 1
+        self.intents = 0
+        self.identified = False
+        self._sequence = itertools.count(1)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._sender = asyncio.ensure_future(self._send_forever())
+
+    def covers(self, guild_id: int) -> bool:
+        return self.identified and (guild_id >> 22) % self.shard_count == self.shard_id
+
+    def send(self, op: int, data, event: Optional[str] = None):
+        payload = {"op": op, "d": data}
+        if op == DISPATCH:
+            payload.update(t=event, s=next(self._sequence))
+        self._queue.put_nowait(json.dumps(payload))
+
+    async def _send_forever(self):
+        while True:
+            message = await self._queue.get()
+            if self.ws.closed:
+                return
+            await self.ws.send_str(message)
+
+    def close(self):
+        self._sender.cancel()
+
+
+class ServerGuild:
+    """The state of a guild on the server."""
+
+    def __init__(self, guild_id: int, name: str, owner_id: int):
+        self.id = guild_id
+        self.name = name
+        self.owner_id = owner_id
+        self.roles = [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0}]
+        self.members: Dict[int, dict] = {}
+        self.channel_ids: List[int] = []
+        self.voice_states: Dict[int, dict] = {}  # by user ID
+
+
+class ServerMessage:
+    def __init__(self, data: dict):
+        self.data = data
+        self.reactors: Dict[str, Set[int]] = {}  # user IDs by emoji
+
+    def json(self, me: int) -> dict:
+        reactions = [
+            {"emoji": {"id": None, "name": emoji}, "count": len(users), "me": me in users}
+            for emoji, users in self.reactors.items()
+            if users
+        ]
+        return dict(self.data, reactions=reactions)
+
+
+class FakeDiscordServer:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        rate_limit: Optional[RateLimit] = None,
+        shard_count: int = 1,
+        category_channel_limit: int = CATEGORY_CHANNEL_LIMIT,
+        guild_channel_limit: int = GUILD_CHANNEL_LIMIT,
+    ):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.shard_count = shard_count
+        self.category_channel_limit = category_channel_limit
+        self.guild_channel_limit = guild_channel_limit
+
+        self.requests = Counter()  # by endpoint, e.g. "POST /guilds/{guild_id}/channels"
+        self.rate_limited = 0
+        # called with the endpoint, the route parameters and the JSON body of every successful request
+        self.observers: List[Callable[[str, Dict[str, str], Optional[dict]], None]] = []
+
+        self._last_id = 0
+        self.bot_user = self.user(self.next_id(), "bot", bot=True)
+        self.guilds: Dict[int, ServerGuild] = {}
+        self.channels: Dict[int, dict] = {}
+        self.messages: Dict[int, Dict[int, ServerMessage]] = {}  # by channel ID, then message ID
+        self.interactions: Dict[str, dict] = {}  # by token
+        # the callback types and followup messages the bot answered interactions with, by interaction token
+        self.interaction_responses: Dict[str, List[int]] = {}
+        self.followups: Dict[str, List[str]] = {}
+        self.sessions: List[GatewaySession] = []
+
+        self.url: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    def next_id(self) -> int:
+        """A snowflake of the current time, so that discord.py derives proper creation times from IDs."""
+        self._last_id = max(self._last_id + 1, (int(time.time() * 1000) - DISCORD_EPOCH) << 22)
+        return self._last_id
+
+    @staticmethod
+    def user(user_id: int, name: str, bot=False) -> dict:
+        return {"id": str(user_id), "username": name, "discriminator": "0001", "avatar": None, "bot": bot}
+
+    # server
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application(middlewares=[self._middleware])
+        api = "/api/v{version}"
+        routes = [
+            ("GET", "/users/@me", self._get_me),
+            ("GET", "/oauth2/applications/@me", self._get_application),
+            ("GET", "/gateway", self._get_gateway),
+            ("GET", "/gateway/bot", self._get_gateway),
+            ("POST", "/guilds/{guild_id}/channels", self._create_channel),
+            ("GET", "/guilds/{guild_id}/members/{user_id}", self._get_member),
+            ("PATCH", "/channels/{channel_id}", self._edit_channel),
+            ("DELETE", "/channels/{channel_id}", self._delete_channel),
+            ("GET", "/channels/{channel_id}/messages", self._get_messages),
+            ("POST", "/channels/{channel_id}/messages", self._send_message),
+            ("POST", "/channels/{channel_id}/messages/bulk-delete", self._bulk_delete_messages),
+            ("GET", "/channels/{channel_id}/messages/{message_id}", self._get_message),
+            ("PATCH", "/channels/{channel_id}/messages/{message_id}", self._edit_message),
+            ("DELETE", "/channels/{channel_id}/messages/{message_id}", self._delete_message),
+            ("PUT", "/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me", self._add_reaction),
+            (
+                "DELETE",
+                "/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/{user_id}",
+                self._remove_reaction,
+            ),
+            ("POST", "/interactions/{interaction_id}/{interaction_token}/callback", self._interaction_callback),
+            ("POST", "/webhooks/{application_id}/{interaction_token}", self._send_followup),
+        ]
+        for method, path, handler in routes:
+            app.router.add_route(method, api + path, handler)
+        app.router.add_get("/gateway", self._gateway)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        for session in self.sessions:
+            session.close()
+            await session.ws.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        resource = request.match_info.route.resource
+        if resource is None or not resource.canonical.startswith("/api/"):
+            return await handler(request)  # the gateway, or no such endpoint
+        endpoint = f"{request.method} {resource.canonical.split('}', 1)[1]}"
+        version = int(request.match_info.get("version", 10))
+        self.requests[endpoint] += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+        headers = {}
+        if self.rate_limit is not None:
+            bucket = (endpoint,) + tuple(request.match_info.get(p) for p in MAJOR_PARAMETERS)
+            retry_after = self.rate_limit.acquire(bucket, time.monotonic())
+            remaining, reset_after = self.rate_limit.state(bucket, time.monotonic())
+            headers = {
+                "X-RateLimit-Limit": str(self.rate_limit.limit),
+                "X-RateLimit-Remaining": str(remaining),
+                "X-RateLimit-Reset": str(time.time() + reset_after),
+                "X-RateLimit-Reset-After": str(reset_after),
+                "X-RateLimit-Bucket": str(hash(bucket)),
+            }
+            if retry_after > 0:
+                self.rate_limited += 1
+                # API versions before 8 give the time in milliseconds. Without Via, discord.py assumes a ban.
+                return _json(
+                    {
+                        "message": "You are being rate limited.",
+                        "retry_after": retry_after * 1000 if version < 8 else retry_after,
+                        "global": False,
+                    },
+                    status=429,
+                    headers=dict(headers, Via="1.1 google"),
+                )
+
+        body = await request.json() if request.can_read_body else None
+        try:
+            response = await handler(request, body)
+        except HTTPError as e:
+            return _json({"message": e.message, "code": e.code}, status=e.status, headers=headers)
+        for observer in self.observers:
+            observer(endpoint, dict(request.match_info), body)
+        response.headers.update(headers)
+        return response
+
+    def _guild(self, guild_id) -> ServerGuild:
+        guild = self.guilds.get(int(guild_id))
+        if guild is None:
+            raise HTTPError(404, 10004, "Unknown Guild")
+        return guild
+
+    def _channel(self, channel_id) -> dict:
+        channel = self.channels.get(int(channel_id))
+        if channel is None:
+            raise HTTPError(404, 10003, "Unknown Channel")
+        return channel
+
+    def _message(self, channel_id, message_id) -> ServerMessage:
+        message = self.messages.get(int(channel_id), {}).get(int(message_id))
+        if message is None:
+            raise HTTPError(404, 10008, "Unknown Message")
+        return message
+
+    # gateway
+
+    def dispatch(self, guild_id: int, event: str, data: dict):
+        """Send an event to the shard of a guild."""
+        for session in self.sessions:
+            if session.covers(guild_id):
+                session.send(DISPATCH, data, event)
+
+    async def _gateway(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        session = GatewaySession(ws)
+        self.sessions.append(session)
+        session.send(HELLO, {"heartbeat_interval": 41250})
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                payload = json.loads(message.data)
+                op, data = payload["op"], payload.get("d")
+                if op == HEARTBEAT:
+                    session.send(HEARTBEAT_ACK, None)
+                elif op == IDENTIFY:
+                    self._identify(session, data)
+                elif op == RESUME:
+                    session.send(INVALID_SESSION, False)
+                elif op == REQUEST_MEMBERS:
+                    guild = self._guild(data["guild_id"])
+                    chunk = {"guild_id": str(guild.id), "members": list(guild.members.values())}
+                    chunk.update(chunk_index=0, chunk_count=1, nonce=data.get("nonce"), not_found=[])
+                    session.send(DISPATCH, chunk, "GUILD_MEMBERS_CHUNK")
+        finally:
+            session.close()
+            self.sessions.remove(session)
+        return ws
+
+    def _identify(self, session: GatewaySession, data: dict):
+        session.shard_id, session.shard_count = data.get("shard", [0, 1])
+        session.intents = data.get("intents", 0)
+        session.identified = True
+        guilds = [guild for guild in self.guilds.values() if session.covers(guild.id)]
+        ready = {
+            "v": 10,
+            "user": self.bot_user,
+            "guilds": [{"id": str(guild.id), "unavailable": True} for guild in guilds],
+            "session_id": uuid.uuid4().hex,
+            "resume_gateway_url": self.url.replace("http", "ws", 1),
+            "application": {"id": self.bot_user["id"], "flags": 0},
+            "private_channels": [],
+            "relationships": [],
+            "shard": [session.shard_id, session.shard_count],
+            "_trace": ["fake-discord"],
+        }
+        session.send(DISPATCH, ready, "READY")
+        for guild in guilds:
+            session.send(DISPATCH, self._guild_create(guild, session.intents), "GUILD_CREATE")
+
+    def _guild_create(self, guild: ServerGuild, intents: int) -> dict:
+        members = list(guild.members.values())
+        if not intents & GUILD_MEMBERS_INTENT:
+            # like discord, only the bot and the members in voice channels
+            member_ids = {int(self.bot_user["id"])} | set(guild.voice_states)
+            members = [m for m in members if int(m["user"]["id"]) in member_ids]
+        return {
+            "id": str(guild.id),
+            "name": guild.name,
+            "owner_id": str(guild.owner_id),
+            "member_count": len(guild.members),
+            "large": len(guild.members) > 250,
+            "unavailable": False,
+            "roles": guild.roles,
+            "emojis": [],
+            "stickers": [],
+            "features": [],
+            "channels": [self.channels[i] for i in guild.channel_ids],
+            "threads": [],
+            "members": members,
+            "voice_states": list(guild.voice_states.values()),
+            "presences": [],
+            "joined_at": _now(),
+        }
+
+    # simulated users
+
+    def add_guild(self, name: str, member_count: int) -> ServerGuild:
+        """Add a guild with the bot and member_count members named user0, user1, ..."""
+        guild = ServerGuild(self.next_id(), name, owner_id=int(self.bot_user["id"]))
+        self.guilds[guild.id] = guild
+        for user in [self.bot_user] + [self.user(self.next_id(), f"user{i}") for i in range(member_count)]:
+            member = {"user": user, "roles": [], "joined_at": _now(), "deaf": False, "mute": False, "flags": 0}
+            guild.members[int(user["id"])] = member
+        return guild
+
+    def member_ids(self, guild: ServerGuild) -> List[int]:
+        """The IDs of the members, without the bot."""
+        return [i for i in guild.members if i != int(self.bot_user["id"])]
+
+    def find_channel(self, guild: ServerGuild, name: str) -> Optional[dict]:
+        return next((self.channels[i] for i in guild.channel_ids if self.channels[i]["name"] == name), None)
+
+    def latest_message(self, channel_id: int) -> Optional[ServerMessage]:
+        messages = self.messages.get(channel_id)
+        return messages[max(messages)] if messages else None
+
+    def react(self, guild: ServerGuild, channel_id: int, message_id: int, user_id: int, emoji: str):
+        """A member adds a reaction to a message."""
+        self._message(channel_id, message_id).reactors.setdefault(emoji, set()).add(user_id)
+        data = {
+            "user_id": str(user_id),
+            "channel_id": str(channel_id),
+            "message_id": str(message_id),
+            "guild_id": str(guild.id),
+            "emoji": {"id": None, "name": emoji},
+            "member": guild.members[user_id],
+        }
+        self.dispatch(guild.id, "MESSAGE_REACTION_ADD", data)
+
+    def press_button(self, guild: ServerGuild, channel_id: int, message_id: int, user_id: int, custom_id: str) -> str:
+        """A member presses a button below a message. Returns the token of the interaction, which the answers of the
+        bot are recorded under."""
+        message = self._message(channel_id, message_id)
+        channel = self._channel(channel_id)
+        token = uuid.uuid4().hex
+        data = {
+            "id": str(self.next_id()),
+            "application_id": self.bot_user["id"],
+            "type": MESSAGE_COMPONENT,
+            "data": {"custom_id": custom_id, "component_type": BUTTON},
+            "guild_id": str(guild.id),
+            "channel_id": channel["id"],
+            "channel": channel,
+            "member": dict(guild.members[user_id], permissions="0"),
+            "message": message.json(int(self.bot_user["id"])),
+            "token": token,
+            "version": 1,
+            "locale": "en-US",
+            "guild_locale": "en-US",
+        }
+        self.interactions[token] = data
+        self.dispatch(guild.id, "INTERACTION_CREATE", data)
+        return token
+
+    def edit_channel(self, channel_id: int, **fields):
+        """A member edits a channel, e.g. its name or topic."""
+        channel = self._channel(channel_id)
+        channel.update(fields)
+        self.dispatch(int(channel["guild_id"]), "CHANNEL_UPDATE", channel)
+
+    def move_member(self, guild: ServerGuild, user_id: int, channel_id: Optional[int]):
+        """A member joins a voice channel, or leaves voice if channel_id is None."""
+        state = {
+            "guild_id": str(guild.id),
+            "channel_id": str(channel_id) if channel_id is not None else None,
+            "user_id": str(user_id),
+            "session_id": uuid.uuid4().hex,
+            "deaf": False,
+            "mute": False,
+            "self_deaf": False,
+            "self_mute": False,
+            "self_video": False,
+            "suppress": True,
+            "request_to_speak_timestamp": None,
+            "member": guild.members[user_id],
+        }
+        if channel_id is None:
+            guild.voice_states.pop(user_id, None)
+        else:
+            guild.voice_states[user_id] = state
+        self.dispatch(guild.id, "VOICE_STATE_UPDATE", state)
+
+    # REST endpoints
+
+    async def _get_me(self, request, body):
+        return _json(self.bot_user)
+
+    async def _get_application(self, request, body):
+        data = {"id": self.bot_user["id"], "name": "bot", "description": "", "icon": None, "owner": self.bot_user}
+        data.update(bot_public=True, bot_require_code_grant=False, flags=0, verify_key="", summary="")
+        return _json(data)
+
+    async def _get_gateway(self, request, body):
+        data = {"url": self.url.replace("http", "ws", 1) + "/gateway", "shards": self.shard_count}
+        data["session_start_limit"] = {"total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 1}
+        return _json(data)
+
+    async def _create_channel(self, request, body):
+        guild = self._guild(request.match_info["guild_id"])
+        parent_id = body.get("parent_id")
+        if len(guild.channel_ids) >= self.guild_channel_limit:
+            raise HTTPError(400, 30013, f"Maximum number of guild channels reached ({self.guild_channel_limit})")
+        if parent_id is not None:
+            siblings = [i for i in guild.channel_ids if self.channels[i].get("parent_id") == str(parent_id)]
+            if len(siblings) >= self.category_channel_limit:
+                raise HTTPError(400, 50035, f"Maximum number of channels in category reached ({len(siblings)})")
+        channel = {
+            "id": str(self.next_id()),
+            "type": body.get("type", TEXT),
+            "guild_id": str(guild.id),
+            "name": body["name"],
+            "position": len(guild.channel_ids),
+            "parent_id": str(parent_id) if parent_id is not None else None,
+            "permission_overwrites": body.get("permission_overwrites", []),
+            "topic": body.get("topic"),
+            "nsfw": False,
+            "rate_limit_per_user": 0,
+            "last_message_id": None,
+            "bitrate": 64000,
+            "user_limit": 0,
+            "rtc_region": None,
+        }
+        self.channels[int(channel["id"])] = channel
+        guild.channel_ids.append(int(channel["id"]))
+        self.dispatch(guild.id, "CHANNEL_CREATE", channel)
+        return _json(channel, status=201)
+
+    async def _get_member(self, request, body):
+        member = self._guild(request.match_info["guild_id"]).members.get(int(request.match_info["user_id"]))
+        if member is None:
+            raise HTTPError(404, 10007, "Unknown Member")
+        return _json(member)
+
+    async def _edit_channel(self, request, body):
+        channel = self._channel(request.match_info["channel_id"])
+        for field in ("name", "topic", "parent_id", "permission_overwrites", "position"):
+            if field in body:
+                channel[field] = body[field]
+        self.dispatch(int(channel["guild_id"]), "CHANNEL_UPDATE", channel)
+        return _json(channel)
+
+    async def _delete_channel(self, request, body):
+        channel = self._channel(request.match_info["channel_id"])
+        channel_id = int(channel["id"])
+        guild = self.guilds[int(channel["guild_id"])]
+        del self.channels[channel_id]
+        guild.channel_ids.remove(channel_id)
+        self.messages.pop(channel_id, None)
+        self.dispatch(guild.id, "CHANNEL_DELETE", channel)
+        return _json(channel)
+
+    async def _get_messages(self, request, body):
+        self._channel(request.match_info["channel_id"])
+        query = request.query
+        message_ids = sorted(self.messages.get(int(request.match_info["channel_id"]), {}))
+        if "before" in query:
+            message_ids = [i for i in message_ids if i < int(query["before"])]
+        if "after" in query:
+            message_ids = [i for i in message_ids if i > int(query["after"])]
+        limit = int(query.get("limit", 50))
+        # the oldest ones after `after`, otherwise the newest ones, always newest first
+        message_ids = message_ids[:limit] if "after" in query and "before" not in query else message_ids[-limit:]
+        messages = self.messages.get(int(request.match_info["channel_id"]), {})
+        me = int(self.bot_user["id"])
+        return _json([messages[i].json(me) for i in reversed(message_ids)])
+
+    async def _send_message(self, request, body):
+        channel = self._channel(request.match_info["channel_id"])
+        data = {
+            "id": str(self.next_id()),
+            "channel_id": channel["id"],
+            "guild_id": channel["guild_id"],
+            "author": self.bot_user,
+            "content": body.get("content") or "",
+            "timestamp": _now(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+            "flags": 0,
+            "components": body.get("components", []),
+        }
+        message = ServerMessage(data)
+        self.messages.setdefault(int(channel["id"]), {})[int(data["id"])] = message
+        payload = message.json(int(self.bot_user["id"]))
+        self.dispatch(int(channel["guild_id"]), "MESSAGE_CREATE", payload)
+        return _json(payload)
+
+    async def _bulk_delete_messages(self, request, body):
+        channel = self._channel(request.match_info["channel_id"])
+        messages = self.messages.get(int(channel["id"]), {})
+        for message_id in body["messages"]:
+            messages.pop(int(message_id), None)
+        data = {"ids": body["messages"], "channel_id": channel["id"], "guild_id": channel["guild_id"]}
+        self.dispatch(int(channel["guild_id"]), "MESSAGE_DELETE_BULK", data)
+        return web.Response(status=204)
+
+    async def _get_message(self, request, body):
+        message = self._message(request.match_info["channel_id"], request.match_info["message_id"])
+        return _json(message.json(int(self.bot_user["id"])))
+
+    async def _edit_message(self, request, body):
+        message = self._message(request.match_info["channel_id"], request.match_info["message_id"])
+        for field in ("content", "components"):
+            if field in body:
+                message.data[field] = body[field]
+        message.data["edited_timestamp"] = _now()
+        payload = message.json(int(self.bot_user["id"]))
+        self.dispatch(int(message.data["guild_id"]), "MESSAGE_UPDATE", payload)
+        return _json(payload)
+
+    async def _delete_message(self, request, body):
+        self._message(request.match_info["channel_id"], request.match_info["message_id"])
+        channel_id, message_id = int(request.match_info["channel_id"]), int(request.match_info["message_id"])
+        message = self.messages[channel_id].pop(message_id)
+        data = {"id": str(message_id), "channel_id": str(channel_id), "guild_id": message.data["guild_id"]}
+        self.dispatch(int(message.data["guild_id"]), "MESSAGE_DELETE", data)
+        return web.Response(status=204)
+
+    async def _add_reaction(self, request, body):
+        message = self._message(request.match_info["channel_id"], request.match_info["message_id"])
+        emoji = request.match_info["emoji"]
+        message.reactors.setdefault(emoji, set()).add(int(self.bot_user["id"]))
+        data = {
+            "user_id": self.bot_user["id"],
+            "channel_id": message.data["channel_id"],
+            "message_id": message.data["id"],
+            "guild_id": message.data["guild_id"],
+            "emoji": {"id": None, "name": emoji},
+        }
+        self.dispatch(int(message.data["guild_id"]), "MESSAGE_REACTION_ADD", data)
+        return web.Response(status=204)
+
+    async def _remove_reaction(self, request, body):
+        message = self._message(request.match_info["channel_id"], request.match_info["message_id"])
+        emoji, user_id = request.match_info["emoji"], request.match_info["user_id"]
+        user_id = self.bot_user["id"] if user_id == "@me" else user_id
+        message.reactors.get(emoji, set()).discard(int(user_id))
+        data = {
+            "user_id": user_id,
+            "channel_id": message.data["channel_id"],
+            "message_id": message.data["id"],
+            "guild_id": message.data["guild_id"],
+            "emoji": {"id": None, "name": emoji},
+        }
+        self.dispatch(int(message.data["guild_id"]), "MESSAGE_REACTION_REMOVE", data)
+        return web.Response(status=204)
+
+    def _interaction(self, token) -> dict:
+        interaction = self.interactions.get(token)
+        if interaction is None:
+            raise HTTPError(404, 10062, "Unknown interaction")
+        return interaction
+
+    async def _interaction_callback(self, request, body):
+        self._interaction(request.match_info["interaction_token"])
+        self.interaction_responses.setdefault(request.match_info["interaction_token"], []).append(body["type"])
+        return web.Response(status=204)
+
+    async def _send_followup(self, request, body):
+        token = request.match_info["interaction_token"]
+        if token not in self.interaction_responses:
+            raise HTTPError(404, 10015, "Unknown Webhook")  # not deferred or answered yet
+        self.followups.setdefault(token, []).append(body.get("content") or "")
+        data = {
+            "id": str(self.next_id()),
+            "channel_id": self._interaction(token)["channel_id"],
+            "author": self.bot_user,
+            "content": body.get("content") or "",
+            "timestamp": _now(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+            "flags": body.get("flags", 0),
+            "webhook_id": request.match_info["application_id"],
+        }
+        return _json(data)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-3.0
+"""Benchmark DynCategory lookups by owner and by channel for a growing number of tracked stages.
+
+Run with: python -m benchmarks.lookup
+"""
+
+import random
+import timeit
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from dynamic_channel.category import DynCategory
+from dynamic_channel.dyn_channel import DynChannel
+from dynamic_channel.events import EventFilter
+from dynamic_channel.expiry import ExpiryScheduler
+
+STAGE_COUNTS = [10, 100, 1_000, 10_000]
+LOOKUPS = 100_000
+
+
+def fake_guild(stage_count):
+    """A guild whose cache holds the owners and the channels of stage_count stages."""
+    members = {i: SimpleNamespace(id=i, display_name=f"user{i}") for i in range(stage_count)}
+    channels = {}
+    for i in range(stage_count):
+        channels[1_000_000 + 2 * i] = SimpleNamespace(id=1_000_000 + 2 * i, topic=None, members=[])
+        channels[1_000_000 + 2 * i + 1] = SimpleNamespace(id=1_000_000 + 2 * i + 1)
+    return SimpleNamespace(id=1, get_member=members.get, get_channel=channels.get)
+
+
+def empty_category(guild):
+    client = SimpleNamespace(
+        store=None,
+        expiry_scheduler=ExpiryScheduler(),
+        event_filter=EventFilter(),
+        pool_size=0,
+        category_channel_limit=None,
+        guild_channel_limit=None,
+    )
+    category_info = SimpleNamespace(stage_max_minutes=60, stage_idle_minutes=15, bot_control_message="")
+    dyn_guild = SimpleNamespace(client=client, guild=guild)
+    return DynCategory(dyn_guild=dyn_guild, category=SimpleNamespace(id=1), category_info=category_info)
+
+
+def new_dyn_channels(dyn_category, stage_count):
+    """The stages of the members of fake_guild(), not tracked yet."""
+    guild = dyn_category.guild
+    dyn_channels = []
+    for i in range(stage_count):
+        owner = guild.get_member(i)
+        dyn_channel = DynChannel(dyn_category, owner.id, owner.display_name)
+        dyn_channel.created_at = datetime.now(timezone.utc)
+        dyn_channel.stage_channel = guild.get_channel(1_000_000 + 2 * i)
+        dyn_channel.text_channel = guild.get_channel(1_000_000 + 2 * i + 1)
+        dyn_channels.append(dyn_channel)
+    return dyn_channels
+
+
+def populated_category(stage_count):
+    dyn_category = empty_category(fake_guild(stage_count))
+    for dyn_channel in new_dyn_channels(dyn_category, stage_count):
+        dyn_category._track(dyn_channel)
+    return dyn_category
+
+
+def main():
+    print(f"{'stages':>8} {'by owner [ns]':>14} {'by channel [ns]':>16}")
+    for stage_count in STAGE_COUNTS:
+        dyn_category = populated_category(stage_count)
+        dyn_channels = dyn_category.dyn_channels
+        owners = [dyn_category.guild.get_member(random.choice(dyn_channels).owner_id) for _ in range(LOOKUPS)]
+        channels = [random.choice(random.choice(dyn_channels).channels) for _ in range(LOOKUPS)]
+
+        by_owner = timeit.timeit(lambda: [dyn_category.dyn_channel_from_owner(o) for o in owners], number=1)
+        by_channel = timeit.timeit(lambda: [dyn_category.dyn_channel_fom_channel(c) for c in channels], number=1)
+        print(f"{stage_count:>8} {by_owner / LOOKUPS * 1e9:>14.1f} {by_channel / LOOKUPS * 1e9:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
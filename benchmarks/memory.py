@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-3.0
+"""Benchmark the memory used by the discord cache in the default and the lean runtime profile.
+
+Synthetic gateway events (guilds with members, voice states and chat messages) are fed into the client state without
+connecting to discord. Events are only delivered if the profile subscribes to their intent, like the gateway does.
+
+Run with: python -m benchmarks.memory
+"""
+
+import argparse
+import gc
+import tracemalloc
+
+from dynamic_channel.bot import PROFILES, DynChannelBot, client_options
+
+BOT_ID = 1
+
+
+def user(user_id):
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0001", "avatar": None}
+
+
+def member(user_id):
+    return {"user": user(user_id), "roles": [], "joined_at": "2021-01-01T00:00:00+00:00", "deaf": False, "mute": False}
+
+
+def guild_create(guild_id, member_count, voice_count, intents):
+    channel_ids = [guild_id * 1000 + i for i in range(10)]
+    member_ids = [guild_id * 100_000 + i for i in range(member_count)]
+    data = {
+        "id": str(guild_id),
+        "name": f"guild{guild_id}",
+        "owner_id": str(member_ids[0]),
+        "member_count": member_count + 1,
+        "large": member_count > 250,
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0}],
+        "emojis": [],
+        "features": [],
+        "channels": [
+            {"id": str(channel_id), "type": 0, "name": f"channel{channel_id}", "position": i, "guild_id": str(guild_id)}
+            for i, channel_id in enumerate(channel_ids)
+        ],
+        "voice_states": [],
+        "members": [member(BOT_ID)],
+        "presences": [],
+    }
+    # the gateway only sends voice states, members in voice channels and presences if subscribed
+    if intents.voice_states:
+        for member_id in member_ids[:voice_count]:
+            data["voice_states"].append(
+                {
+                    "user_id": str(member_id),
+                    "channel_id": str(channel_ids[-1]),
+                    "session_id": "x",
+                    "member": member(member_id),
+                }
+            )
+            data["members"].append(member(member_id))
+    if intents.members:
+        data["members"] += [member(member_id) for member_id in member_ids[voice_count:]]
+    if intents.presences:
+        data["presences"] = [{"user": {"id": str(m)}, "status": "online"} for m in member_ids]
+    return data, channel_ids, member_ids
+
+
+def message_create(message_id, guild_id, channel_id, author_id):
+    return {
+        "id": str(message_id),
+        "channel_id": str(channel_id),
+        "guild_id": str(guild_id),
+        "author": user(author_id),
+        "member": member(author_id),
+        "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit." * 2,
+        "timestamp": "2021-01-01T00:00:00+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+    }
+
+
+def measure(profile, guild_count, member_count, voice_count, message_count):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    bot = DynChannelBot(category_info=None, **client_options(profile))
+    state = bot._connection
+    state.user = state.store_user(user(BOT_ID))
+    intents = state._intents
+    for guild_id in range(1, guild_count + 1):
+        data, channel_ids, member_ids = guild_create(guild_id, member_count, voice_count, intents)
+        state.parse_guild_create(data)
+        if intents.guild_messages:
+            for i in range(message_count):
+                author_id = member_ids[i % len(member_ids)]
+                state.parse_message_create(
+                    message_create(guild_id * 10_000 + i, guild_id, channel_ids[i % 9], author_id)
+                )
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, len(bot.guilds), sum(len(g.members) for g in bot.guilds), len(bot.cached_messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--members", type=int, default=500, help="members per guild")
+    parser.add_argument("--voice", type=int, default=10, help="members in voice channels per guild")
+    parser.add_argument("--messages", type=int, default=50, help="chat messages per guild")
+    args = parser.parse_args()
+
+    print(f"{'profile':>8} {'memory [MiB]':>13} {'guilds':>7} {'members':>8} {'messages':>9}")
+    for profile in PROFILES:
+        used, guilds, members, messages = measure(profile, args.guilds, args.members, args.voice, args.messages)
+        print(f"{profile:>8} {used / 2**20:>13.1f} {guilds:>7} {members:>8} {messages:>9}")
+
+
+if __name__ == "__main__":
+    main()
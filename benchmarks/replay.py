@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-3.0
+"""Replay event traces against the bot through the local fake discord server and report throughput, latencies and
+REST requests per scenario.
+
+The bot runs unmodified on top of discord.py, connected to benchmarks/fake_server.py over HTTP and a websocket. A trace
+is a list of simulated user events, one JSON object per line, with the time in seconds since the start of the trace:
+
+    {"t": 0.0, "kind": "create", "user": 3}                  user3 reacts with 🆕 to the control message
+    {"t": 0.5, "kind": "topic", "user": 3, "topic": "Hi"}    user3 sets the topic of their stage
+    {"t": 0.5, "kind": "rename", "user": 3, "name": "x"}     someone renames user3's stage
+    {"t": 1.0, "kind": "join", "user": 7, "owner": 3}        user7 joins user3's stage
+    {"t": 1.5, "kind": "leave", "user": 7}                   user7 leaves voice
+    {"t": 2.0, "kind": "delete", "user": 3}                  user3 reacts with ❌
+
+Users are given by index into the members of the guild (user0, user1, ...). Traces are replayed `speed` times faster
+than recorded. Events which refer to a stage are held back until the stage exists, later events of the same user
+wait for them. An event is done once the bot
+reacted to it: create once both channels of the stage were requested, delete once both were deleted (or handed back
+to the pool), rename once the name was restored, topic with the next edit of the control message, join and leave once
+the bot handled the voice state update. Latencies are measured from dispatching the event.
+
+Synthetic scenarios are built in, any trace can be replayed with --trace. --save-traces writes the synthetic traces,
+e.g. to edit and replay them.
+
+Run with: python -m benchmarks.replay [--scenarios reaction-storm channel-edits voice] [--users 100] [--speed 10]
+    [--latency 0.05] [--rate-limit 5 5] [--pool-size 5] [--profile lean] [--trace trace.jsonl] [--output report.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import discord
+
+from benchmarks.fake_discord import RateLimit
+from benchmarks.fake_server import FakeDiscordServer, routed_to
+from benchmarks.suite import category_info
+from dynamic_channel.bot import PROFILES, DynChannelBot, client_options
+from dynamic_channel.message import ReactMessage
+
+SCENARIOS = ["reaction-storm", "channel-edits", "voice"]
+KINDS = ["create", "delete", "rename", "topic", "join", "leave"]
+# seconds to wait for the bot to handle all events after the last one was dispatched
+TIMEOUT = 60.0
+# the bot is done once it sent no requests for this many seconds, e.g. to remove reactions or edit the control message
+QUIET_SECONDS = 1.0
+
+
+def _emoji(action: str) -> str:
+    """The reaction of an action of the control message."""
+    return next(emoji for emoji, wrapper in ReactMessage.reactions.items() if wrapper.func.__name__ == action)
+
+
+CREATE_EMOJI = _emoji("create_dyn_channel")
+DELETE_EMOJI = _emoji("delete_stage")
+
+
+def synthetic_trace(scenario: str, users: int) -> List[dict]:
+    """Stages of `users` owners and, depending on the scenario, what happens to them. Owners react within a second."""
+    rng = random.Random(0)
+    trace = [{"t": rng.random(), "kind": "create", "user": u} for u in range(users)]
+    if scenario == "reaction-storm":
+        trace += [{"t": 2 + rng.random(), "kind": "delete", "user": u} for u in range(users)]
+    elif scenario == "channel-edits":
+        trace += [{"t": 2 + rng.random(), "kind": "topic", "user": u, "topic": f"Topic {u}"} for u in range(users)]
+        trace += [{"t": 4 + rng.random(), "kind": "rename", "user": u, "name": f"stage {u}"} for u in range(users)]
+    elif scenario == "voice":
+        # listeners are the members after the owners
+        for listener in range(users, 2 * users):
+            trace.append({"t": 2 + rng.random(), "kind": "join", "user": listener, "owner": rng.randrange(users)})
+            trace.append({"t": 4 + rng.random(), "kind": "leave", "user": listener})
+    else:
+        raise ValueError(f"Unknown scenario {scenario}, expected one of {SCENARIOS}.")
+    return sorted(trace, key=lambda event: event["t"])
+
+
+def load_trace(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as file:
+        return sorted((json.loads(line) for line in file if line.strip()), key=lambda event: event["t"])
+
+
+def save_trace(path: str, trace: List[dict]):
+    with open(path, "w", encoding="utf-8") as file:
+        for event in trace:
+            file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    return sorted(values)[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class ReplayBot(DynChannelBot):
+    """Reports handled voice state updates to the replay, they cause no REST requests."""
+
+    def __init__(self, *args, on_voice_state_handled=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_voice_state_handled = on_voice_state_handled
+
+    async def on_voice_state_update(self, member, before, after):
+        await super().on_voice_state_update(member, before, after)
+        if self.on_voice_state_handled is not None:
+            self.on_voice_state_handled(member.id)
+
+
+class Pending:
+    """A dispatched event, done once all its effects were observed."""
+
+    def __init__(self, kind: str, effects: int):
+        self.kind = kind
+        self.remaining = effects
+        self.dispatched_at = time.perf_counter()
+        self.done = asyncio.get_event_loop().create_future()
+
+    def observe(self):
+        self.remaining -= 1
+        if not self.remaining and not self.done.done():
+            self.done.set_result(time.perf_counter())
+
+
+class Replay:
+    """Replays a trace against a bot and a fake discord server, which are set up by run()."""
+
+    def __init__(self, trace: List[dict], speed: float, server: FakeDiscordServer, bot_options: dict):
+        self.trace = trace
+        self.speed = speed
+        self.server = server
+        self.bot_options = bot_options
+
+        self.guild = None
+        self.members: List[int] = []
+        self.control_channel_id: Optional[int] = None
+        self.control_message_id: Optional[int] = None
+
+        self.events: List[Pending] = []
+        # events waiting for their effects, by effect. Effects on the same key are observed in order.
+        self._waiting: Dict[tuple, deque] = {}
+        # creations by user, events which refer to a stage wait for them
+        self._creations: Dict[int, Pending] = {}
+
+    async def run(self) -> dict:
+        user_count = max(max(e["user"], e.get("owner", 0)) for e in self.trace) + 1 if self.trace else 0
+        self.guild = self.server.add_guild("replay", user_count)
+        self.members = self.server.member_ids(self.guild)
+        bot = ReplayBot(
+            category_info(),
+            guild_ready_timeout=0.1,
+            on_voice_state_handled=lambda user_id: self._observe(("voice", user_id)),
+            **self.bot_options,
+        )
+        await bot.login("fake token")
+        connection = asyncio.ensure_future(bot.connect())
+        try:
+            startup_started_at = time.perf_counter()
+            while bot.time_to_ready is None:
+                if connection.done():
+                    connection.result()  # raises the error
+                await asyncio.sleep(0.01)
+            startup_seconds = time.perf_counter() - startup_started_at
+            startup_requests = sum(self.server.requests.values())
+            return dict(await self._replay(), startup_seconds=startup_seconds, startup_rest_requests=startup_requests)
+        finally:
+            await bot.close()
+            await asyncio.gather(connection, return_exceptions=True)
+
+    async def _replay(self) -> dict:
+        server = self.server
+        control_channel = server.find_channel(self.guild, category_info().text_channel_name)
+        self.control_channel_id = int(control_channel["id"])
+        self.control_message_id = int(server.latest_message(self.control_channel_id).data["id"])
+        server.requests.clear()
+        server.rate_limited = 0
+        server.observers.append(self._on_request)
+
+        started_at = time.perf_counter()
+        dispatches = {}  # the last dispatch by user
+        for event in self.trace:
+            delay = started_at + event["t"] / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            previous = dispatches.get(event["user"])
+            dispatches[event["user"]] = asyncio.ensure_future(self._dispatch(event, previous))
+        await asyncio.gather(*dispatches.values())
+        _, not_done = await asyncio.wait([e.done for e in self.events], timeout=TIMEOUT) if self.events else ((), ())
+        await self._quiet()
+        server.observers.remove(self._on_request)
+
+        done = [e for e in self.events if e.done.done()]
+        finished_at = max((e.done.result() for e in done), default=started_at)
+        seconds = finished_at - started_at
+        latencies = {}
+        for kind in KINDS:
+            values = [e.done.result() - e.dispatched_at for e in done if e.kind == kind]
+            if values:
+                latencies[kind] = {
+                    "count": len(values),
+                    "p50": percentile(values, 0.5),
+                    "p90": percentile(values, 0.9),
+                    "p99": percentile(values, 0.99),
+                    "max": max(values),
+                }
+        return {
+            "events": len(self.trace),
+            "completed": len(done),
+            "timed_out": len(not_done),
+            "seconds": seconds,
+            "events_per_second": len(done) / seconds if seconds else None,
+            "latency_seconds": latencies,
+            "rest_requests": sum(server.requests.values()),
+            "rest_requests_by_endpoint": dict(sorted(server.requests.items())),
+            "rate_limited": server.rate_limited,
+        }
+
+    async def _quiet(self):
+        """Wait until the bot sent its last requests."""
+        while True:
+            requests = sum(self.server.requests.values())
+            await asyncio.sleep(QUIET_SECONDS)
+            if sum(self.server.requests.values()) == requests:
+                return
+
+    # effects
+
+    def _expect(self, kind: str, *keys) -> Pending:
+        pending = Pending(kind, len(keys))
+        for key in keys:
+            self._waiting.setdefault(key, deque()).append(pending)
+        self.events.append(pending)
+        return pending
+
+    def _observe(self, key):
+        waiting = self._waiting.get(key)
+        if waiting:
+            waiting.popleft().observe()
+
+    def _on_request(self, endpoint: str, parameters: Dict[str, str], body: Optional[dict]):
+        if endpoint == "POST /guilds/{guild_id}/channels":
+            self._observe(("name", body["name"]))
+        elif endpoint == "PATCH /channels/{channel_id}":
+            # new stages may get pooled channels
+            if "name" in body:
+                self._observe(("name", body["name"]))
+            self._observe(("channel", int(parameters["channel_id"])))
+        elif endpoint == "DELETE /channels/{channel_id}":
+            self._observe(("channel", int(parameters["channel_id"])))
+        elif endpoint == "PATCH /channels/{channel_id}/messages/{message_id}":
+            # one edit shows all topics changed since the last one
+            waiting = self._waiting.pop(("message", int(parameters["message_id"])), ())
+            for pending in waiting:
+                pending.observe()
+
+    # events
+
+    def _member(self, index: int) -> int:
+        return self.members[index]
+
+    async def _stage(self, user: int) -> Optional[dict]:
+        """The channels of the stage of a user, once they exist."""
+        creation = self._creations.get(user)
+        if creation is not None:
+            await asyncio.wait([creation.done], timeout=TIMEOUT)
+        name = f"user{user}"
+        stage = self.server.find_channel(self.guild, f"{name}'s stage")
+        text = self.server.find_channel(self.guild, f"{name}'s text")
+        return {"stage": stage, "text": text} if stage is not None and text is not None else None
+
+    async def _dispatch(self, event: dict, previous=None):
+        if previous is not None:
+            await previous
+        kind, user = event["kind"], event["user"]
+        server, guild = self.server, self.guild
+        if kind == "create":
+            self._creations[user] = self._expect(kind, ("name", f"user{user}'s stage"), ("name", f"user{user}'s text"))
+            server.react(guild, self.control_channel_id, self.control_message_id, self._member(user), CREATE_EMOJI)
+            return
+        if kind == "leave":
+            self._expect(kind, ("voice", self._member(user)))
+            server.move_member(guild, self._member(user), None)
+            return
+
+        stage = await self._stage(event.get("owner", user))
+        if stage is None:
+            logging.warning(f"Skipping {event}, the stage does not exist.")
+            return
+        stage_id, text_id = int(stage["stage"]["id"]), int(stage["text"]["id"])
+        if kind == "delete":
+            self._expect(kind, ("channel", stage_id), ("channel", text_id))
+            server.react(guild, self.control_channel_id, self.control_message_id, self._member(user), DELETE_EMOJI)
+        elif kind == "rename":
+            self._expect(kind, ("channel", stage_id))
+            server.edit_channel(stage_id, name=event["name"])
+        elif kind == "topic":
+            self._expect(kind, ("message", self.control_message_id))
+            server.edit_channel(stage_id, topic=event["topic"])
+        elif kind == "join":
+            self._expect(kind, ("voice", self._member(user)))
+            server.move_member(guild, self._member(user), stage_id)
+        else:
+            raise ValueError(f"Unknown event kind {kind}, expected one of {KINDS}.")
+
+
+async def replay(trace, speed, latency, rate_limit, bot_options) -> dict:
+    server = FakeDiscordServer(latency=latency, rate_limit=rate_limit)
+    await server.start()
+    try:
+        with routed_to(server):
+            return await Replay(trace, speed, server, bot_options).run()
+    finally:
+        await server.stop()
+
+
+def print_report(name: str, result: dict):
+    print(f"{name}: {result['completed']}/{result['events']} events in {result['seconds']:.2f} s", end="")
+    if result["events_per_second"]:
+        print(f" ({result['events_per_second']:.1f} events/s)", end="")
+    print(f", {result['timed_out']} timed out, startup {result['startup_seconds']:.2f} s")
+    print(f"  {'latency [ms]':<14} {'count':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+    for kind, latency in result["latency_seconds"].items():
+        values = " ".join(f"{latency[p] * 1000:>8.1f}" for p in ("p50", "p90", "p99", "max"))
+        print(f"  {kind:<14} {latency['count']:>6} {values}")
+    print(f"  {result['rest_requests']} REST requests, {result['rate_limited']} rate limited:")
+    for endpoint, count in result["rest_requests_by_endpoint"].items():
+        print(f"    {count:>6}  {endpoint}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--trace", nargs="+", default=[], help="replay these trace files instead of the scenarios")
+    parser.add_argument("--save-traces", metavar="DIRECTORY", help="write the synthetic traces to this directory")
+    parser.add_argument("--users", type=int, default=100, help="stage owners in the synthetic scenarios")
+    parser.add_argument("--speed", type=float, default=10.0, help="replay this many times faster than recorded")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated REST latency in seconds")
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        nargs=2,
+        metavar=("REQUESTS", "SECONDS"),
+        help="simulated rate limit per bucket (default: none)",
+    )
+    parser.add_argument("--pool-size", type=int, default=0, help="channel pool size per category")
+    parser.add_argument("--profile", choices=PROFILES, default="default", help="runtime profile of the bot")
+    parser.add_argument("--output", "-o", help="also write the report as JSON to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.trace:
+        traces = {os.path.basename(path): load_trace(path) for path in args.trace}
+    else:
+        traces = {scenario: synthetic_trace(scenario, args.users) for scenario in args.scenarios}
+    if args.save_traces:
+        os.makedirs(args.save_traces, exist_ok=True)
+        for name, trace in traces.items():
+            save_trace(os.path.join(args.save_traces, f"{name}.jsonl"), trace)
+
+    rate_limit = args.rate_limit
+    bot_options = {"pool_size": args.pool_size, **client_options(args.profile)}
+    results = []
+    for name, trace in traces.items():
+        limit = RateLimit(int(rate_limit[0]), rate_limit[1]) if rate_limit else None
+        result = asyncio.run(replay(trace, args.speed, args.latency, limit, bot_options))
+        print_report(name, result)
+        results.append(dict(result, scenario=name))
+
+    if args.output:
+        report = {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "discord.py": discord.__version__,
+            "config": {
+                "users": args.users,
+                "speed": args.speed,
+                "latency": args.latency,
+                "rate_limit": args.rate_limit,
+                "pool_size": args.pool_size,
+                "profile": args.profile,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            f.write(json.dumps(report, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-3.0
+"""Benchmark the startup of the bot after a restart with eager and with lazy guild activation.
+
+All guilds were set up before the restart and some of them have stages. Measures the time to ready, the REST requests
+and the memory used by the bot until it is ready, and for lazy activation the time to activate a guild on its first
+interaction. Runs against the in-process fake discord backend.
+
+Run with: python -m benchmarks.startup [--guilds 1000] [--latency 0.05]
+"""
+
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fake_discord import FakeDiscord, FakeGuild
+from benchmarks.suite import category_info
+from dynamic_channel.bot import ACTIVATIONS, DynChannelBot
+
+
+def make_bot(guilds, database, activation):
+    # guilds are only activated on demand, the background activation would skew the first use
+    bot = DynChannelBot(category_info(), database=database, activation=activation, activation_interval=0)
+    bot._connection.user = guilds[0].me
+    # the bot looks its guilds up by ID, like after a GUILD_CREATE
+    for guild in guilds:
+        bot._connection._add_guild(guild)
+    return bot
+
+
+async def prepare(guilds, database, stage_share):
+    """Set up all guilds and create stages like a previous run of the bot would have."""
+    bot = make_bot(guilds, database, "eager")
+    await bot.bootstrap(guilds)
+    for guild in guilds[: int(len(guilds) * stage_share)]:
+        dyn_category = bot._dyn_channel_guilds[guild.id].dyn_category
+        await dyn_category.create_dyn_channel(guild.add_member("owner"))
+    await bot.store.close()
+
+
+async def measure(guilds, backend, database, activation):
+    gc.collect()
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    requests_before = sum(backend.requests.values())
+
+    bot = make_bot(guilds, database, activation)
+    await bot.bootstrap(guilds)
+
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0] - memory_before
+    tracemalloc.stop()
+    requests = sum(backend.requests.values()) - requests_before
+
+    activation_seconds = None
+    if activation == "lazy":
+        started_at = time.perf_counter()
+        await bot.activate_guild(guilds[-1])
+        activation_seconds = time.perf_counter() - started_at
+
+    await bot.store.close()
+    return bot.time_to_ready, requests, memory, activation_seconds
+
+
+async def run(guild_count, latency, stage_share):
+    backend = FakeDiscord(latency=latency)
+    guilds = [FakeGuild(backend, name=f"guild{i}") for i in range(guild_count)]
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "dynamic_channel.db")
+        await prepare(guilds, database, stage_share)
+
+        print(f"{'activation':>10} {'ready [s]':>10} {'requests':>9} {'memory [MiB]':>13} {'first use [s]':>14}")
+        for activation in ACTIVATIONS:
+            ready, requests, memory, activation_seconds = await measure(guilds, backend, database, activation)
+            first_use = f"{activation_seconds:>14.3f}" if activation_seconds is not None else f"{'-':>14}"
+            print(f"{activation:>10} {ready:>10.3f} {requests:>9} {memory / 2**20:>13.2f} {first_use}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated REST latency in seconds")
+    parser.add_argument("--stages", type=float, default=0.1, help="share of guilds with a stage")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(run(args.guilds, args.latency, args.stages))
+
+
+if __name__ == "__main__":
+    main()
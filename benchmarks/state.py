@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-3.0
+"""Benchmark the memory of the tracked stages of a category.
+
+The owners and channels live in a fake discord cache, which is not counted. Measured is the memory of the stage
+records alone and of the records once they are tracked, i.e. including the indexes of the category, the rendered
+control message lines, the expiry schedule and the event filter.
+
+Run with: python -m benchmarks.state [--stages 100000]
+"""
+
+import argparse
+import gc
+import sys
+import tracemalloc
+
+from benchmarks.lookup import empty_category, fake_guild, new_dyn_channels
+
+
+def allocated() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def measure(stage_count):
+    dyn_category = empty_category(fake_guild(stage_count))
+    tracemalloc.start()
+    try:
+        before = allocated()
+        dyn_channels = new_dyn_channels(dyn_category, stage_count)
+        # the list holding the records is not part of them
+        records = allocated() - before - sys.getsizeof(dyn_channels)
+        for dyn_channel in dyn_channels:
+            dyn_category._track(dyn_channel)
+        tracked = allocated() - before - sys.getsizeof(dyn_channels)
+    finally:
+        tracemalloc.stop()
+    return records, tracked
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stages", type=int, default=100_000)
+    args = parser.parse_args()
+
+    records, tracked = measure(args.stages)
+    print(f"{args.stages} stages")
+    print(f"  records: {records / 2**20:>8.1f} MiB, {records / args.stages:>6.0f} bytes per stage")
+    print(f"  tracked: {tracked / 2**20:>8.1f} MiB, {tracked / args.stages:>6.0f} bytes per stage")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: GPL-3.0
+"""Benchmark the core classes against the in-process fake discord backend and emit the results as JSON.
+
+Measures stage creation and deletion throughput, purge time, lookup cost and control message render cost for a growing
+number of stages in one category. The fake does not enforce discord's channel limits.
+
+Run with: python -m benchmarks.suite [--stages 10 1000] [--latency 0.05] [--rate-limit 5 5] [--pool-size 5]
+    [--output results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import time
+from datetime import datetime, timezone
+
+import discord
+
+from benchmarks.fake_discord import FakeDiscord, FakeGuild, RateLimit
+from dynamic_channel.bot import CategoryInfo, DynChannelBot
+
+LOOKUPS = 10_000
+RENDERS = 100
+
+
+def category_info():
+    return CategoryInfo(
+        category_name="User Stages",
+        text_channel_name="create-your-stage",
+        text_channel_topic="Create your own stage",
+        bot_control_message="Create your brand-new personal stage!",
+        log_channel_name=None,
+        stage_max_minutes=600,
+    )
+
+
+class Setup:
+    """A bot with one guild on a fresh fake backend, bootstrapped like on_ready would."""
+
+    def __init__(self, backend: FakeDiscord, pool_size=0):
+        self.backend = backend
+        self.guild = FakeGuild(backend)
+        # the fake does not enforce discord's channel limits, neither does the bot here
+        self.bot = DynChannelBot(
+            category_info(), pool_size=pool_size, category_channel_limit=None, guild_channel_limit=None
+        )
+        self.bot._connection.user = self.guild.me
+        # the bot looks its guilds up by ID, like after a GUILD_CREATE
+        self.bot._connection._add_guild(self.guild)
+        self.dyn_category = None
+
+    async def bootstrap(self):
+        dyn_guild = await self.bot.dyn_channel_guild(guild=self.guild)
+        self.dyn_category = await dyn_guild.dyn_channel_category
+        control_channel = await self.dyn_category.control_channel
+        await control_channel.control_message
+
+    def add_members(self, count):
+        return [self.guild.add_member(f"user{i}") for i in range(count)]
+
+
+async def timed(setup: Setup, coro):
+    """Run coro and return its duration and the REST requests it caused."""
+    requests_before = sum(setup.backend.requests.values())
+    rate_limited_before = setup.backend.rate_limited
+    started_at = time.perf_counter()
+    await coro
+    seconds = time.perf_counter() - started_at
+    return (
+        seconds,
+        sum(setup.backend.requests.values()) - requests_before,
+        setup.backend.rate_limited - rate_limited_before,
+    )
+
+
+def result(benchmark, stages, seconds, operations, rest_requests=0, rate_limited=0):
+    return {
+        "benchmark": benchmark,
+        "stages": stages,
+        "seconds": seconds,
+        "operations": operations,
+        "operations_per_second": operations / seconds if seconds else None,
+        "rest_requests": rest_requests,
+        "rate_limited": rate_limited,
+    }
+
+
+async def run_scale(stage_count, make_backend, pool_size):
+    results = []
+    setup = Setup(make_backend(), pool_size=pool_size)
+    await setup.bootstrap()
+    dyn_category = setup.dyn_category
+    owners = setup.add_members(stage_count)
+
+    seconds, requests, limited = await timed(
+        setup, asyncio.gather(*(dyn_category.create_dyn_channel(owner) for owner in owners))
+    )
+    results.append(result("create", stage_count, seconds, stage_count, requests, limited))
+
+    dyn_channels = dyn_category.dyn_channels
+    sample_owners = [random.choice(owners) for _ in range(LOOKUPS)]
+    sample_channels = [random.choice(random.choice(dyn_channels).channels) for _ in range(LOOKUPS)]
+    started_at = time.perf_counter()
+    for owner in sample_owners:
+        dyn_category.dyn_channel_from_owner(owner)
+    for channel in sample_channels:
+        dyn_category.dyn_channel_fom_channel(channel)
+    results.append(result("lookup", stage_count, time.perf_counter() - started_at, 2 * LOOKUPS))
+
+    # change one stage and render the control message pages again
+    started_at = time.perf_counter()
+    for i in range(RENDERS):
+        dyn_channel = random.choice(dyn_channels)
+        dyn_channel.stage_channel.topic = f"Topic {i}"
+        dyn_category.update_control_message(dyn_channel)
+        dyn_category.control_message_pages()
+    results.append(result("render", stage_count, time.perf_counter() - started_at, RENDERS))
+
+    seconds, requests, limited = await timed(
+        setup, asyncio.gather(*(dyn_category.delete_dyn_channel(owner) for owner in owners))
+    )
+    results.append(result("delete", stage_count, seconds, stage_count, requests, limited))
+
+    await asyncio.gather(*(dyn_category.create_dyn_channel(owner) for owner in owners))
+    seconds, requests, limited = await timed(setup, dyn_category.purge())
+    results.append(result("purge", stage_count, seconds, stage_count, requests, limited))
+    return results
+
+
+async def run(stage_counts, make_backend, pool_size=0):
+    results = []
+    for stage_count in stage_counts:
+        logging.info(f"Running benchmarks with {stage_count} stages...")
+        results += await run_scale(stage_count, make_backend, pool_size)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stages", type=int, nargs="+", default=[10, 1_000, 100_000], help="stage counts")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated REST latency in seconds")
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        nargs=2,
+        metavar=("REQUESTS", "SECONDS"),
+        help="simulated rate limit per bucket (default: none)",
+    )
+    parser.add_argument("--pool-size", type=int, default=0, help="channel pool size per category")
+    parser.add_argument("--output", "-o", help="write JSON to this file instead of stdout")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    def make_backend():
+        rate_limit = RateLimit(int(args.rate_limit[0]), args.rate_limit[1]) if args.rate_limit else None
+        return FakeDiscord(latency=args.latency, rate_limit=rate_limit)
+
+    results = asyncio.run(run(args.stages, make_backend, args.pool_size))
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "discord.py": discord.__version__,
+        "config": {"latency": args.latency, "rate_limit": args.rate_limit, "pool_size": args.pool_size},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
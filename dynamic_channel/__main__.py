@@ -8,9 +8,11 @@ import os
 from dotenv import load_dotenv
 
 # TODO linters, README, licence, git, CI, CD?
-# from dynamic_channel.log import TextChannelHandler
 
-from .bot import CategoryInfo, DynChannelBot
+from .bot import ACTIVATIONS, PROFILES, CategoryInfo, DynChannelBot, client_options
+from .interactions import CONTROLS
+from .log import TextChannelHandler, start_queue_logging
+from .supervisor import ShardSupervisor
 
 logger = logging.getLogger(__name__)
 
@@ -30,26 +32,99 @@ if __name__ == "__main__":
         choices=logging._nameToLevel.keys(),
     )
     parser.add_argument("--logfile", "-f", default="discord.log", help="log file path")
+    parser.add_argument("--shards", "-s", type=int, help="total number of shards (default: recommended by discord)")
+    parser.add_argument(
+        "--processes", "-p", type=int, default=1, help="number of worker processes to distribute the shards over"
+    )
+    parser.add_argument(
+        "--bootstrap-concurrency",
+        type=int,
+        default=10,
+        help="number of guilds to set up concurrently after login",
+    )
+    parser.add_argument(
+        "--rest-concurrency",
+        type=int,
+        default=50,
+        help="maximum number of concurrent channel operations (creates, deletes) against discord",
+    )
+    parser.add_argument(
+        "--database",
+        "-d",
+        default="dynamic_channel.db",
+        help="SQLite database to keep the stages across restarts in (empty to disable)",
+    )
+    parser.add_argument(
+        "--journal",
+        default="dynamic_channel.journal",
+        help="file to log channel operations in, to recover them after a crash (empty to disable)",
+    )
+    parser.add_argument(
+        "--activation",
+        default="eager",
+        choices=ACTIVATIONS,
+        help="'lazy' only sets up guilds known from the database once they are used (requires --database)",
+    )
+    parser.add_argument(
+        "--activation-interval",
+        type=float,
+        default=1.0,
+        help="seconds between background setups of the guilds which lazy activation skipped (0 to disable)",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=0,
+        help="maximum number of hidden stages per guild which are kept ready for instant creation (default: disabled)",
+    )
+    parser.add_argument(
+        "--controls",
+        default="auto",
+        choices=CONTROLS,
+        help="'buttons' puts buttons below the control message instead of reactions (requires discord.py 2.0), "
+        "'auto' uses buttons if discord.py supports them",
+    )
+    parser.add_argument(
+        "--reconcile-interval",
+        type=float,
+        default=3600.0,
+        help="seconds between reconciliations of the channels with the tracked stages (0 to disable)",
+    )
+    parser.add_argument(
+        "--reconcile-apply",
+        action="store_true",
+        help="let periodic reconciliations change the channels instead of only logging what they would change",
+    )
+    parser.add_argument(
+        "--profile",
+        default="default",
+        choices=PROFILES,
+        help="runtime profile, 'lean' requests minimal intents and caches as little as possible",
+    )
+    parser.add_argument("--metrics-port", type=int, help="serve prometheus metrics on this port (default: disabled)")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="interface to serve metrics on")
     args = parser.parse_args()
+    if args.processes > 1 and args.shards is None:
+        parser.error("--processes requires --shards")
 
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging._nameToLevel[args.loglevel])
-
+    loglevel = logging._nameToLevel[args.loglevel]
     formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handlers = [
+        logging.StreamHandler(),
+        logging.FileHandler(filename=args.logfile, encoding="utf-8", mode="w"),
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
 
-    handler = logging.StreamHandler()
-    handler.setFormatter(formatter)
-    root_logger.addHandler(handler)
-
-    # TODO
-    # handler = TextChannelHandler()
-    # handler.setFormatter(logging.Formatter("%(levelname)s _%(name)s_  %(message)s"))
-    # handler.setLevel(logging.INFO)
-    # root_logger.addHandler(handler)
-
-    handler = logging.FileHandler(filename=args.logfile, encoding="utf-8", mode="w")
-    handler.setFormatter(formatter)
-    root_logger.addHandler(handler)
+    if args.processes > 1:
+        # the supervisor does not run an event loop, the workers send their records to it
+        root_logger = logging.getLogger()
+        root_logger.setLevel(loglevel)
+        for handler in handlers:
+            root_logger.addHandler(handler)
+    else:
+        # file and stream I/O happens in a background thread, guild logs are shipped to the log channels
+        log_listener = start_queue_logging(handlers + [TextChannelHandler()], loglevel)
 
     load_dotenv()
     TOKEN = args.token or os.getenv("DISCORD_TOKEN")
@@ -59,6 +134,9 @@ if __name__ == "__main__":
     STAGE_MAX_MINUTES = int(os.getenv("STAGE_MAX_MINUTES"))
     BOT_CONTROL_MESSAGE = os.getenv("BOT_CONTROL_MESSAGE")
     LOG_CHANNEL_NAME = os.getenv("LOG_CHANNEL_NAME")
+    CONTROL_MESSAGE_EDIT_INTERVAL = float(os.getenv("CONTROL_MESSAGE_EDIT_INTERVAL", "1.0"))
+    STAGE_EXTEND_MINUTES = int(os.getenv("STAGE_EXTEND_MINUTES", "10"))
+    STAGE_IDLE_MINUTES = int(os.getenv("STAGE_IDLE_MINUTES", "15"))
 
     category_info = CategoryInfo(
         category_name=CATEGORY_NAME,
@@ -67,7 +145,41 @@ if __name__ == "__main__":
         bot_control_message=BOT_CONTROL_MESSAGE,
         log_channel_name=LOG_CHANNEL_NAME,
         stage_max_minutes=STAGE_MAX_MINUTES,
+        control_message_edit_interval=CONTROL_MESSAGE_EDIT_INTERVAL,
+        stage_extend_minutes=STAGE_EXTEND_MINUTES,
+        stage_idle_minutes=STAGE_IDLE_MINUTES,
     )
 
-    logger.info("Connecting to discord.com...")
-    DynChannelBot(category_info).run(TOKEN)
+    bot_options = {
+        "bootstrap_concurrency": args.bootstrap_concurrency,
+        "rest_concurrency": args.rest_concurrency,
+        "database": args.database,
+        "journal": args.journal,
+        "activation": args.activation,
+        "activation_interval": args.activation_interval,
+        "pool_size": args.pool_size,
+        "controls": args.controls,
+        "reconcile_interval": args.reconcile_interval,
+        "reconcile_dry_run": not args.reconcile_apply,
+        "metrics_host": args.metrics_host,
+        "metrics_port": args.metrics_port,
+        **client_options(args.profile),
+    }
+
+    if args.processes > 1:
+        supervisor = ShardSupervisor(
+            token=TOKEN,
+            category_info=category_info,
+            shard_count=args.shards,
+            process_count=args.processes,
+            log_handlers=handlers,
+            loglevel=loglevel,
+            bot_options=bot_options,
+        )
+        supervisor.run()
+    else:
+        logger.info("Connecting to discord.com...")
+        try:
+            DynChannelBot(category_info, shard_count=args.shards, **bot_options).run(TOKEN)
+        finally:
+            log_listener.stop()
@@ -2,18 +2,33 @@
 import asyncio
 import datetime
 import logging
-from typing import Dict, Generator, List
+import time
+from typing import Any, Dict, Generator, List, Optional
 
 from discord import (
-    Client,
+    AutoShardedClient,
     Guild,
+    Intents,
+    MemberCacheFlags,
     PermissionOverwrite,
     StageChannel,
     TextChannel,
 )
 
+from dynamic_channel import metrics
+from dynamic_channel.capacity import CATEGORY_CHANNEL_LIMIT, GUILD_CHANNEL_LIMIT
+from dynamic_channel.category import DynCategory
+from dynamic_channel.events import EventFilter
+from dynamic_channel.expiry import ExpiryScheduler
 from dynamic_channel.guild import DynChannelGuild
+from dynamic_channel.interactions import CONTROLS, buttons_available, control_view
+from dynamic_channel.journal import Journal
+from dynamic_channel.locks import KeyedLock
+from dynamic_channel.log import set_guild
 from dynamic_channel.message import ReactMessage, react_to
+from dynamic_channel.pool import ChannelPool
+from dynamic_channel.scheduler import RestScheduler
+from dynamic_channel.store import ControlMessageRecord, StateStore
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +42,9 @@ class CategoryInfo:
         bot_control_message,
         log_channel_name,
         stage_max_minutes,
+        control_message_edit_interval=1.0,
+        stage_extend_minutes=10,
+        stage_idle_minutes=15,
     ):
         self.category_name = category_name
         self.text_channel_name = text_channel_name
@@ -34,67 +52,402 @@ class CategoryInfo:
         self.bot_control_message = bot_control_message
         self.log_channel_name = log_channel_name
         self.stage_max_minutes = stage_max_minutes
+        self.control_message_edit_interval = control_message_edit_interval
+        self.stage_extend_minutes = stage_extend_minutes  # old stages which are not empty are kept this much longer
+        self.stage_idle_minutes = stage_idle_minutes  # stages which are empty this long are deleted (0 to disable)
 
 
-class DynChannelBot(Client):
-    def __init__(self, category_info):
-        super().__init__()
+PROFILES = ["default", "lean"]
+ACTIVATIONS = ["eager", "lazy"]
+
+
+def client_options(profile: str) -> Dict[str, Any]:
+    """Get the discord client options for a runtime profile.
+
+    default: discord.py defaults. The default intents are given explicitly, discord.py 2.0 requires them.
+    lean: only the intents the bot needs (guilds, reactions, voice states), no member chunking, only members in voice
+        channels are cached (needed for stage occupancy) and no message cache (reactions are received as raw events).
+        Stage owners do not have to be cached, stages only keep their ID and name.
+    """
+    if profile == "default":
+        return {"intents": Intents.default()}
+    if profile == "lean":
+        intents = Intents.none()
+        intents.guilds = True
+        intents.guild_reactions = True
+        intents.voice_states = True
+        return {
+            "intents": intents,
+            "member_cache_flags": MemberCacheFlags.from_intents(intents),
+            "chunk_guilds_at_startup": False,
+            "max_messages": None,
+        }
+    raise ValueError(f"Unknown profile {profile}, expected one of {PROFILES}.")
+
+
+class DynChannelBot(AutoShardedClient):
+    def __init__(
+        self,
+        category_info,
+        bootstrap_concurrency=10,
+        rest_concurrency=50,
+        database=None,
+        journal=None,
+        activation="eager",
+        activation_interval=1.0,
+        pool_size=0,
+        controls="auto",
+        category_channel_limit=CATEGORY_CHANNEL_LIMIT,
+        guild_channel_limit=GUILD_CHANNEL_LIMIT,
+        reconcile_interval=3600.0,
+        reconcile_dry_run=True,
+        metrics_host="127.0.0.1",
+        metrics_port=None,
+        **options,
+    ):
+        """Options (e.g. shard_ids and shard_count) are passed on to the discord client."""
+        super().__init__(**options)
         self.category_info = category_info  # TODO is there a better way to do this? either way: typing
 
-        self._dyn_channel_guilds: Dict[Guild, DynChannelGuild] = {}
+        # number of guilds which are bootstrapped concurrently after login
+        self.bootstrap_concurrency = bootstrap_concurrency
+        # startup progress: number of bootstrapped guilds, out of the number of guilds to bootstrap
+        self.bootstrapped_guilds = 0
+        self.guilds_to_bootstrap = 0
+        # seconds from instantiation until all guilds were bootstrapped for the first time
+        self.time_to_ready: Optional[float] = None
+        self._created_at = time.monotonic()
+        # POSIX time of the start, restored stages are idle since then at the latest
+        self.started_at = time.time()
+
+        # all channel creations and deletions are scheduled here, by rate limit bucket and priority
+        self.rest_scheduler = RestScheduler(max_concurrency=rest_concurrency)
+
+        # tracked stages and control messages survive restarts if a database is given
+        self.store: Optional[StateStore] = StateStore(database) if database else None
+        # channel operations in flight are finished or rolled back after a crash if a journal file is given
+        self.journal: Optional[Journal] = Journal(journal) if journal else None
+
+        # eager: set up all guilds after login. lazy: set up guilds which are known from the store on their first
+        # interaction, once one of their stages expires or is idle for too long, or in the background one guild every
+        # activation_interval seconds (0 to disable). Only new guilds are set up after login.
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Unknown activation {activation}, expected one of {ACTIVATIONS}.")
+        self.activation = activation
+        self.activation_interval = activation_interval
+        self._activation_task = None
+        # guilds which are not set up yet, with their control message as a placeholder, indexed by guild ID
+        self._inactive_guilds: Dict[int, ControlMessageRecord] = {}
+        self._activation_locks = KeyedLock()
+
+        # set up guilds, indexed by guild ID
+        self._dyn_channel_guilds: Dict[int, DynChannelGuild] = {}
+        # maximal number of hidden channel pairs per category, kept ready for new stages (0 to disable)
+        self.pool_size = pool_size
+
+        # reactions: control messages react to reactions. buttons: control messages get buttons instead (requires
+        # discord.py 2.0), reactions to control messages from before still work. auto: buttons if available
+        if controls not in CONTROLS:
+            raise ValueError(f"Unknown controls {controls}, expected one of {CONTROLS}.")
+        if controls == "auto":
+            controls = "buttons" if buttons_available() else "reactions"
+        elif controls == "buttons" and not buttons_available():
+            raise ValueError("Buttons require discord.py 2.0 or newer.")
+        self.controls = controls
+        # view with the buttons of all control messages, created once the event loop runs
+        self.control_view = None
+        # stages overflow into further categories once a category is full (None for no limit)
+        self.category_channel_limit = category_channel_limit
+        self.guild_channel_limit = guild_channel_limit
 
-        # start timer function, will be called periodically
-        # TODO
-        # loop = asyncio.get_event_loop()
-        # loop.create_task(self.periodic())
+        # drops irrelevant gateway events early, knows the IDs of everything the bot manages
+        self.event_filter = EventFilter()
+
+        # DynCategories of all guilds, indexed by the IDs of their categories, including overflow categories
+        self._dyn_categories: Dict[int, DynCategory] = {}
+        # messages which react to reactions, indexed by message ID
+        self._react_messages: Dict[int, ReactMessage] = {}
+
+        # deletes stages after category_info.stage_max_minutes
+        self.expiry_scheduler = ExpiryScheduler()
+        self._expiry_task = None
+
+        # all categories are reconciled every reconcile_interval seconds (0 to disable). By default, this is a dry run
+        # which only logs the plans. Purges always apply them.
+        self.reconcile_interval = reconcile_interval
+        self.reconcile_dry_run = reconcile_dry_run
+        self._reconcile_task = None
+
+        # metrics are served on http://metrics_host:metrics_port/metrics, if a port is given
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
 
     async def dyn_channel_guild(self, guild: Guild) -> DynChannelGuild:
-        if guild in self._dyn_channel_guilds:
-            return self._dyn_channel_guilds[guild]
+        if guild.id in self._dyn_channel_guilds:
+            return self._dyn_channel_guilds[guild.id]
 
         dyn_guild = DynChannelGuild(client=self, guild=guild, category_info=self.category_info)
-        self._dyn_channel_guilds[guild] = dyn_guild
+        self._dyn_channel_guilds[guild.id] = dyn_guild
         return dyn_guild
 
-    async def periodic(self):
-        while True:
-            await asyncio.sleep(30)
+    def register_dyn_category(self, dyn_category: DynCategory, category_id: Optional[int] = None):
+        """Register a DynCategory by its category, or by one of its overflow categories."""
+        category_id = category_id or dyn_category.category_id
+        self._dyn_categories[category_id] = dyn_category
+        self.event_filter.category_ids.add(category_id)
+
+    def unregister_category(self, category_id: int):
+        self._dyn_categories.pop(category_id, None)
+        self.event_filter.category_ids.discard(category_id)
+
+    def dyn_category_from_channel(self, channel) -> Optional[DynCategory]:
+        """Get the DynCategory a channel belongs to, if any."""
+        return self._dyn_categories.get(channel.category_id)
+
+    def register_react_message(self, react_message: ReactMessage):
+        self._react_messages[react_message.message.id] = react_message
+        self.event_filter.message_ids.add(react_message.message.id)
+
+    def unregister_react_message(self, react_message: ReactMessage):
+        self._react_messages.pop(react_message.message.id, None)
+        self.event_filter.message_ids.discard(react_message.message.id)
+
+    def dispatch(self, event, *args, **kwargs):
+        """Drop irrelevant events before discord.py creates a task for their callback. Filtered events do not reach
+        wait_for() either."""
+        if self.event_filter.accepts(event, *args):
+            super().dispatch(event, *args, **kwargs)
+
+    async def on_raw_reaction_add(self, payload):
+        """Callback function. Is called for every reaction, regardless of the message cache.
+
+        discord.py runs every event callback in its own task, so reactions are handled concurrently. Locking is up to
+        the DynCategory.
+        """
+        set_guild(payload.guild_id)
+        if payload.user_id == self.user.id:
+            return
+        react_message = await self.react_message(payload.guild_id, payload.message_id)
+        if react_message is None:
+            return
+        await react_message.on_reaction(payload)
+
+    async def react_message(self, guild_id: int, message_id: int) -> Optional[ReactMessage]:
+        """Get the ReactMessage of a message, activating its guild if necessary."""
+        react_message = self._react_messages.get(message_id)
+        if react_message is None and guild_id in self._inactive_guilds:
+            await self.activate_guild(self.get_guild(guild_id))
+            react_message = self._react_messages.get(message_id)
+        return react_message
+
+    def _stage_counts(self):
+        for dyn_category in set(self._dyn_categories.values()):
+            yield (dyn_category.guild.id,), len(dyn_category.dyn_channels)
+
+    async def start(self, *args, **kwargs):
+        if self.metrics_port is not None:
+            await metrics.serve(self.metrics_host, self.metrics_port)
+            metrics.instrument_http(self.http)
+            metrics.STAGES.callback = self._stage_counts
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        logger.info(f"Gateway events (handled/filtered): {self.event_filter.summary()}")
+        await super().close()
+        if self.store is not None:
+            await self.store.close()
+        if self.journal is not None:
+            await self.journal.close()
+
+    async def bootstrap_guild(self, guild: Guild):
+        """Make sure the category, control channel and control message (and log channel, if any) exist in a guild."""
+        set_guild(guild.id)
+        logger.info(f"[{guild}] Logged on as {self.user} (shard {guild.shard_id})")
+
+        dyn_guild = await self.dyn_channel_guild(guild=guild)
+        dyn_category = await dyn_guild.dyn_channel_category
+        await dyn_category.log_channel
+        control_channel = await dyn_category.control_channel
+
+        # request bot control message to create it if it does not exist
+        await control_channel.control_message
+
+    async def activate_guild(self, guild: Guild):
+        """Set up an inactive guild. Concurrent calls set it up once."""
+        async with self._activation_locks(guild.id):
+            if guild.id not in self._inactive_guilds:
+                return
+            logger.info(f"[{guild}] Activating guild.")
+            await self.bootstrap_guild(guild)
+            del self._inactive_guilds[guild.id]
+
+    def _activate_later(self, guild_id: int):
+        guild = self.get_guild(guild_id)
+        if guild is not None:
+            self.loop.create_task(self.activate_guild(guild))
+
+    def _defer_activation(self, guilds: List[Guild]) -> List[Guild]:
+        """Keep placeholders for the guilds which were set up before. Returns the guilds which have to be set up now."""
+        if self.store is None:
+            return guilds
+
+        records = {record.guild_id: record for record in self.store.control_messages()}
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # restored stages are idle since the start
+        idle_deadline = datetime.datetime.fromtimestamp(self.started_at, datetime.timezone.utc) + datetime.timedelta(
+            minutes=self.category_info.stage_idle_minutes
+        )
+        active_guilds = []
+        for guild in guilds:
+            record = records.get(guild.id)
+            if record is None or guild.id in self._dyn_channel_guilds:
+                active_guilds.append(guild)
+                continue
 
-            logger.info(f"Perform periodic actions.")
-            for guild in self.guilds:
-                dyn_guild = await self.dyn_channel_guild(guild=guild)
-                dyn_category = await dyn_guild.dyn_channel_category
-                await dyn_category.delete_old_stages()  # TODO implement delete
+            self._inactive_guilds[guild.id] = record
+            # let the events of the guild pass, they activate it
+            self.event_filter.category_ids.add(record.category_id)
+            self.event_filter.message_ids.add(record.message_id)
 
-                # TODO update message?
-                # control_channel = await category.control_channel
-                # await self.update_control_message(channel=control_channel)
+            # stages still have to expire, and empty ones have to be deleted once they are idle for too long
+            created_at = self.store.earliest_dyn_channel(record.category_id)
+            if created_at is not None:
+                deadline = created_at + datetime.timedelta(minutes=self.category_info.stage_max_minutes)
+                if self.category_info.stage_idle_minutes:
+                    deadline = min(deadline, idle_deadline)
+                self.loop.call_later(max(0.0, (deadline - now).total_seconds()), self._activate_later, guild.id)
+        return active_guilds
+
+    async def activate_in_background(self):
+        """Activate the inactive guilds one after another, every activation_interval seconds. This catches up with
+        what changed while the bot was offline, e.g. deleted control messages, in guilds nobody uses."""
+        try:
+            while self._inactive_guilds:
+                await asyncio.sleep(self.activation_interval)
+                guild_id = next(iter(self._inactive_guilds), None)
+                if guild_id is None:
+                    return
+                guild = self.get_guild(guild_id)
+                if guild is None:
+                    # the bot was removed from the guild
+                    del self._inactive_guilds[guild_id]
+                    continue
+                try:
+                    await self.activate_guild(guild)
+                except Exception:
+                    logger.exception(f"[{guild}] Activation failed.")
+                    # try the other guilds first
+                    if guild_id in self._inactive_guilds:
+                        self._inactive_guilds[guild_id] = self._inactive_guilds.pop(guild_id)
+        finally:
+            self._activation_task = None
 
     async def on_ready(self):
         """Callback function. Is called after a successful login."""
+        if self.controls == "buttons" and self.control_view is None:
+            self.control_view = control_view(self)
+            # handle the buttons of control messages from before the restart, too
+            self.add_view(self.control_view)
+        if self._expiry_task is None:
+            self._expiry_task = self.loop.create_task(self.expiry_scheduler.run())
+        if self._reconcile_task is None and self.reconcile_interval:
+            self._reconcile_task = self.loop.create_task(self.reconcile_periodically())
+        await self.bootstrap(self.guilds)
+
+    async def reconcile_periodically(self):
+        """Repair drift between the channels and the tracked stages of all active categories, forever."""
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            for dyn_category in set(self._dyn_categories.values()):
+                try:
+                    await dyn_category.reconcile(dry_run=self.reconcile_dry_run)
+                except Exception:
+                    logger.exception(f"[{dyn_category.guild}] Reconciliation failed.")
+
+    async def bootstrap(self, guilds: List[Guild]):
+        """Set up the given guilds, or only the new ones if activation is lazy."""
+        started_at = time.monotonic()
+        if self.activation == "lazy":
+            guilds = self._defer_activation(guilds)
+            if self._inactive_guilds and self.activation_interval and self._activation_task is None:
+                self._activation_task = self.loop.create_task(self.activate_in_background())
+        self.bootstrapped_guilds = 0
+        self.guilds_to_bootstrap = len(guilds)
+        guilds = iter(guilds)
+        log_every = max(1, self.guilds_to_bootstrap // 10)
 
-        for guild in self.guilds:
-            logger.info(f"[{guild}] Logged on as {self.user}")
+        async def bootstrap_worker():
+            # all workers share the same iterator, so every guild is bootstrapped exactly once
+            for guild in guilds:
+                try:
+                    await self.bootstrap_guild(guild)
+                except Exception:
+                    logger.exception(f"[{guild}] Bootstrapping failed.")
+                self.bootstrapped_guilds += 1
+                if self.bootstrapped_guilds % log_every == 0:
+                    logger.info(f"Bootstrapped {self.bootstrapped_guilds}/{self.guilds_to_bootstrap} guilds.")
 
-            dyn_guild = await self.dyn_channel_guild(guild=guild)
-            dyn_category = await dyn_guild.dyn_channel_category
-            control_channel = await dyn_category.control_channel
+        worker_count = min(self.bootstrap_concurrency, self.guilds_to_bootstrap)
+        await asyncio.gather(*(bootstrap_worker() for _ in range(worker_count)))
 
-            # request bot control message to create it if it does not exist
-            await control_channel.control_message
+        if self.time_to_ready is None:
+            self.time_to_ready = time.monotonic() - self._created_at
+        logger.info(
+            f"Bootstrapped {self.bootstrapped_guilds} guilds in {time.monotonic() - started_at:.1f} seconds, "
+            f"{len(self._inactive_guilds)} guilds are inactive (time to ready: {self.time_to_ready:.1f} seconds)."
+        )
+
+    async def on_voice_state_update(self, member, before, after):
+        """Callback function. Is called once a member joins, leaves or moves between voice channels, or changes their
+        voice state. Keeps the occupancy of the stages up to date."""
+        if before.channel == after.channel:
+            return  # e.g. muted
+        for channel, joined in ((before.channel, False), (after.channel, True)):
+            if channel is None:
+                continue
+            dyn_category = self.dyn_category_from_channel(channel)
+            if dyn_category is not None:
+                dyn_category.update_occupancy(channel, member, joined)
 
     async def on_guild_channel_update(self, before, after):
         """Callback function. Is called once a channel is edited."""
-        dyn_guild = await self.dyn_channel_guild(guild=before.guild)
-        dyn_category = await dyn_guild.dyn_channel_category
+        set_guild(before.guild.id)
+        if before.guild.id in self._inactive_guilds:
+            await self.activate_guild(before.guild)
+        dyn_category = self.dyn_category_from_channel(before)
+        if dyn_category is None:
+            return
+
+        dyn_channel = dyn_category.dyn_channel_fom_channel(before)
+        if dyn_channel is None:
+            return
 
         if before.name != after.name:
-            dyn_channel = dyn_category.dyn_channel_fom_channel(before)
-            if dyn_channel is not None:
-                is_name_improper = after.name not in [dyn_channel.stage_name, dyn_channel.text_name]
-                if is_name_improper:
-                    logger.warning(f'Channel name was changed: "{before}" -> "{after}". Undoing the change.')
-                    await after.edit(name=before.name)
+            # the names of pooled channels are proper while the stage is handed back to the pool
+            is_name_improper = after.name not in [
+                dyn_channel.stage_name,
+                dyn_channel.text_name,
+                ChannelPool.STAGE_NAME,
+                ChannelPool.TEXT_NAME,
+            ]
+            if is_name_improper:
+                logger.warning(f'Channel name was changed: "{before}" -> "{after}". Undoing the change.')
+                await after.edit(name=before.name)
+
+        if isinstance(after, StageChannel) and before.topic != after.topic:
+            logger.info(f'[{after.guild}] Stage topic was changed: "{before.topic}" -> "{after.topic}"')
+            dyn_category.update_control_message(dyn_channel)
+
+    async def on_guild_channel_delete(self, channel):
+        """Callback function. Is called once a channel is deleted. Sets up the control or log channel again."""
+        dyn_category = self.dyn_category_from_channel(channel)
+        if dyn_category is None or not dyn_category.forget_channel(channel.id):
+            return
+        set_guild(channel.guild.id)
+        logger.warning(f"[{channel.guild}] Channel {channel} was deleted. Setting it up again.")
+        await dyn_category.log_channel
+        control_channel = await dyn_category.control_channel
+        await control_channel.control_message
 
     async def create_dyn_channel(self, user, control_channel):
         """Create new dynamic channel."""
@@ -114,11 +467,8 @@ class DynChannelBot(Client):
 
         logger.warning(f"[{control_channel.guild}] {user} purges all stages. Burn them alive!")
 
-        # delete tracked channels
-        await control_channel.dyn_category.delete_all_dyn_channels()
-
-        # delete untracked channels
-        await control_channel.dyn_category.delete_all_untracked_channels()
+        # delete tracked and untracked channels
+        await control_channel.dyn_category.purge()
 
     # async def on_message(self, message):
     #     """Callback function. Is called after the bot registers a message."""
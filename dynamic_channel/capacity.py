@@ -0,0 +1,177 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import asyncio
+import logging
+import re
+import sys
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from discord import CategoryChannel
+
+from dynamic_channel.scheduler import DELETE_CHANNEL, Priority, channel_bucket, guild_bucket
+
+logger = logging.getLogger(__name__)
+
+# discord rejects new channels beyond these limits, categories count as channels of the guild
+CATEGORY_CHANNEL_LIMIT = 50
+GUILD_CHANNEL_LIMIT = 500
+
+
+class CapacityError(RuntimeError):
+    """The guild has no room for more channels."""
+
+
+class CapacityManager:
+    """Spreads the stages of a DynCategory over its category and overflow categories.
+
+    A discord category holds at most 50 channels, i.e. about 24 stages. Once all categories are full, an overflow
+    category is created. New stages go to the category with the most room. Channels which are being created count
+    as well, the discord cache only learns about them later. Empty overflow categories are deleted by trim().
+
+    The IDs of the overflow categories are kept in the store, so only categories the bot created are ever taken over
+    and deleted, even if other categories are named alike. Without a store, they are not taken over after a restart.
+
+    Limits may be None, e.g. for benchmarks against a fake discord which does not enforce them.
+    """
+
+    def __init__(self, dyn_category, category_limit=CATEGORY_CHANNEL_LIMIT, guild_limit=GUILD_CHANNEL_LIMIT):
+        self.dyn_category = dyn_category
+        self.category_limit = category_limit
+        self.guild_limit = guild_limit
+
+        # IDs, discord.py replaces the category objects when it reconnects
+        self.overflow_category_ids: List[int] = []
+        self._pending: Dict[int, int] = {}  # number of channels being created, by category ID
+        self._overflow_lock = asyncio.Lock()
+
+    @property
+    def client(self):
+        return self.dyn_category.client
+
+    @property
+    def guild(self):
+        return self.dyn_category.guild
+
+    @property
+    def store(self):
+        return self.dyn_category.store
+
+    @property
+    def overflow_categories(self) -> List[CategoryChannel]:
+        """The overflow categories which are in the discord cache."""
+        categories = (self.guild.get_channel(i) for i in self.overflow_category_ids)
+        return [c for c in categories if c is not None]
+
+    @property
+    def categories(self) -> List[CategoryChannel]:
+        return [self.dyn_category.category] + self.overflow_categories
+
+    def overflow_name(self, number: int) -> str:
+        return f"{self.dyn_category.category_info.category_name} {number}"
+
+    def _overflow_number(self, category) -> Optional[int]:
+        match = re.fullmatch(re.escape(self.dyn_category.category_info.category_name) + r" (\d+)", category.name)
+        return int(match.group(1)) if match else None
+
+    def restore(self):
+        """Take over the overflow categories the bot created before the last shutdown."""
+        if self.store is None:
+            return
+        primary_id = self.dyn_category.category_id
+        for category_id in self.store.overflow_category_ids(primary_id):
+            if isinstance(self.guild.get_channel(category_id), CategoryChannel):
+                self._add(category_id)
+            else:
+                # deleted while the bot was offline
+                self.store.delete_overflow_category(primary_id, category_id)
+        if self.overflow_category_ids:
+            logger.info(f"[{self.guild}] Restored {len(self.overflow_category_ids)} overflow categories.")
+
+    def _add(self, category_id: int):
+        self.overflow_category_ids.append(category_id)
+        self.client.register_dyn_category(self.dyn_category, category_id)
+
+    def _remove(self, category_id: int):
+        self.overflow_category_ids.remove(category_id)
+        self.client.unregister_category(category_id)
+        if self.store is not None:
+            self.store.delete_overflow_category(self.dyn_category.category_id, category_id)
+
+    def room(self, category) -> int:
+        """Number of channels which can still be created in a category."""
+        if self.category_limit is None:
+            return self._guild_room()
+        category_load = len(category.channels) + self._pending.get(category.id, 0)
+        return max(0, min(self.category_limit - category_load, self._guild_room()))
+
+    def _guild_room(self) -> int:
+        if self.guild_limit is None:
+            return sys.maxsize
+        return self.guild_limit - len(self.guild.channels) - sum(self._pending.values())
+
+    @contextmanager
+    def pending(self, category, count: int):
+        """Count channels which are being created in a category."""
+        if not count:
+            yield
+            return
+        self._pending[category.id] = self._pending.get(category.id, 0) + count
+        try:
+            yield
+        finally:
+            self._pending[category.id] -= count
+            if not self._pending[category.id]:
+                del self._pending[category.id]
+
+    def _least_loaded(self, count: int) -> Optional[CategoryChannel]:
+        category = max(self.categories, key=self.room)
+        return category if self.room(category) >= count else None
+
+    async def allocate(self, count: int, preferred=None) -> CategoryChannel:
+        """Find a category with room for count channels, preferably the given one, or create an overflow category.
+        Count the channels as pending() before awaiting anything else. Raises CapacityError if the guild is full."""
+        if preferred is not None and self.room(preferred) >= count:
+            return preferred
+        category = self._least_loaded(count)
+        if category is not None:
+            return category
+
+        async with self._overflow_lock:
+            # another stage may have created one meanwhile
+            category = self._least_loaded(count)
+            if category is not None:
+                return category
+            if self._guild_room() < count + 1:
+                raise CapacityError(f"No room for {count} more channels in guild {self.guild}.")
+
+            numbers = {self._overflow_number(c) for c in self.overflow_categories}
+            number = next(n for n in range(2, len(numbers) + 3) if n not in numbers)
+            primary = self.dyn_category.category
+            logger.info(f"[{self.guild}] All categories are full. Creating overflow category {number}.")
+            category = await self.client.rest_scheduler.run(
+                guild_bucket(self.guild),
+                lambda: self.guild.create_category(self.overflow_name(number), overwrites=primary.overwrites),
+            )
+            self._add(category.id)
+            if self.store is not None:
+                self.store.save_overflow_category(primary, category)
+            return category
+
+    async def trim(self, priority=Priority.BULK):
+        """Delete the overflow categories without channels. Forget the ones which were deleted by someone else."""
+        for category_id in list(self.overflow_category_ids):
+            category = self.guild.get_channel(category_id)
+            if category is None:
+                self._remove(category_id)
+                continue
+            if category.channels or category_id in self._pending:
+                continue
+            logger.info(f"[{self.guild}] Deleting empty overflow category {category}.")
+            self._remove(category_id)
+            try:
+                await self.client.rest_scheduler.run(
+                    channel_bucket(category, DELETE_CHANNEL), category.delete, priority=priority
+                )
+            except Exception as e:
+                logger.error(f"[{self.guild}] Could not delete overflow category {category}: {e}")
@@ -1,13 +1,22 @@
 # SPDX-License-Identifier: GPL-3.0
 
+import asyncio
 import logging
-from typing import Generator, List
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Generator, List, Optional
 
-from discord import Guild, PermissionOverwrite, StageChannel, TextChannel
+from discord import CategoryChannel, Guild, NotFound, PermissionOverwrite, StageChannel, TextChannel
 
+from dynamic_channel.capacity import CapacityError, CapacityManager
 from dynamic_channel.control_channel import ControlChannel
-from dynamic_channel.dyn_channel import DynChannel
-# from dynamic_channel.log import LogChannel
+from dynamic_channel.dyn_channel import DynChannel, owner_name_of
+from dynamic_channel.journal import CREATE, Operation
+from dynamic_channel.locks import KeyedLock, SharedExclusiveLock
+from dynamic_channel.log import LogChannel, set_guild
+from dynamic_channel.pool import ChannelPool
+from dynamic_channel.reconcile import Plan, Reconciler
+from dynamic_channel.renderer import ControlMessageRenderer
+from dynamic_channel.scheduler import DELETE_CHANNEL, Priority, channel_bucket
 
 logger = logging.getLogger(__name__)
 
@@ -15,11 +24,31 @@ logger = logging.getLogger(__name__)
 class DynCategory:
     def __init__(self, dyn_guild, category, category_info):
         self.dyn_guild = dyn_guild
-        self.category = category
+        # discord objects go stale when discord.py reconnects, only IDs are kept
+        self.category_id = category.id
         self.category_info = category_info
 
-        # tracked DynChannels, created by bot and owned by user during runtime
-        self._tracked_dyn_channels = []
+        # tracked DynChannels, created by bot and owned by user during runtime, indexed by owner ID
+        self._tracked_dyn_channels: Dict[int, DynChannel] = {}
+        # the same DynChannels, indexed by the IDs of their stage and text channels
+        self._dyn_channels_by_channel_id: Dict[int, DynChannel] = {}
+
+        self._control_channel: Optional[ControlChannel] = None
+        self._log_channel: Optional[LogChannel] = None
+        # spreads the stages over overflow categories once the category is full
+        self.capacity = CapacityManager(
+            self, category_limit=self.client.category_channel_limit, guild_limit=self.client.guild_channel_limit
+        )
+        # hidden channels, ready to be handed out for new stages
+        self.pool = ChannelPool(self, max_size=self.client.pool_size) if self.client.pool_size else None
+        # repairs drift between the channels of the category and the tracked stages
+        self._reconciler = Reconciler(self)
+        # renders the stage list, only stages which changed are rendered again
+        self._renderer = ControlMessageRenderer(category_info.bot_control_message)
+
+        # operations of the same owner are serialized, purges exclude all other operations
+        self._owner_locks = KeyedLock()
+        self._purge_lock = SharedExclusiveLock()
 
     @property
     def client(self):
@@ -29,37 +58,73 @@ class DynCategory:
     def guild(self) -> Guild:
         return self.dyn_guild.guild
 
-    def control_message_text(self) -> str:
-        """Get the bot control message text."""
-        text = ""
-        if self._tracked_dyn_channels:
-            text += "```\n"
-            text += "Stages\n"
-            for dyn_channel in self._tracked_dyn_channels:
-                text += f" - {dyn_channel}\n"
-            text += "```\n"
-        text += self.category_info.bot_control_message
-        return text
+    @property
+    def category(self) -> Optional[CategoryChannel]:
+        return self.guild.get_channel(self.category_id)
+
+    @property
+    def store(self):
+        return self.client.store
+
+    @property
+    def expiry_scheduler(self):
+        return self.client.expiry_scheduler
+
+    @property
+    def journal(self):
+        return self.client.journal
+
+    def control_message_pages(self) -> List[str]:
+        """Get the bot control message text, split into pages which fit into a discord message each."""
+        return self._renderer.pages()
 
     @property
     async def control_channel(self) -> ControlChannel:
-        return ControlChannel(self, await self.control_text_channel, self.control_message_text)
+        if self._control_channel is None:
+            self._control_channel = ControlChannel(self, await self.control_text_channel, self.control_message_pages)
+        return self._control_channel
+
+    def forget_channel(self, channel_id: int) -> bool:
+        """Forget the control or log channel if it is the given one, e.g. because it was deleted. Returns whether it
+        was, it is set up again on the next access."""
+        if self._control_channel is not None and self._control_channel.text_channel_id == channel_id:
+            self._control_channel.forget()
+            self._control_channel = None
+            return True
+        if self._log_channel is not None and self._log_channel.text_channel_id == channel_id:
+            self._log_channel.unregister()
+            self._log_channel = None
+            return True
+        return False
+
+    def update_control_message(self, dyn_channel: Optional[DynChannel] = None):
+        """Schedule an update of the control messages, e.g. because a stage changed. A changed stage is rendered
+        again."""
+        if dyn_channel is not None and dyn_channel.owner_id in self._tracked_dyn_channels:
+            self._renderer.update(dyn_channel)
+        if self._control_channel is not None:
+            self._control_channel.update_control_message()
 
     @property
     async def control_text_channel(self) -> TextChannel:
+        if self.store is not None:
+            record = self.store.control_message(self.category_id)
+            if record is not None and self.guild.get_channel(record.channel_id) is not None:
+                return self.guild.get_channel(record.channel_id)
+
         try:
             return next(
                 c
                 for c in self.category.channels
-                if isinstance(c, TextChannel) and c.name == self.category_info.log_channel_name
+                if isinstance(c, TextChannel) and c.name == self.category_info.text_channel_name
             )
         except StopIteration as e:
             logger.warning(
-                f"[{self.category.guild}] Could not find any text channel in category '{self.category_info.category_name}' in guild {self.category.guild}. Creating..."
+                f"[{self.guild}] Could not find any text channel in category '{self.category_info.category_name}' in guild {self.guild}. Creating..."
             )
             overwrites = {
-                self.category.guild.me: PermissionOverwrite(send_messages=True),
-                self.category.guild.default_role: PermissionOverwrite(send_messages=False),
+                self.guild.me: PermissionOverwrite(send_messages=True),
+                self.guild.default_role: PermissionOverwrite(send_messages=False),
             }
             return await self.category.create_text_channel(
                 name=self.category_info.text_channel_name,
@@ -67,27 +132,33 @@ class DynCategory:
                 overwrites=overwrites,
             )
 
-    # @property
-    # async def log_channel(self) -> LogChannel:
-    #     return LogChannel(self, await self.log_text_channel)
+    @property
+    async def log_channel(self) -> Optional[LogChannel]:
+        """The channel which receives the log of the guild, if category_info.log_channel_name is set."""
+        if self._log_channel is None and self.category_info.log_channel_name:
+            self._log_channel = LogChannel(self.client, await self.log_text_channel)
+            self._log_channel.register()
+        return self._log_channel
 
     @property
     async def log_text_channel(self) -> TextChannel:
         try:
             return next(
-                c for c in self.category.channels if isinstance(c, TextChannel) and self.category_info.text_channel_name
-            )  # TODO
+                c
+                for c in self.category.channels
+                if isinstance(c, TextChannel) and c.name == self.category_info.log_channel_name
+            )
         except StopIteration as e:
             logger.warning(
-                f"[{self.category.guild}] Could not find any text channel in category '{self.category_info.category_name}' in guild {self.category.guild}. Creating..."
+                f"[{self.guild}] Could not find log channel '{self.category_info.log_channel_name}' in guild {self.guild}. Creating..."
             )
+            # the log is for admins only
             overwrites = {
-                self.category.guild.me: PermissionOverwrite(send_messages=True),
-                self.category.guild.default_role: PermissionOverwrite(send_messages=False),
+                self.guild.me: PermissionOverwrite(view_channel=True, send_messages=True),
+                self.guild.default_role: PermissionOverwrite(view_channel=False),
             }
             return await self.category.create_text_channel(
-                name=self.category_info.text_channel_name,
-                topic=self.category_info.text_channel_topic,
+                name=self.category_info.log_channel_name,
                 overwrites=overwrites,
             )
 
@@ -97,67 +168,255 @@ class DynCategory:
 
     @property
     def dyn_channels(self) -> List[DynChannel]:
-        return self._tracked_dyn_channels
+        return list(self._tracked_dyn_channels.values())
 
-    def dyn_channel_from_owner(self, owner) -> DynChannel:
-        return next(dyn_channel for dyn_channel in self._tracked_dyn_channels if dyn_channel.owner == owner)
+    def _track(self, dyn_channel: DynChannel, persist=True, active_at: Optional[float] = None):
+        self._tracked_dyn_channels[dyn_channel.owner_id] = dyn_channel
+        for channel_id in dyn_channel.channel_ids:
+            self._dyn_channels_by_channel_id[channel_id] = dyn_channel
+            self.client.event_filter.channel_ids.add(channel_id)
+        self._renderer.update(dyn_channel)
+        if persist and self.store is not None:
+            self.store.save_dyn_channel(dyn_channel)
+        dyn_channel.expires_at = dyn_channel.created_at + timedelta(minutes=self.category_info.stage_max_minutes)
+        dyn_channel.reset_occupancy(active_at)
+        self._schedule_expiry(dyn_channel)
 
-    def dyn_channel_fom_channel(self, channel) -> DynChannel:
-        if isinstance(channel, TextChannel):
-            try:
-                return next(
-                    dyn_channel for dyn_channel in self._tracked_dyn_channels if dyn_channel.text_channel == channel
-                )
-            except StopIteration:
-                return None
+    def _schedule_expiry(self, dyn_channel: DynChannel):
+        """Schedule the deletion of a stage once it is too old, or once it was empty for too long."""
+        deadline = dyn_channel.expires_at
+        idle_minutes = self.category_info.stage_idle_minutes
+        if idle_minutes and not dyn_channel.occupancy:
+            deadline = min(deadline, dyn_channel.last_active_at + timedelta(minutes=idle_minutes))
+        self.expiry_scheduler.schedule(dyn_channel, deadline)
+
+    def update_occupancy(self, channel, member, joined: bool):
+        """Count a member who joined or left a channel. Stages are reclaimed once they are empty for too long."""
+        dyn_channel = self.dyn_channel_fom_channel(channel)
+        if dyn_channel is None or channel.id != dyn_channel.stage_channel_id:
+            return
+        was_empty = not dyn_channel.occupancy
+        dyn_channel.update_occupancy(member.id, joined)
+        if was_empty != (not dyn_channel.occupancy):
+            self._schedule_expiry(dyn_channel)
+
+    def _untrack(self, dyn_channel: DynChannel):
+        self._tracked_dyn_channels.pop(dyn_channel.owner_id, None)
+        for channel_id in dyn_channel.channel_ids:
+            self._dyn_channels_by_channel_id.pop(channel_id, None)
+            self.client.event_filter.channel_ids.discard(channel_id)
+        self._renderer.remove(dyn_channel)
+        if self.store is not None:
+            self.store.delete_dyn_channel(dyn_channel.stage_channel_id)
+        self.expiry_scheduler.cancel(dyn_channel)
+
+    async def restore(self):
+        """Track the dynamic channels which were tracked before the last shutdown, as far as they still exist."""
+        self.capacity.restore()
+        if self.pool is not None:
+            self.pool.restore()
+        if self.store is None:
+            return
 
-        if isinstance(channel, StageChannel):
+        for record in self.store.pop_dyn_channels(self.category_id):
+            stage_channel = self.guild.get_channel(record.stage_channel_id)
+            text_channel = self.guild.get_channel(record.text_channel_id)
+            # the owner is not looked up, the stage only needs their ID and name
+            owner_name = record.owner_name or (owner_name_of(stage_channel.name) if stage_channel is not None else None)
+            if None in (stage_channel, text_channel, owner_name):
+                # leftovers are deleted as untracked channels on the next purge
+                logger.warning(f"[{self.guild}] Could not restore stage {record.stage_channel_id}. Forgetting it.")
+                self.store.delete_dyn_channel(record.stage_channel_id)
+                continue
+
+            dyn_channel = DynChannel(self, record.owner_id, owner_name)
+            dyn_channel.stage_channel = stage_channel
+            dyn_channel.text_channel = text_channel
+            dyn_channel.created_at = record.created_at
+            logger.info(f"[{self.guild}] Restored stage owned by {owner_name}: {stage_channel}")
+            # records from before owner names were stored are saved again, with the name. The stage may have been idle
+            # while the bot was offline, but at least since the start, also if the guild is activated later.
+            self._track(dyn_channel, persist=record.owner_name is None, active_at=self.client.started_at)
+
+    async def recover(self):
+        """Finish or roll back the channel operations which were in flight when the bot stopped. Safe to repeat."""
+        if self.journal is None:
+            return
+        for operation in self.journal.pop_unfinished(self.category_id):
+            logger.info(f"[{self.guild}] Recovering unfinished operation {operation}")
             try:
-                return next(
-                    dyn_channel for dyn_channel in self._tracked_dyn_channels if dyn_channel.stage_channel == channel
-                )
-            except StopIteration:
-                return None
+                if operation.kind == CREATE:
+                    await self._recover_creation(operation)
+                else:
+                    await self._recover_deletion(operation)
+            except Exception:
+                # the journal entry stays, the next startup tries again
+                logger.exception(f"[{self.guild}] Could not recover operation {operation}")
+                continue
+            await self.journal.done(operation)
+
+    def _is_pooled(self, channel) -> bool:
+        return self.pool is not None and channel.name in (ChannelPool.STAGE_NAME, ChannelPool.TEXT_NAME)
+
+    async def _recover_creation(self, operation: Operation):
+        """Track the stage if both channels were created, otherwise delete what was created."""
+        channels = [self.guild.get_channel(i) for i in operation.channel_ids]
+        channels = [c for c in channels if c is not None]
+        if len(operation.channel_ids) < 2:
+            # channels whose creation was not journaled anymore
+            channels += [
+                c
+                for category in self.capacity.categories
+                for c in category.channels
+                if c.name in operation.names and c.id not in operation.channel_ids
+            ]
+        # tracked channels are fine, pooled ones went back into the pool
+        channels = [c for c in channels if self.dyn_channel_fom_channel(c) is None and not self._is_pooled(c)]
+        if not channels:
+            return
+
+        stage_channels = [c for c in channels if isinstance(c, StageChannel)]
+        text_channels = [c for c in channels if isinstance(c, TextChannel)]
+        if len(stage_channels) == len(text_channels) == 1 and len(channels) == 2:
+            # the channels are named after the owner, who is not looked up
+            owner_name = owner_name_of(stage_channels[0].name)
+            if owner_name is not None and operation.owner_id not in self._tracked_dyn_channels:
+                dyn_channel = DynChannel(self, operation.owner_id, owner_name)
+                dyn_channel.stage_channel, dyn_channel.text_channel = stage_channels[0], text_channels[0]
+                dyn_channel.created_at = stage_channels[0].created_at.replace(tzinfo=timezone.utc)
+                logger.info(f"[{self.guild}] Completing creation of stage {dyn_channel}")
+                self._track(dyn_channel)
+                return
+
+        logger.info(f"[{self.guild}] Rolling back creation of {len(channels)} channels.")
+        await self._delete_channels(channels)
+
+    async def _recover_deletion(self, operation: Operation):
+        """Delete the channels which are left."""
+        channels = []
+        for channel_id in operation.channel_ids:
+            dyn_channel = self._dyn_channels_by_channel_id.get(channel_id)
+            if dyn_channel is not None:
+                self._untrack(dyn_channel)
+            channel = self.guild.get_channel(channel_id)
+            if channel is not None and not self._is_pooled(channel):
+                channels.append(channel)
+        if channels:
+            logger.info(f"[{self.guild}] Completing deletion of {len(channels)} channels.")
+            await self._delete_channels(channels)
+
+    async def _delete_channels(self, channels):
+        results = await self.client.rest_scheduler.gather(
+            *((channel_bucket(c, DELETE_CHANNEL), c.delete) for c in channels), priority=Priority.BULK
+        )
+        errors = [r for r in results if isinstance(r, Exception) and not isinstance(r, NotFound)]
+        if errors:
+            raise errors[0]
+
+    def dyn_channel_from_owner(self, owner) -> Optional[DynChannel]:
+        return self._tracked_dyn_channels.get(owner.id)
+
+    def dyn_channel_fom_channel(self, channel) -> Optional[DynChannel]:
+        return self._dyn_channels_by_channel_id.get(channel.id)
 
     async def create_dyn_channel(self, owner):
         """Create a new stage if user does not already own one."""
-        try:
-            # Getting the dyn_channel will raise a StopIteration if owner does not own DynChannel
+        async with self._purge_lock.shared(), self._owner_locks(owner.id):
             dyn_channel = self.dyn_channel_from_owner(owner=owner)
+            if dyn_channel is not None:
+                logger.warning(
+                    f"[{self.guild}] Refusing to create new stage. User {owner} already owns a dyn_channel: {dyn_channel}"
+                )
+                return
 
-            logger.warning(
-                f"[{self.guild}] Refusing to create new stage. User {owner} already owns a dyn_channel: {dyn_channel}"
-            )
-            return
-        except StopIteration:
-            pass
-
-        dyn_channel = DynChannel(self, owner)
-        await dyn_channel.create()
-        self._tracked_dyn_channels.append(dyn_channel)
+            dyn_channel = DynChannel(self, owner.id, owner.display_name)
+            try:
+                await dyn_channel.create()
+            except CapacityError as e:
+                logger.warning(f"[{self.guild}] Refusing to create new stage for {owner}: {e}")
+                return
+            self._track(dyn_channel)
 
     async def delete_dyn_channel(self, owner):
         """Delete the stage owned by a given owner."""
-        try:
-            # Getting the dyn_channel will raise a StopIteration if owner does not own DynChannel
+        async with self._purge_lock.shared(), self._owner_locks(owner.id):
             dyn_channel = self.dyn_channel_from_owner(owner=owner)
-            await dyn_channel.destroy()
-            self._tracked_dyn_channels.remove(dyn_channel)
+            if dyn_channel is None:
+                logger.warning(f"[{self.guild}] User {owner} does not owns a dyn_channel. Refusing to delete.")
+                return
+
+            try:
+                await dyn_channel.destroy()
+                self._untrack(dyn_channel)
+            except RuntimeError:
+                logger.warning(
+                    f"[{self.guild}] User {owner} wants to delete their dyn_channel but it is not empty. Refusing."
+                )
+
+    async def expire_dyn_channels(self, dyn_channels: List[DynChannel]):
+        """Delete stages which are past their deadline or idle for too long. Stages with members in them get some more
+        time."""
+        set_guild(self.guild.id)
+
+        async def expire(dyn_channel):
+            async with self._owner_locks(dyn_channel.owner_id):
+                if self._tracked_dyn_channels.get(dyn_channel.owner_id) is not dyn_channel:
+                    return  # deleted in the meantime
+                now = datetime.now(timezone.utc)
+                if dyn_channel.occupancy:
+                    extension = timedelta(minutes=self.category_info.stage_extend_minutes)
+                    logger.info(f"[{self.guild}] Stage {dyn_channel} is old but not empty. Extending by {extension}.")
+                    dyn_channel.expires_at = now + extension
+                    self._schedule_expiry(dyn_channel)
+                    return
+                if dyn_channel.expires_at > now + timedelta(seconds=self.expiry_scheduler.batch_window):
+                    logger.info(f"[{self.guild}] Deleting idle stage {dyn_channel}")
+                else:
+                    logger.info(f"[{self.guild}] Deleting old stage {dyn_channel}")
+                await dyn_channel.destroy(force=True, priority=Priority.BULK)
+                self._untrack(dyn_channel)
+
+        async with self._purge_lock.shared():
+            results = await asyncio.gather(*(expire(d) for d in dyn_channels), return_exceptions=True)
+        for dyn_channel, result in zip(dyn_channels, results):
+            if isinstance(result, Exception):
+                logger.error(f"[{self.guild}] Could not delete old stage {dyn_channel}: {result}")
+        self.update_control_message()
+
+    async def purge(self):
+        """Delete all dynamic channels, including the untracked ones. No stages are created or deleted meanwhile."""
+        async with self._purge_lock.exclusive():
+            await self.delete_all_dyn_channels()
+            if self.pool is not None:
+                self.pool.clear()
+            plan = await self._reconciler.plan(purge=True)
+            await self._reconciler.execute(plan)
+            await self.capacity.trim()
 
-        except StopIteration:
-            logger.warning(f"[{self.guild}] User {owner} does not owns a dyn_channel. Refusing to delete.")
-        except RuntimeError:
-            logger.warning(f"[{self.guild}] User {owner} wants to delete their dyn_channel but it is not empty. Refusing.")
+    async def reconcile(self, dry_run=False) -> Plan:
+        """Adopt untracked stages, forget deleted ones, undo renames and delete stray channels. No stages are created
+        or deleted meanwhile. With dry_run, the plan is only logged."""
+        set_guild(self.guild.id)
+        async with self._purge_lock.exclusive():
+            plan = await self._reconciler.plan()
+            if plan:
+                logger.info(f"[{self.guild}] Reconciliation{' (dry run)' if dry_run else ''}: {plan.summary()}")
+                for step in plan:
+                    logger.debug(f"[{self.guild}] Reconciliation step: {step}")
+                if not dry_run:
+                    await self._reconciler.execute(plan)
+            if not dry_run:
+                await self.capacity.trim()
+        return plan
 
     async def delete_all_dyn_channels(self):
-        for dyn_channel in self._tracked_dyn_channels:
-            await dyn_channel.destroy(force=True)
-        self._tracked_dyn_channels = []
-
-    async def delete_all_untracked_channels(self):
-        tracked_channels = [c for d in self.dyn_channels for c in d.channels] + [
-            (await self.control_channel).text_channel
-        ]
-        for channel in self.category.channels:
-            if channel not in tracked_channels:
-                await channel.delete()
+        dyn_channels = self.dyn_channels
+        results = await asyncio.gather(
+            *(dyn_channel.destroy(force=True, priority=Priority.BULK, recycle=False) for dyn_channel in dyn_channels),
+            return_exceptions=True,
+        )
+        for dyn_channel, result in zip(dyn_channels, results):
+            if isinstance(result, Exception):
+                logger.error(f"[{self.guild}] Could not delete {dyn_channel}: {result}")
+            else:
+                self._untrack(dyn_channel)
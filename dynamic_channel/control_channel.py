@@ -1,53 +1,80 @@
 # SPDX-License-Identifier: GPL-3.0
 import asyncio
 import logging
+import time
+from datetime import timedelta
+from typing import List
 
-from dynamic_channel.message import ReactMessage, react_to
+from discord import HTTPException, Object
+from discord.utils import DISCORD_EPOCH
+
+from dynamic_channel.message import ReactMessage, TextMessage, react_to
+from dynamic_channel.scheduler import BULK_DELETE_MESSAGES, DELETE_MESSAGE, Priority, channel_bucket
 
 logger = logging.getLogger(__name__)
 
+# discord only bulk deletes messages younger than 14 days, keep some margin
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(hours=1)
+
 
 class ControlMessage(ReactMessage):
     def __init__(
         self, control_channel, get_text_cb
     ):  # TODO shouldn't this class (and its parent) work with a text model (here get_text() callback)?
-        super().__init__(control_channel.client, get_text_cb)
+        super().__init__(
+            control_channel.client,
+            get_text_cb,
+            edit_interval=control_channel.dyn_category.category_info.control_message_edit_interval,
+            view=control_channel.client.control_view,
+        )
         self.control_channel = control_channel
 
     @property
     def client(self):
         return self.control_channel.client
 
-    @react_to("🆕", remove=True)
-    async def create_dyn_channel(self, _reaction, user):
-        await self.client.create_dyn_channel(user=user, control_channel=self.control_channel)
-        await self.update_text()
+    # the actions return an answer, which is shown to users of the buttons
 
-    @react_to("❌", remove=True)
-    async def delete_stage(self, _reaction, user):
+    @react_to("🆕", remove=True, label="Create stage")
+    async def create_dyn_channel(self, _emoji, user):
+        await self.client.create_dyn_channel(user=user, control_channel=self.control_channel)
+        self.control_channel.update_control_message()
+        dyn_channel = self.control_channel.dyn_category.dyn_channel_from_owner(user)
+        if dyn_channel is None or dyn_channel.stage_channel_id is None:
+            return "Your stage could not be created."
+        return f"Your stage: <#{dyn_channel.stage_channel_id}>"
+
+    @react_to("❌", remove=True, label="Delete stage")
+    async def delete_stage(self, _emoji, user):
         await self.client.delete_dyn_channel(user=user, control_channel=self.control_channel)
-        await asyncio.sleep(0.1)
-        await self.update_text()
+        self.control_channel.update_control_message()
+        if self.control_channel.dyn_category.dyn_channel_from_owner(user) is not None:
+            return "Your stage was not deleted, there are still members in it."
+        return "You have no stage (anymore)."
 
     # @react_to("🗑️️️", remove=True)
-    @react_to("🔥", remove=True)
-    async def delete_all_stages(self, _reaction, user):
+    @react_to("🔥", remove=True, label="Delete all stages")
+    async def delete_all_stages(self, _emoji, user):
         await self.client.delete_all_channels(user=user, control_channel=self.control_channel)
-        await asyncio.sleep(0.1)
-        await self.update_text()
+        self.control_channel.update_control_message()
+        if not user.guild_permissions.manage_channels:
+            return "Deleting all stages needs the manage channels permission."
+        return "All stages were deleted."
 
     # @react_to("🔄", remove=True)
-    # async def reload(self, reaction, user):
-    #     await self.update_text()
+    # async def reload(self, emoji, user):
+    #     self.update_text()
 
 
 class ControlChannel:
-    def __init__(self, dyn_category, text_channel, get_text_cb):
-        """If control_message is None, the control channel will be reset (i.e. posting the control message)."""
+    def __init__(self, dyn_category, text_channel, get_pages_cb):
+        """The first page is shown in the control message, the other pages in messages below it."""
         self.dyn_category = dyn_category
-        self.text_channel = text_channel
-        self._get_text_cb = get_text_cb
+        self.text_channel_id = text_channel.id
+        self._get_pages_cb = get_pages_cb
         self._control_message = None
+        self._page_messages: List[TextMessage] = []  # messages for the second page onwards
+        self._sync_task = None
 
     @property
     def client(self):  # TODO align these, i.e. dyn_ naming convention
@@ -57,22 +84,145 @@ class ControlChannel:
     def guild(self):
         return self.dyn_category.guild
 
+    @property
+    def text_channel(self):
+        return self.guild.get_channel(self.text_channel_id)
+
+    @property
+    def edit_interval(self):
+        return self.dyn_category.category_info.control_message_edit_interval
+
+    def _page_text(self, index):
+        pages = self._get_pages_cb()
+        return pages[index] if index < len(pages) else None
+
     @property
     async def control_message(self):
         if self._control_message is not None:
             return self._control_message
 
-        # delete all prior messages in the same text channel (except the last one if it is by the bot)
-        async for message in self.text_channel.history().filter(lambda msg: msg.author == self.client.user):
-            logger.info(f"[{self.text_channel.guild}] Deleting prior bot control message: {message}")
-            await message.delete()
+        store = self.dyn_category.store
+        record = store.control_message(self.dyn_category.category_id) if store is not None else None
+        if record is not None and record.channel_id == self.text_channel_id:
+            # adopt the control message from before the last shutdown, if it still exists
+            try:
+                message = await self.text_channel.fetch_message(record.message_id)
+            except HTTPException:
+                logger.warning(f"[{self.guild}] Could not fetch prior bot control message. Reposting.")
+            else:
+                control_message = ControlMessage(control_channel=self, get_text_cb=lambda: self._page_text(0))
+                await control_message.adopt(message)
+                self._control_message = control_message
+                await self._adopt_page_messages()
+                self.update_control_message()
+                return self._control_message
 
         # post new bot control message
-        text = self._get_text_cb()
-        logger.info(
-            f"[{self.text_channel.guild}] Posting new bot control message in channel {self.text_channel}: {text}"
-        )
-
-        self._control_message = ControlMessage(control_channel=self, get_text_cb=self._get_text_cb)
-        loop = asyncio.get_event_loop()
-        loop.create_task(self._control_message.send_and_wait(self.text_channel))
+        text = self._page_text(0)
+        logger.info(f"[{self.guild}] Posting new bot control message in channel {self.text_channel}: {text}")
+
+        control_message = ControlMessage(control_channel=self, get_text_cb=lambda: self._page_text(0))
+        await control_message.send(self.text_channel)
+        if store is not None:
+            store.save_control_message(self.dyn_category.category, control_message.message)
+        self._control_message = control_message
+
+        # delete prior control messages in the background, the new one is usable already
+        # if we know the last control message, older ones were cleaned up already. Its ID says nothing about the
+        # messages of another channel, e.g. if the control channel was recreated.
+        after = Object(record.message_id) if record is not None and record.channel_id == self.text_channel_id else None
+        asyncio.get_event_loop().create_task(self._delete_prior_messages(before=control_message.message, after=after))
+        self.update_control_message()
+        return self._control_message
+
+    def forget(self):
+        """Forget the control and page messages, e.g. because they were deleted together with the channel."""
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+        for message in [self._control_message] + self._page_messages:
+            if message is not None:
+                message.forget()
+        self._control_message = None
+        self._page_messages = []
+
+    def _new_page_message(self, index) -> TextMessage:
+        return TextMessage(self.client, lambda: self._page_text(index), edit_interval=self.edit_interval)
+
+    async def _adopt_page_messages(self):
+        """Take over the page messages below the adopted control message."""
+        try:
+            async for message in self.text_channel.history(limit=None, after=self._control_message.message):
+                if message.author == self.client.user:
+                    page_message = self._new_page_message(len(self._page_messages) + 1)
+                    await page_message.adopt(message)
+                    self._page_messages.append(page_message)
+        except HTTPException:
+            logger.exception(f"[{self.guild}] Could not adopt prior page messages in {self.text_channel}.")
+
+    async def _sync_page_messages(self):
+        """Post or delete page messages until there is one per page."""
+        synced = False
+        try:
+            while not synced:
+                page_count = len(self._get_pages_cb())
+                if len(self._page_messages) + 1 < page_count:
+                    page_message = self._new_page_message(len(self._page_messages) + 1)
+                    await page_message.send(self.text_channel)
+                    self._page_messages.append(page_message)
+                elif len(self._page_messages) + 1 > page_count:
+                    await self._page_messages.pop().delete()
+                else:
+                    synced = True
+        except HTTPException:
+            logger.exception(f"[{self.guild}] Could not post or delete page messages in {self.text_channel}.")
+        finally:
+            self._sync_task = None
+        if synced:
+            # pages may have changed while we were posting
+            self.update_control_message()
+
+    async def _delete_prior_messages(self, before, after=None, trickle_interval=1.0):
+        """Delete the bot's messages between after and before.
+
+        Messages younger than 14 days are bulk deleted. Older ones have to be deleted one by one, this is done slowly
+        and with low priority.
+        """
+        guild = self.guild
+        # snowflake IDs start with a millisecond timestamp
+        min_bulk_id = int((time.time() - BULK_DELETE_MAX_AGE.total_seconds()) * 1000 - DISCORD_EPOCH) << 22
+        recent, old = [], []
+        try:
+            # the history is bounded by the last known control message, otherwise look at the last 100 messages
+            async for message in self.text_channel.history(limit=None if after else 100, before=before, after=after):
+                if message.author == self.client.user:
+                    (recent if message.id > min_bulk_id else old).append(message)
+
+            logger.info(f"[{guild}] Deleting {len(recent) + len(old)} prior bot messages in {self.text_channel}.")
+            delete_bucket = channel_bucket(self.text_channel, DELETE_MESSAGE)
+            bulk_delete_bucket = channel_bucket(self.text_channel, BULK_DELETE_MESSAGES)
+            for i in range(0, len(recent), 100):
+                chunk = recent[i : i + 100]
+                if len(chunk) == 1:
+                    await self.client.rest_scheduler.run(delete_bucket, chunk[0].delete, priority=Priority.BULK)
+                else:
+                    await self.client.rest_scheduler.run(
+                        bulk_delete_bucket, lambda: self.text_channel.delete_messages(chunk), priority=Priority.BULK
+                    )
+
+            for message in old:
+                await self.client.rest_scheduler.run(delete_bucket, message.delete, priority=Priority.BULK)
+                await asyncio.sleep(trickle_interval)
+        except HTTPException:
+            logger.exception(f"[{guild}] Could not delete prior bot messages in {self.text_channel}.")
+
+    def update_control_message(self):
+        """Schedule an update of the control message and page messages whose text changed, if it was posted already."""
+        if self._control_message is None:
+            return
+
+        pages = self._get_pages_cb()
+        for message, text in zip([self._control_message] + self._page_messages, pages):
+            if text != message.sent_text:
+                message.update_text()
+        if len(self._page_messages) + 1 != len(pages) and self._sync_task is None:
+            self._sync_task = asyncio.get_event_loop().create_task(self._sync_page_messages())
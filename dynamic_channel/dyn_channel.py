@@ -1,26 +1,89 @@
 # SPDX-License-Identifier: GPL-3.0
 
+import asyncio
 import logging
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Set, Tuple
 
+import aiohttp
 from discord import (
     CategoryChannel,
+    DiscordServerError,
     Guild,
     Member,
+    Object,
     PermissionOverwrite,
     StageChannel,
     TextChannel,
 )
 
+from dynamic_channel import metrics
+from dynamic_channel.journal import CREATE, DELETE
+from dynamic_channel.scheduler import DELETE_CHANNEL, EDIT_CHANNEL, Priority, channel_bucket, guild_bucket
+
 logger = logging.getLogger(__name__)
 
+# channel creations which fail without an answer from discord are tried this often, with exponential backoff
+CREATE_ATTEMPTS = 3
+CREATE_RETRY_DELAY = 1.0
+
+# the channels of a stage are named after its owner
+STAGE_SUFFIX = "'s stage"
+TEXT_SUFFIX = "'s text"
+
+
+def _timestamp(value: Optional[datetime]) -> Optional[float]:
+    return value.timestamp() if value is not None else None
+
+
+def _datetime(timestamp: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(timestamp, timezone.utc) if timestamp is not None else None
+
+
+def owner_name_of(channel_name: str) -> Optional[str]:
+    """The name of the owner a stage or text channel is named after, if it is named like one."""
+    for suffix in (STAGE_SUFFIX, TEXT_SUFFIX):
+        if channel_name.endswith(suffix) and len(channel_name) > len(suffix):
+            return channel_name[: -len(suffix)]
+    return None
+
 
 class DynChannel:
-    def __init__(self, dyn_category, owner):
+    """A stage and its text channel, owned by a member.
+
+    Only IDs and timestamps are kept, so a tracked stage takes a small, fixed amount of memory and never holds on to
+    outdated discord objects. The owner and the channels are looked up in the discord cache when they are needed.
+    """
+
+    __slots__ = (
+        "dyn_category",
+        "owner_id",
+        "owner_name",
+        "stage_channel_id",
+        "text_channel_id",
+        "_created_at",
+        "_expires_at",
+        "_last_active_at",
+        "occupant_ids",
+    )
+
+    def __init__(self, dyn_category, owner_id: int, owner_name: str):
         self.dyn_category = dyn_category
-        self.owner: Member = owner
+        self.owner_id = owner_id
+        # the channels are named after the owner, even if they are not cached anymore
+        self.owner_name = owner_name
+
+        self.stage_channel_id: Optional[int] = None
+        self.text_channel_id: Optional[int] = None
+        self._created_at: Optional[float] = None
+        # the stage expires at this time, unless there are members in it
+        self._expires_at: Optional[float] = None
+        # last time a member joined or left the stage
+        self._last_active_at: Optional[float] = None
 
-        self.text_channel: TextChannel = None
-        self.stage_channel: StageChannel = None
+        # IDs of the members in the stage, kept up to date from voice state updates. None while the stage is empty.
+        self.occupant_ids: Optional[Set[int]] = None
 
     @property
     def client(self):
@@ -30,53 +93,262 @@ class DynChannel:
     def guild(self) -> Guild:
         return self.dyn_category.guild
 
+    @property
+    def rest_scheduler(self):
+        return self.client.rest_scheduler
+
     @property
     def category(self) -> CategoryChannel:
+        """The category of the DynCategory. The channels may be in one of its overflow categories."""
         return self.dyn_category.category
 
+    @property
+    def category_id(self) -> int:
+        return self.dyn_category.category_id
+
+    @property
+    def owner(self) -> Optional[Member]:
+        """The owner, if they are cached."""
+        return self.guild.get_member(self.owner_id)
+
+    @property
+    def stage_channel(self) -> Optional[StageChannel]:
+        return self.guild.get_channel(self.stage_channel_id) if self.stage_channel_id is not None else None
+
+    @stage_channel.setter
+    def stage_channel(self, channel: Optional[StageChannel]):
+        self.stage_channel_id = channel.id if channel is not None else None
+
+    @property
+    def text_channel(self) -> Optional[TextChannel]:
+        return self.guild.get_channel(self.text_channel_id) if self.text_channel_id is not None else None
+
+    @text_channel.setter
+    def text_channel(self, channel: Optional[TextChannel]):
+        self.text_channel_id = channel.id if channel is not None else None
+
+    @property
+    def created_at(self) -> Optional[datetime]:
+        return _datetime(self._created_at)
+
+    @created_at.setter
+    def created_at(self, value: Optional[datetime]):
+        self._created_at = _timestamp(value)
+
+    @property
+    def expires_at(self) -> Optional[datetime]:
+        return _datetime(self._expires_at)
+
+    @expires_at.setter
+    def expires_at(self, value: Optional[datetime]):
+        self._expires_at = _timestamp(value)
+
+    @property
+    def last_active_at(self) -> Optional[datetime]:
+        return _datetime(self._last_active_at)
+
     @property
     def stage_name(self):
-        return f"{self.owner.display_name}'s stage"
+        return f"{self.owner_name}{STAGE_SUFFIX}"
 
     @property
     def text_name(self):
-        return f"{self.owner.display_name}'s text"
+        return f"{self.owner_name}{TEXT_SUFFIX}"
+
+    @property
+    def channel_ids(self) -> Tuple[Optional[int], Optional[int]]:
+        return self.stage_channel_id, self.text_channel_id
 
     @property
-    def channels(self):
-        return [self.stage_channel, self.text_channel]
+    def channels(self) -> List:
+        """The stage and text channel, as far as they are cached. Deleted channels are missing."""
+        return [c for c in (self.stage_channel, self.text_channel) if c is not None]
+
+    @property
+    def occupancy(self) -> int:
+        """Number of members in the stage."""
+        return len(self.occupant_ids) if self.occupant_ids else 0
+
+    def reset_occupancy(self, active_at: Optional[float] = None):
+        """Take the members from the discord cache, e.g. when the stage starts being tracked. The stage counts as
+        active at the given POSIX time, by default now."""
+        stage_channel = self.stage_channel
+        members = stage_channel.members if stage_channel is not None else []
+        self.occupant_ids = {m.id for m in members} or None
+        self._last_active_at = active_at if active_at is not None else time.time()
+
+    def update_occupancy(self, member_id: int, joined: bool):
+        if joined:
+            if self.occupant_ids is None:
+                self.occupant_ids = set()
+            self.occupant_ids.add(member_id)
+        elif self.occupant_ids is not None:
+            self.occupant_ids.discard(member_id)
+            if not self.occupant_ids:
+                self.occupant_ids = None
+        self._last_active_at = time.time()
 
     async def create(self):
-        logger.info(f"[{self.guild}] Creating new stage for user {self.owner}.")
+        started_at = time.perf_counter() if metrics.enabled else None
+        # hot paths like this one format their log records lazily
+        logger.info("[%s] Creating new stage for user %s.", self.guild, self.owner_name)
+        # the owner may not be cached, e.g. in the lean profile
+        owner = self.owner or Object(id=self.owner_id)
         overwrites = {
-            self.owner: PermissionOverwrite(
+            owner: PermissionOverwrite(
                 request_to_speak=True,
                 manage_channels=True,
                 move_members=True,
                 mute_members=True,
             ),
         }
-        self.stage_channel = await self.guild.create_stage_channel(
-            name=self.stage_name, category=self.category, overwrites=overwrites
-        )
-        self.text_channel = await self.guild.create_text_channel(name=self.text_name, category=self.category)
+        pool = self.dyn_category.pool
+        stage_channel, text_channel = pool.take() if pool is not None else (None, None)
+        # channels which are not taken from the pool go next to the pooled one, if there is room
+        capacity = self.dyn_category.capacity
+        missing = [stage_channel, text_channel].count(None)
+        pooled = stage_channel or text_channel
+        try:
+            category = await capacity.allocate(missing, preferred=pooled.category if pooled is not None else None)
+        except Exception:
+            if pool is not None:
+                pool.restock(stage_channel, text_channel)
+            raise
 
-    async def destroy(self, force=False):  # TODO and nobody in present in stage
-        """Delete text and stage."""
-        if self.stage_channel.members and not force:
-            logger.warning(
-                f"[{self.guild}] Refusing to delete channel {self.stage_channel.name} because there are members in it: {self.stage_channel.members}"
+        # the room is counted right away, concurrent creates must not see it as free while the journal is written
+        with capacity.pending(category, missing):
+            journal = self.client.journal
+            operation = None
+            if journal is not None:
+                try:
+                    operation = await journal.begin(
+                        CREATE,
+                        self,
+                        names=[self.stage_name, self.text_name],
+                        channel_ids=[c.id for c in (stage_channel, text_channel) if c is not None],
+                    )
+                except Exception:
+                    if pool is not None:
+                        pool.restock(stage_channel, text_channel)
+                    raise
+
+            self.created_at = datetime.now(timezone.utc)
+            results = await asyncio.gather(
+                self._claim_or_create(
+                    stage_channel,
+                    lambda: self.guild.create_stage_channel(
+                        name=self.stage_name, category=category, overwrites=overwrites
+                    ),
+                    category,
+                    operation,
+                    name=self.stage_name,
+                    overwrites=overwrites,
+                ),
+                self._claim_or_create(
+                    text_channel,
+                    lambda: self.guild.create_text_channel(name=self.text_name, category=category),
+                    category,
+                    operation,
+                    name=self.text_name,
+                    sync_permissions=True,
+                ),
+                return_exceptions=True,
             )
-            raise RuntimeError(f"Refusing to delete channel {self.stage_channel.name} because it is not empty.")
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            # do not leave half a stage behind
+            await self._roll_back([r for r in results if not isinstance(r, Exception)], operation)
+            raise errors[0]
+        self.stage_channel, self.text_channel = results
+        if operation is not None:
+            await journal.done(operation)
+        if started_at is not None:
+            metrics.CHANNEL_OPERATION_SECONDS.observe(time.perf_counter() - started_at, "create")
+
+    async def _claim_or_create(self, channel, create, category, operation=None, **fields):
+        """Set up a channel from the pool with the given fields, or create a new one if there is none."""
+        if channel is not None:
+            await self.rest_scheduler.run(channel_bucket(channel, EDIT_CHANNEL), lambda: channel.edit(**fields))
+            return channel
+
+        for attempt in range(CREATE_ATTEMPTS):
+            try:
+                channel = await self.rest_scheduler.run(guild_bucket(self.guild), create)
+                break
+            except (DiscordServerError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt + 1 == CREATE_ATTEMPTS:
+                    raise
+                logger.warning("[%s] Could not create channel %s, retrying: %s", self.guild, fields["name"], e)
+                await asyncio.sleep(CREATE_RETRY_DELAY * 2**attempt)
+                # discord may have created the channel anyway, do not create it twice
+                channel = self._find_untracked(category, fields["name"])
+                if channel is not None:
+                    break
+        if operation is not None:
+            await self.client.journal.add_channel(operation, channel.id)
+        return channel
 
-        logger.info(f"[{self.guild}] Deleting text channel owned by {self.owner}: {self.text_channel}")
-        await self.text_channel.delete()
+    def _find_untracked(self, category, name):
+        for channel in category.channels:
+            if channel.name == name and self.dyn_category.dyn_channel_fom_channel(channel) is None:
+                return channel
+        return None
 
-        logger.info(f"[{self.guild}] Deleting stage channel owned by {self.owner}: {self.stage_channel}")
-        await self.stage_channel.delete()
+    async def _roll_back(self, channels, operation=None):
+        """Delete the channels of a failed creation."""
+        logger.warning("[%s] Could not create stage for user %s. Rolling back.", self.guild, self.owner_name)
+        results = await self.rest_scheduler.gather(*((channel_bucket(c, DELETE_CHANNEL), c.delete) for c in channels))
+        if any(isinstance(r, Exception) for r in results):
+            # the journal entry stays, the next startup tries again
+            logger.error("[%s] Could not roll back creation of stage for user %s.", self.guild, self.owner_name)
+        elif operation is not None:
+            await self.client.journal.done(operation)
+
+    async def destroy(self, force=False, priority=Priority.INTERACTIVE, recycle=True):
+        """Delete text and stage. If the category has a channel pool and recycle is set, they go back to the pool.
+        Raises RuntimeError if there are members in the stage, unless force is set."""
+        if self.occupancy and not force:
+            logger.warning(
+                "[%s] Refusing to delete channel %s because there are %d members in it.",
+                self.guild,
+                self.stage_name,
+                self.occupancy,
+            )
+            raise RuntimeError(f"Refusing to delete channel {self.stage_name} because it is not empty.")
+
+        started_at = time.perf_counter() if metrics.enabled else None
+        stage_channel, text_channel = self.stage_channel, self.text_channel
+        logger.info(
+            "[%s] Deleting text and stage channel owned by %s: %s, %s",
+            self.guild,
+            self.owner_name,
+            text_channel,
+            stage_channel,
+        )
+        journal = self.client.journal
+        operation = None
+        if journal is not None:
+            # if this fails halfway, the next startup finishes it
+            operation = await journal.begin(DELETE, self, channel_ids=self.channel_ids)
+        pool = self.dyn_category.pool
+        if pool is not None and recycle and stage_channel is not None and text_channel is not None:
+            await pool.release(stage_channel, text_channel, priority=priority)
+        else:
+            # channels which were deleted by someone else are not cached anymore
+            await asyncio.gather(
+                *(
+                    self.rest_scheduler.run(channel_bucket(c, DELETE_CHANNEL), c.delete, priority=priority)
+                    for c in self.channels
+                )
+            )
+        if operation is not None:
+            await journal.done(operation)
+        if started_at is not None:
+            metrics.CHANNEL_OPERATION_SECONDS.observe(time.perf_counter() - started_at, "destroy")
 
     def __str__(self):
         string = f"{self.stage_name}"
-        if self.stage_channel.topic:
-            string += f': "{self.stage_channel.topic}"'
+        stage_channel = self.stage_channel
+        if stage_channel is not None and stage_channel.topic:
+            string += f': "{stage_channel.topic}"'
         return string
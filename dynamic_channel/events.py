@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import logging
+from collections import Counter
+from typing import Set
+
+from dynamic_channel import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class EventFilter:
+    """Drops gateway events which do not concern the bot, before discord.py schedules a task for them.
+
+    Whether an event is relevant is decided by set lookups of the IDs of managed categories, channels and messages,
+    without touching any other object. Events without a rule are always passed on.
+    """
+
+    def __init__(self):
+        self.category_ids: Set[int] = set()  # categories with stages
+        self.channel_ids: Set[int] = set()  # stage and text channels of tracked stages
+        self.message_ids: Set[int] = set()  # messages which react to reactions
+        self.counts = Counter()  # by (event, "handled" or "filtered")
+
+        self._rules = {
+            "guild_channel_update": self._is_channel_update_relevant,
+            "guild_channel_delete": self._is_channel_delete_relevant,
+            "raw_reaction_add": self._is_reaction_relevant,
+            "voice_state_update": self._is_voice_state_update_relevant,
+        }
+
+    def _is_channel_update_relevant(self, before, after) -> bool:
+        return before.category_id in self.category_ids or after.category_id in self.category_ids
+
+    def _is_channel_delete_relevant(self, channel) -> bool:
+        return channel.category_id in self.category_ids
+
+    def _is_reaction_relevant(self, payload) -> bool:
+        return payload.message_id in self.message_ids
+
+    def _is_voice_state_update_relevant(self, _member, before, after) -> bool:
+        return (before.channel is not None and before.channel.id in self.channel_ids) or (
+            after.channel is not None and after.channel.id in self.channel_ids
+        )
+
+    def accepts(self, event: str, *args) -> bool:
+        rule = self._rules.get(event)
+        if rule is None:
+            return True
+        result = "handled" if rule(*args) else "filtered"
+        self.counts[event, result] += 1
+        metrics.EVENTS.inc(event, result)
+        return result == "handled"
+
+    def summary(self) -> str:
+        return ", ".join(
+            f"{event} {self.counts[event, 'handled']}/{self.counts[event, 'filtered']}" for event in self._rules
+        )
@@ -0,0 +1,88 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """Expires dynamic channels once their deadline has passed.
+
+    Deadlines are kept in a heap. The scheduler sleeps until the earliest deadline is due, so it costs nothing while
+    no stage is about to expire. Stages which are due within batch_window seconds of each other are expired together,
+    one batch per category.
+    """
+
+    def __init__(self, batch_window: float = 5.0):
+        self.batch_window = batch_window
+
+        self._heap: List = []  # (deadline, counter, dyn_channel), may contain outdated entries
+        self._deadlines: Dict = {}  # current deadline (timestamp) by dyn_channel
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def deadline(self, dyn_channel) -> Optional[float]:
+        return self._deadlines.get(dyn_channel)
+
+    def schedule(self, dyn_channel, deadline: datetime):
+        """Set or move the deadline of a dynamic channel."""
+        timestamp = deadline.timestamp()
+        self._deadlines[dyn_channel] = timestamp
+        entry = (timestamp, next(self._counter), dyn_channel)
+        heapq.heappush(self._heap, entry)
+        if self._wakeup is not None and self._heap[0] is entry:
+            # the new deadline is the earliest one, sleep less
+            self._wakeup.set()
+
+    def cancel(self, dyn_channel):
+        """Forget the deadline of a dynamic channel, e.g. because it was deleted."""
+        self._deadlines.pop(dyn_channel, None)
+
+    def _is_current(self, entry) -> bool:
+        timestamp, _, dyn_channel = entry
+        return self._deadlines.get(dyn_channel) == timestamp
+
+    def _pop_due(self, now: float) -> List:
+        due = []
+        while self._heap and self._heap[0][0] <= now + self.batch_window:
+            entry = heapq.heappop(self._heap)
+            if self._is_current(entry):
+                del self._deadlines[entry[2]]
+                due.append(entry[2])
+        return due
+
+    async def run(self):
+        """Expire dynamic channels forever."""
+        self._wakeup = asyncio.Event()
+        while True:
+            # drop outdated entries, so that we do not wake up for nothing
+            while self._heap and not self._is_current(self._heap[0]):
+                heapq.heappop(self._heap)
+
+            timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            batches: Dict = {}
+            for dyn_channel in self._pop_due(time.time()):
+                batches.setdefault(dyn_channel.dyn_category, []).append(dyn_channel)
+            for dyn_category, dyn_channels in batches.items():
+                asyncio.get_event_loop().create_task(self._expire(dyn_category, dyn_channels))
+
+    async def _expire(self, dyn_category, dyn_channels):
+        try:
+            await dyn_category.expire_dyn_channels(dyn_channels)
+        except Exception:
+            logger.exception(f"[{dyn_category.guild}] Could not expire {len(dyn_channels)} stages.")
@@ -2,8 +2,9 @@
 
 import logging
 from datetime import datetime
+from typing import Optional
 
-from discord import PermissionOverwrite, StageChannel
+from discord import Guild, PermissionOverwrite, StageChannel
 
 from dynamic_channel.category import DynCategory
 from dynamic_channel.dyn_channel import DynChannel
@@ -16,7 +17,12 @@ class DynChannelGuild:
         self.category_info = category_info
         self.dyn_category = None
         self.client = client
-        self.guild = guild
+        # discord.py replaces the guild object when it reconnects, so it is looked up by ID
+        self.guild_id = guild.id
+
+    @property
+    def guild(self) -> Optional[Guild]:
+        return self.client.get_guild(self.guild_id)
 
     def tracked_dyn_channel(self, owner):
         return None  # TODO
@@ -33,7 +39,11 @@ class DynChannelGuild:
                 f"[{self.guild}] Could not find category '{self.category_info.category_name}' in guild {self.guild}. Creating..."
             )
             category = await self.guild.create_category(self.category_info.category_name)
-        self.dyn_category = DynCategory(self, category, self.category_info)
+        dyn_category = DynCategory(self, category, self.category_info)
+        await dyn_category.restore()
+        await dyn_category.recover()
+        self.dyn_category = dyn_category
+        self.client.register_dyn_category(self.dyn_category)
         return self.dyn_category
 
     # async def _delete_stage(
@@ -0,0 +1,66 @@
+# SPDX-License-Identifier: GPL-3.0
+"""Buttons below the control message, as an alternative to its reactions.
+
+A button runs the same action as the matching reaction, but the user gets an ephemeral answer and there is no reaction
+to clean up afterwards. Posting the control message does not add any reactions either. Buttons require discord.py 2.0
+or newer, with older versions only reactions are available.
+"""
+
+import logging
+
+from dynamic_channel.log import set_guild
+from dynamic_channel.message import ReactMessage
+
+try:
+    from discord import ButtonStyle, ui
+except ImportError:  # discord.py < 2.0
+    ButtonStyle = ui = None
+
+logger = logging.getLogger(__name__)
+
+# auto: buttons if discord.py supports them, reactions otherwise
+CONTROLS = ["auto", "reactions", "buttons"]
+
+
+def buttons_available() -> bool:
+    return ui is not None
+
+
+def _custom_id(action) -> str:
+    # must not change between releases, posted buttons keep it
+    return f"dynamic_channel:{action.func.__name__}"
+
+
+def control_view(client):
+    """Build the view with one button per reaction of the control message.
+
+    The view is persistent: it has no timeout and its buttons have fixed custom IDs, so one instance handles the
+    buttons of all control messages, including those posted before the last restart. Register it with
+    client.add_view(). The control message is looked up by the message the button belongs to.
+    """
+    view = ui.View(timeout=None)
+    for emoji, action in ReactMessage.reactions.items():
+        button = ui.Button(emoji=emoji, label=action.label, style=ButtonStyle.secondary, custom_id=_custom_id(action))
+        button.callback = _button_callback(client, emoji)
+        view.add_item(button)
+    return view
+
+
+def _button_callback(client, emoji):
+    async def callback(interaction):
+        set_guild(interaction.guild_id)
+        # actions may take longer than the three seconds discord waits for an answer
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        try:
+            react_message = await client.react_message(interaction.guild_id, interaction.message.id)
+            if react_message is None:
+                answer = "This control message is not in use anymore."
+            else:
+                answer = await react_message.on_interaction(emoji, interaction.user)
+        except Exception:
+            # hot path, formatted lazily
+            logger.exception("[%s] Could not handle button %s of %s.", interaction.guild, emoji, interaction.user)
+            answer = "Something went wrong, please try again later."
+        await interaction.followup.send(answer or "Done.", ephemeral=True)
+
+    return callback
@@ -0,0 +1,170 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+CREATE = "create"  # create or claim the channels of a stage
+DELETE = "delete"  # delete the channels of a stage, or hand them back to the pool
+
+
+class Operation:
+    """A multi-step channel operation of a stage."""
+
+    def __init__(self, op_id: int, kind: str, guild_id: int, category_id: int, owner_id: int, names, channel_ids):
+        self.id = op_id
+        self.kind = kind
+        self.guild_id = guild_id
+        self.category_id = category_id
+        self.owner_id = owner_id
+        self.names: List[str] = list(names)  # names of the channels, to find created channels whose ID is unknown
+        self.channel_ids: List[int] = list(channel_ids)  # the channels known to be affected so far
+
+    def __str__(self):
+        return f"{self.kind} #{self.id} of owner {self.owner_id} (channels {self.channel_ids})"
+
+    def begin_entry(self) -> dict:
+        return {
+            "begin": self.id,
+            "kind": self.kind,
+            "guild_id": self.guild_id,
+            "category_id": self.category_id,
+            "owner_id": self.owner_id,
+            # copies, the entry may be written in another thread while channels are added
+            "names": list(self.names),
+            "channel_ids": list(self.channel_ids),
+        }
+
+
+class Journal:
+    """Append-only log of the multi-step channel operations, one JSON object per line.
+
+    An operation is written before it starts, the channels it creates are added once they exist and the operation is
+    marked as done once it finished or was rolled back. Only the first line is synced to disk before the operation
+    goes on, lost later lines just cause a needless recovery. Operations which were not done when the process died
+    are recovered on the next startup by their DynCategory, so recovery only looks at the work that was in flight.
+
+    On startup and after every compact_after finished operations, the file is compacted to the unfinished
+    operations, so it does not grow while the bot runs.
+    """
+
+    def __init__(self, path: str, compact_after: int = 1000):
+        self.path = path
+        self.compact_after = compact_after
+
+        # unfinished operations as of startup, by category ID. Entries are consumed by recovering them.
+        self._unfinished: Dict[int, List[Operation]] = {}
+        operations = self._load()
+        for operation in operations:
+            self._unfinished.setdefault(operation.category_id, []).append(operation)
+        self._compact([o.begin_entry() for o in operations])
+        if operations:
+            logger.warning(f"Found {len(operations)} unfinished channel operations in {path}.")
+
+        # operations which are not done, including the unfinished ones from before, by ID
+        self._open: Dict[int, Operation] = {o.id: o for o in operations}
+        self._done_count = 0  # operations done since the last compaction
+
+        self._ids = itertools.count(max((o.id for o in operations), default=0) + 1)
+        self._file = open(path, "a", encoding="utf-8")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+
+    def _load(self) -> List[Operation]:
+        operations: Dict[int, Operation] = {}
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the process died while writing the line
+                        logger.warning(f"Skipping torn line in {self.path}: {line!r}")
+                        continue
+                    if "begin" in entry:
+                        operations[entry["begin"]] = Operation(
+                            entry["begin"],
+                            entry["kind"],
+                            entry["guild_id"],
+                            entry["category_id"],
+                            entry["owner_id"],
+                            entry["names"],
+                            entry["channel_ids"],
+                        )
+                    elif "channel" in entry and entry["id"] in operations:
+                        operations[entry["id"]].channel_ids.append(entry["channel"])
+                    elif "done" in entry:
+                        operations.pop(entry["done"], None)
+        except FileNotFoundError:
+            pass
+        return list(operations.values())
+
+    def _compact(self, entries: List[dict]):
+        """Replace the file with the begin entries of the unfinished operations."""
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            for entry in entries:
+                file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+
+    def pop_unfinished(self, category_id: int) -> List[Operation]:
+        """Get the unfinished operations of a category as of startup. Returns an empty list on subsequent calls."""
+        return self._unfinished.pop(category_id, [])
+
+    def _recompact(self, entries: List[dict]):
+        self._file.close()
+        self._compact(entries)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _append(self, entry: dict, sync: bool):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    async def _write(self, entry: dict, sync=False):
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._append, entry, sync)
+
+    async def begin(
+        self, kind: str, dyn_channel, names: Sequence[str] = (), channel_ids: Sequence[Optional[int]] = ()
+    ) -> Operation:
+        """Write an operation of a stage to disk. Returns once it is safe to start the operation."""
+        operation = Operation(
+            next(self._ids),
+            kind,
+            dyn_channel.guild.id,
+            dyn_channel.category_id,
+            dyn_channel.owner_id,
+            names,
+            [i for i in channel_ids if i is not None],
+        )
+        self._open[operation.id] = operation
+        await self._write(operation.begin_entry(), sync=True)
+        return operation
+
+    async def add_channel(self, operation: Operation, channel_id: int):
+        """Note a channel the operation created."""
+        operation.channel_ids.append(channel_id)
+        await self._write({"channel": channel_id, "id": operation.id})
+
+    async def done(self, operation: Operation):
+        self._open.pop(operation.id, None)
+        self._done_count += 1
+        if self._done_count < self.compact_after:
+            await self._write({"done": operation.id})
+            return
+        # the writes run in order, so the compacted file replaces everything written so far
+        self._done_count = 0
+        entries = [o.begin_entry() for o in self._open.values()]
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._recompact, entries)
+
+    async def close(self):
+        self._executor.shutdown()
+        self._file.close()
@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable
+
+
+class KeyedLock:
+    """One lock per key, e.g. per owner. Locks are dropped once nobody holds or waits for them."""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._users: Dict[Hashable, int] = {}
+
+    def locked(self, key: Hashable) -> bool:
+        return key in self._locks and self._locks[key].locked()
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable):
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+            self._users[key] = 0
+        lock = self._locks[key]
+        self._users[key] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[key] -= 1
+            if self._users[key] == 0:
+                del self._locks[key]
+                del self._users[key]
+
+
+class SharedExclusiveLock:
+    """Held either by any number of shared holders or by a single exclusive holder.
+
+    Waiting exclusive holders take precedence over new shared holders, so a steady stream of shared holders cannot
+    starve them.
+    """
+
+    def __init__(self):
+        self._shared = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+        self._condition = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # created lazily, so that the lock can be instantiated outside of the event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    @asynccontextmanager
+    async def shared(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self._exclusive and not self._exclusive_waiting)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self._shared -= 1
+                self.condition.notify_all()
+
+    @asynccontextmanager
+    async def exclusive(self):
+        async with self.condition:
+            self._exclusive_waiting += 1
+            try:
+                await self.condition.wait_for(lambda: not self._exclusive and not self._shared)
+            finally:
+                self._exclusive_waiting -= 1
+                # shared holders may have been waiting for us only
+                self.condition.notify_all()
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self._exclusive = False
+                self.condition.notify_all()
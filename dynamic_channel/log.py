@@ -0,0 +1,166 @@
+# SPDX-License-Identifier: GPL-3.0
+"""Logging without blocking the event loop.
+
+The root logger only puts records into a queue, the actual handlers (files, streams, discord log channels) run in a
+background thread. Records of the bot's own loggers which are logged while handling a guild are shipped to the log
+channel of that guild, if it has one, batched into few messages.
+"""
+
+import asyncio
+import contextvars
+import logging
+import queue
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from typing import Deque, Dict, List, Optional
+
+from discord import HTTPException
+
+from dynamic_channel.renderer import MESSAGE_MAX_LENGTH
+from dynamic_channel.scheduler import SEND_MESSAGE, Priority, channel_bucket
+
+logger = logging.getLogger(__name__)
+
+# ID of the guild the current task works for. Every event callback runs in its own task, so setting it does not leak
+# into other callbacks.
+_guild_id = contextvars.ContextVar("guild_id", default=None)
+
+# log channels by guild ID
+_log_channels: Dict[int, "LogChannel"] = {}
+
+
+def set_guild(guild_id: Optional[int]):
+    """Attribute the log records of the current task to a guild."""
+    _guild_id.set(guild_id)
+
+
+class GuildFilter(logging.Filter):
+    """Stores the guild the record was logged for in record.guild_id. Has to run where the record is logged."""
+
+    def filter(self, record):
+        if getattr(record, "guild_id", None) is None:
+            record.guild_id = _guild_id.get()
+        return True
+
+
+def start_queue_logging(handlers: List[logging.Handler], level) -> QueueListener:
+    """Make the root logger pass all records to the given handlers, in a background thread. Stop the returned
+    listener on shutdown to flush the remaining records."""
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(GuildFilter())
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class TextChannelHandler(logging.Handler):
+    """Ships the records of the bot's loggers to the log channel of the guild they were logged for.
+
+    May run in any thread, the records are passed on to the event loop of the log channel.
+    """
+
+    def __init__(self, level=logging.INFO):
+        super().__init__(level)
+        self.setFormatter(logging.Formatter("%(levelname)s _%(name)s_  %(message)s"))
+
+    def emit(self, record):
+        # records of the log channel itself would feed back into it
+        if not record.name.startswith("dynamic_channel") or record.name == __name__:
+            return
+        log_channel = _log_channels.get(getattr(record, "guild_id", None))
+        if log_channel is None:
+            return
+        try:
+            log_channel.loop.call_soon_threadsafe(log_channel.append, self.format(record))
+        except RuntimeError:
+            pass  # the event loop is closed already
+        except Exception:
+            self.handleError(record)
+
+
+class LogChannel:
+    """A discord text channel which receives log lines.
+
+    Lines are collected and sent at most once per interval seconds, in as few messages as possible. If discord cannot
+    keep up, the oldest lines are dropped.
+    """
+
+    def __init__(self, client, text_channel, interval: float = 5.0, max_lines: int = 1000):
+        self.client = client
+        self.guild_id = text_channel.guild.id
+        self.text_channel_id = text_channel.id
+        self.interval = interval
+        self.loop = asyncio.get_event_loop()
+
+        self._lines: Deque[str] = deque(maxlen=max_lines)
+        self._flush_task = None
+
+    @property
+    def guild(self):
+        return self.client.get_guild(self.guild_id)
+
+    @property
+    def text_channel(self):
+        return self.client.get_channel(self.text_channel_id)
+
+    def register(self):
+        """Start shipping the records of the guild to this channel."""
+        _log_channels[self.guild_id] = self
+
+    def unregister(self):
+        if _log_channels.get(self.guild_id) is self:
+            del _log_channels[self.guild_id]
+
+    def append(self, line: str):
+        """Queue a line. Must be called in the event loop."""
+        if len(line) > MESSAGE_MAX_LENGTH:
+            line = line[: MESSAGE_MAX_LENGTH - 1] + "…"
+        self._lines.append(line)
+        if self._flush_task is None:
+            self._flush_task = self.loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # whatever is logged while sending belongs to no guild, else it would be shipped again
+        set_guild(None)
+        try:
+            await asyncio.sleep(self.interval)
+        finally:
+            self._flush_task = None
+        await self.flush()
+
+    def _batches(self) -> List[str]:
+        batches = []
+        batch: List[str] = []
+        length = 0
+        while self._lines:
+            line = self._lines.popleft()
+            if batch and length + 1 + len(line) > MESSAGE_MAX_LENGTH:
+                batches.append("\n".join(batch))
+                batch, length = [], 0
+            length += len(line) + (1 if batch else 0)
+            batch.append(line)
+        if batch:
+            batches.append("\n".join(batch))
+        return batches
+
+    async def flush(self):
+        """Send all queued lines. They are dropped if the channel does not exist anymore."""
+        text_channel = self.text_channel
+        batches = self._batches()
+        if text_channel is None:
+            return
+        for content in batches:
+            try:
+                await self.client.rest_scheduler.run(
+                    channel_bucket(text_channel, SEND_MESSAGE),
+                    lambda: text_channel.send(content),
+                    priority=Priority.BULK,
+                )
+            except HTTPException as e:
+                logger.warning(f"[{self.guild}] Could not ship log lines to {text_channel}: {e}")
@@ -1,70 +1,201 @@
 # SPDX-License-Identifier: GPL-3.0
+import asyncio
 import logging
+import time
+
+from dynamic_channel import metrics
+from dynamic_channel.scheduler import DELETE_MESSAGE, DELETE_REACTION, EDIT_MESSAGE, SEND_MESSAGE, channel_bucket
 
 logger = logging.getLogger(__name__)
 
 
 class ReactionWrapper:
-    def __init__(self, func, emoji, remove):
+    def __init__(self, func, emoji, remove, label=None):
         self.func = func
         self.emoji = emoji
         self.remove = remove
+        self.label = label or func.__name__  # shown on the button of the action
 
     def __set_name__(self, owner, name):
         setattr(owner, name, self.wrapper)
-        owner.reactions[self.emoji] = self.wrapper
+        owner.reactions[self.emoji] = self
+
+    def __call__(self, other_self, emoji, user, remove=True):
+        return self.wrapper(other_self, emoji, user, remove=remove)
 
-    async def wrapper(self, other_self, *args, **kwargs):
-        reaction, user = args
+    async def wrapper(self, other_self, emoji, user, remove=True):
+        """remove=False skips removing the reaction, e.g. if the action was triggered by a button."""
+        started_at = time.perf_counter() if metrics.enabled else None
+        # hot path, formatted lazily
         logger.info(
-            f"[{reaction.message.guild}] User {user} reacted to bot message: ({reaction})  --> {self.func.__name__}"
+            "[%s] User %s reacted to bot message: (%s)  --> %s",
+            other_self.message.guild,
+            user,
+            emoji,
+            self.func.__name__,
         )
-        result = await self.func(other_self, *args, **kwargs)
-        if self.remove:
-            await reaction.remove(user)
+        try:
+            result = await self.func(other_self, emoji, user)
+            if self.remove and remove:
+                await other_self.remove_reaction(emoji, user)
+        finally:
+            # failed actions took the user's time, too
+            if started_at is not None:
+                metrics.ACTION_SECONDS.observe(time.perf_counter() - started_at, self.func.__name__)
         return result
 
 
-def react_to(emoji, remove=False):
+def react_to(emoji, remove=False, label=None):
     def _decorator(func):
-        return ReactionWrapper(func, emoji, remove)
+        return ReactionWrapper(func, emoji, remove, label)
 
     return _decorator
 
 
-class ReactMessage:
-    reactions = {}
-
-    def __init__(self, client, get_text_cb):
+class TextMessage:
+    def __init__(self, client, get_text_cb, edit_interval=1.0):
+        """The discord message is edited at most once per edit_interval seconds. get_text_cb may return None if the
+        message is about to be deleted."""
         self._client = client
         self._get_text_cb = get_text_cb
+        self.edit_interval = edit_interval
         self.message = None
 
+        self._sent_text = None  # text of the discord message, as far as we know
+        self._last_edit_at = 0.0
+        self._flush_task = None
+
     @property
     def text(self):
         return self._get_text_cb()
 
-    async def update_text(self):
-        """Update discord message text."""
+    @property
+    def sent_text(self):
+        """Text of the discord message, as far as we know."""
+        return self._sent_text
+
+    def update_text(self):
+        """Mark discord message text as outdated. It will be edited with the newest text once the edit interval allows."""
+        metrics.CONTROL_MESSAGE_UPDATES.inc()
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_event_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            loop = asyncio.get_event_loop()
+            # always yield once, so that updates from the same burst are coalesced
+            await asyncio.sleep(max(0.0, self._last_edit_at + self.edit_interval - loop.time()))
+        finally:
+            # updates from now on need another flush
+            self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Edit discord message text, unless it is up to date."""
         text = self.text
-        logger.info(f"[{self.message.guild}] Update bot control message in channel {self.message.channel}: {text}")
-        await self.message.edit(content=text)
+        if self.message is None or text is None or text == self._sent_text:
+            return
+
+        logger.debug("[%s] Update bot message in channel %s: %s", self.message.guild, self.message.channel, text)
+        self._sent_text = text
+        self._last_edit_at = asyncio.get_event_loop().time()
+        metrics.CONTROL_MESSAGE_EDITS.inc()
+        try:
+            await self._client.rest_scheduler.run(
+                channel_bucket(self.message.channel, EDIT_MESSAGE), lambda: self.message.edit(content=text)
+            )
+        except Exception:
+            logger.exception(f"[{self.message.guild}] Could not update bot message.")
+            self._sent_text = None
+
+    async def send(self, channel):
+        text = self.text
+        logger.debug("[%s] Create message in channel %s: %s", channel.guild, channel, text)
+        self.message = await self._client.rest_scheduler.run(
+            channel_bucket(channel, SEND_MESSAGE), lambda: channel.send(text)
+        )
+        self._sent_text = text
 
-    async def send_and_wait(self, channel):
+    async def adopt(self, message):
+        """Take over an already posted message, e.g. after a restart, instead of posting a new one."""
+        self.message = message
+        self._sent_text = message.content
+        # the text may have changed while we were offline
+        self.update_text()
+
+    def forget(self):
+        """Stop updating the message, e.g. because it is deleted."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    async def delete(self):
+        self.forget()
+        await self._client.rest_scheduler.run(channel_bucket(self.message.channel, DELETE_MESSAGE), self.message.delete)
+
+
+class ReactMessage(TextMessage):
+    reactions = {}
+
+    def __init__(self, client, get_text_cb, edit_interval=1.0, view=None):
+        """If a view (discord.py 2.0 buttons for the reactions) is given, it is attached to the message instead of
+        adding the reactions."""
+        super().__init__(client, get_text_cb, edit_interval=edit_interval)
+        self.view = view
+
+    def forget(self):
+        super().forget()
+        if self.message is not None:
+            self._client.unregister_react_message(self)
+
+    async def remove_reaction(self, emoji, user):
+        await self._client.rest_scheduler.run(
+            channel_bucket(self.message.channel, DELETE_REACTION), lambda: self.message.remove_reaction(emoji, user)
+        )
+
+    async def send(self, channel):
+        """Post the message, add all reactions (or the view) and register it with the client to receive reactions."""
         text = self.text
-        logger.info(f"[{channel.guild}] Create react message in channel {channel}: {text}")
-        self.message = await channel.send(text)
+        logger.debug("[%s] Create react message in channel %s: %s", channel.guild, channel, text)
+        if self.view is not None:
+            self.message = await channel.send(text, view=self.view)
+        else:
+            self.message = await channel.send(text)
+        self._sent_text = text
+        self._client.register_react_message(self)
+        if self.view is not None:
+            return
         for emoji in ReactMessage.reactions.keys():
             await self.message.add_reaction(emoji)
 
-        while True:
-            reaction, user = await self._client.wait_for(
-                "reaction_add",
-                check=lambda reaction, user: reaction.message == self.message and user != self._client.user,
-            )
-            if reaction.emoji in ReactMessage.reactions:
-                # call callback function (deleting reaction is up to callback)
-                await ReactMessage.reactions[reaction.emoji](self, reaction, user)
-            else:
-                # always remove unknown reactions
-                await reaction.remove(user)
+    async def adopt(self, message):
+        """Take over an already posted message, e.g. after a restart, instead of posting a new one."""
+        logger.info(f"[{message.guild}] Adopt react message in channel {message.channel}: {message.id}")
+        await super().adopt(message)
+        self._client.register_react_message(self)
+        if self.view is not None:
+            # reactions from before still work, they are not removed
+            if not message.components:
+                await self._client.rest_scheduler.run(
+                    channel_bucket(message.channel, EDIT_MESSAGE), lambda: message.edit(view=self.view)
+                )
+            return
+        present = {str(r.emoji) for r in message.reactions if r.me}
+        for emoji in ReactMessage.reactions.keys():
+            if emoji not in present:
+                await self.message.add_reaction(emoji)
+
+    async def on_reaction(self, payload):
+        """Called by the client for every reaction (but the client's own ones) to this message."""
+        emoji = str(payload.emoji)
+        user = payload.member
+        if emoji in ReactMessage.reactions:
+            # call callback function (deleting reaction is up to callback)
+            await ReactMessage.reactions[emoji](self, emoji, user)
+        else:
+            # always remove unknown reactions
+            await self.remove_reaction(payload.emoji, user)
+
+    async def on_interaction(self, emoji, user):
+        """Called for every button of the view. Runs the action of the reaction, returns the answer for the user."""
+        return await ReactMessage.reactions[emoji](self, emoji, user, remove=False)
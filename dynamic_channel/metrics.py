@@ -0,0 +1,172 @@
+# SPDX-License-Identifier: GPL-3.0
+"""Metrics in the Prometheus text format.
+
+Metrics are disabled by default. While disabled, recording a value is a single check of a global flag. Callers which
+have to do extra work to get a value (e.g. timing something) should check `metrics.enabled` first.
+"""
+
+import bisect
+import logging
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+enabled = False
+
+_registry: List["_Metric"] = []
+
+
+def _format_labels(labelnames: Sequence[str], labels: Sequence) -> str:
+    if not labelnames:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels))
+    return "{" + pairs + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        """Yield (suffix, labels, value) for every sample."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{self.name}{suffix}{labels} {value}" for suffix, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        if enabled:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield "_total", _format_labels(self.labelnames, labels), value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._counts: Dict[tuple, List[int]] = {}  # per bucket, not cumulative, the last one is +Inf
+        self._sums: Dict[tuple, float] = {}
+
+    def observe(self, value: float, *labels):
+        if enabled:
+            if labels not in self._counts:
+                self._counts[labels] = [0] * (len(self.buckets) + 1)
+                self._sums[labels] = 0.0
+            self._counts[labels][bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[labels] += value
+
+    def samples(self):
+        for labels, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield "_bucket", _format_labels(self.labelnames + ("le",), labels + (bound,)), cumulative
+            yield "_count", _format_labels(self.labelnames, labels), cumulative
+            yield "_sum", _format_labels(self.labelnames, labels), self._sums[labels]
+
+
+class CallbackGauge(_Metric):
+    """Gauge whose values are collected on scrape, callback yields (labels, value) pairs."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), callback: Callable = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self):
+        if self.callback is None:
+            return
+        for labels, value in self.callback():
+            yield "", _format_labels(self.labelnames, labels), value
+
+
+ACTION_SECONDS = Histogram(
+    "dynamic_channel_action_seconds", "Time from receiving a reaction until its action completed.", ["action"]
+)
+CHANNEL_OPERATION_SECONDS = Histogram(
+    "dynamic_channel_channel_operation_seconds", "Duration of creating or destroying a stage.", ["operation"]
+)
+REST_REQUESTS = Counter("dynamic_channel_rest_requests", "REST requests to discord.", ["endpoint"])
+RATE_LIMITED = Counter("dynamic_channel_rate_limited", "REST requests which were rate limited by discord (429).")
+CONTROL_MESSAGE_UPDATES = Counter(
+    "dynamic_channel_control_message_updates", "Requested control message updates (before coalescing)."
+)
+CONTROL_MESSAGE_EDITS = Counter("dynamic_channel_control_message_edits", "Control message edits sent to discord.")
+EVENTS = Counter(
+    "dynamic_channel_events", "Gateway events which were handled or dropped by the event filter.", ["event", "result"]
+)
+STAGES = CallbackGauge("dynamic_channel_stages", "Tracked stages.", ["guild"])
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+class _RateLimitFilter(logging.Filter):
+    """Counts the rate limit warnings of discord.py, which has no other hook for them."""
+
+    def filter(self, record):
+        if str(record.msg).startswith("We are being rate limited"):
+            RATE_LIMITED.inc()
+        return True
+
+
+def instrument_http(http):
+    """Count the requests of a discord.py HTTPClient per endpoint (method and path template)."""
+    request = http.request
+
+    async def counting_request(route, **kwargs):
+        REST_REQUESTS.inc(f"{route.method} {route.path}")
+        return await request(route, **kwargs)
+
+    http.request = counting_request
+
+
+async def serve(host: str, port: int):
+    """Enable metrics and serve them via HTTP on /metrics."""
+    global enabled
+    enabled = True
+    logging.getLogger("discord.http").addFilter(_RateLimitFilter())
+
+    async def handle(_request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,240 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+from discord import PermissionOverwrite, StageChannel, TextChannel
+
+from dynamic_channel.scheduler import (
+    DELETE_CHANNEL,
+    EDIT_CHANNEL,
+    GET_MESSAGES,
+    Priority,
+    channel_bucket,
+    guild_bucket,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def has_messages(channel) -> bool:
+    # history() is iterated instead of flattened, discord.py 2.0 dropped flatten()
+    async for _ in channel.history(limit=1):
+        return True
+    return False
+
+
+class ChannelPool:
+    """Hidden stage and text channels of a category, created ahead of time.
+
+    Creating a stage takes channels from the pool and only renames them, which is one edit per channel instead of
+    two channel creations in the rate limit bucket of the guild. Deleting a stage resets its channels and puts them
+    back. Text channels are only reused if nobody wrote in them, otherwise they are deleted.
+
+    The pool holds as many channels as stages were created in the last demand_window seconds, but at least min_size
+    and at most max_size. Once the demand drops, the pool is trimmed.
+    """
+
+    STAGE_NAME = "pooled-stage"
+    TEXT_NAME = "pooled-text"
+
+    def __init__(self, dyn_category, max_size: int, min_size: int = 0, demand_window: float = 600.0):
+        self.dyn_category = dyn_category
+        self.max_size = max_size
+        self.min_size = min_size
+        self.demand_window = demand_window
+
+        # IDs of the pooled channels, discord.py replaces the channel objects when it reconnects
+        self._stage_channel_ids: List[int] = []
+        self._text_channel_ids: List[int] = []
+        self._claimed_at: Deque[float] = deque()  # times of recent claims, oldest first
+        # channels which are being reset to go back into the pool, concurrent releases must not overfill it
+        self._incoming_stages = 0
+        self._incoming_texts = 0
+
+        self._maintain_task = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    @property
+    def client(self):
+        return self.dyn_category.client
+
+    @property
+    def guild(self):
+        return self.dyn_category.guild
+
+    @property
+    def rest_scheduler(self):
+        return self.client.rest_scheduler
+
+    @property
+    def channel_ids(self) -> List[int]:
+        return self._stage_channel_ids + self._text_channel_ids
+
+    def __len__(self):
+        return min(len(self._stage_channel_ids), len(self._text_channel_ids))
+
+    @property
+    def target_size(self) -> int:
+        """Number of channel pairs to keep ready, following the recent demand."""
+        threshold = time.monotonic() - self.demand_window
+        while self._claimed_at and self._claimed_at[0] < threshold:
+            self._claimed_at.popleft()
+        return max(self.min_size, min(self.max_size, len(self._claimed_at)))
+
+    def hidden_overwrites(self):
+        return {
+            self.guild.default_role: PermissionOverwrite(view_channel=False),
+            self.guild.me: PermissionOverwrite(view_channel=True),
+        }
+
+    def restore(self):
+        """Take over the pooled channels from before the last shutdown. Channels of deleted stages are pooled where
+        they are, which may be an overflow category."""
+        for channel in (c for category in self.dyn_category.capacity.categories for c in category.channels):
+            if isinstance(channel, StageChannel) and channel.name == self.STAGE_NAME:
+                self._stage_channel_ids.append(channel.id)
+            elif isinstance(channel, TextChannel) and channel.name == self.TEXT_NAME:
+                self._text_channel_ids.append(channel.id)
+        if self._stage_channel_ids or self._text_channel_ids:
+            logger.info(
+                f"[{self.guild}] Restored {len(self._stage_channel_ids)} pooled stage channels and "
+                f"{len(self._text_channel_ids)} pooled text channels."
+            )
+            # assume the demand from before the restart, the pool is trimmed if it does not come back
+            now = time.monotonic()
+            self._claimed_at.extend(now for _ in range(max(len(self._stage_channel_ids), len(self._text_channel_ids))))
+            self._maintain()
+
+    def take(self) -> Tuple[Optional[StageChannel], Optional[TextChannel]]:
+        """Take a stage and a text channel out of the pool. Channels are None if the pool ran out of them."""
+        self._claimed_at.append(time.monotonic())
+        stage_channel = self._pop(self._stage_channel_ids)
+        text_channel = self._pop(self._text_channel_ids)
+        self._maintain()
+        return stage_channel, text_channel
+
+    def _pop(self, channel_ids: List[int]):
+        """Take a channel out of the pool, skipping the ones which were deleted by someone else."""
+        while channel_ids:
+            channel = self.guild.get_channel(channel_ids.pop())
+            if channel is not None:
+                return channel
+        return None
+
+    def restock(self, *channels):
+        """Put channels back which were taken but not used."""
+        for channel in channels:
+            if isinstance(channel, StageChannel):
+                self._stage_channel_ids.append(channel.id)
+            elif isinstance(channel, TextChannel):
+                self._text_channel_ids.append(channel.id)
+
+    def clear(self):
+        """Forget all pooled channels, e.g. because they are purged."""
+        self._stage_channel_ids.clear()
+        self._text_channel_ids.clear()
+
+    async def release(self, stage_channel: StageChannel, text_channel: TextChannel, priority=Priority.INTERACTIVE):
+        """Reset the channels of a deleted stage and put them back into the pool, or delete them."""
+        target_size = self.target_size
+        keep_stage = not stage_channel.members and len(self._stage_channel_ids) + self._incoming_stages < target_size
+        claim_text = len(self._text_channel_ids) + self._incoming_texts < target_size
+        # claim the room before waiting for anything
+        self._incoming_stages += keep_stage
+        self._incoming_texts += claim_text
+        try:
+            keep_text = claim_text and not await self.rest_scheduler.run(
+                channel_bucket(text_channel, GET_MESSAGES), lambda: has_messages(text_channel), priority=priority
+            )
+
+            async def reset(channel, name, keep):
+                if keep:
+                    await self.rest_scheduler.run(
+                        channel_bucket(channel, EDIT_CHANNEL),
+                        lambda: channel.edit(name=name, overwrites=self.hidden_overwrites()),
+                        priority=priority,
+                    )
+                else:
+                    await self.rest_scheduler.run(
+                        channel_bucket(channel, DELETE_CHANNEL), channel.delete, priority=priority
+                    )
+                return keep
+
+            kept_stage, kept_text = await asyncio.gather(
+                reset(stage_channel, self.STAGE_NAME, keep_stage), reset(text_channel, self.TEXT_NAME, keep_text)
+            )
+        finally:
+            self._incoming_stages -= keep_stage
+            self._incoming_texts -= claim_text
+        if kept_stage:
+            self._stage_channel_ids.append(stage_channel.id)
+        if kept_text:
+            self._text_channel_ids.append(text_channel.id)
+        self._maintain()
+
+    def _maintain(self):
+        """Make sure the pool is resized in the background."""
+        if self._maintain_task is None:
+            self._maintain_task = asyncio.get_event_loop().create_task(self._run())
+        elif self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await self._resize()
+                except Exception:
+                    logger.exception(f"[{self.guild}] Could not resize channel pool.")
+                if not self._claimed_at:
+                    return
+                # the pool shrinks once the oldest claim leaves the demand window
+                timeout = self._claimed_at[0] + self.demand_window - time.monotonic()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(0.0, timeout))
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+        finally:
+            self._maintain_task = None
+
+    async def _resize(self):
+        target_size = self.target_size
+        category = self.dyn_category.category
+        capacity = self.dyn_category.capacity
+        bucket = guild_bucket(self.guild)
+        for channel_ids, name, create in (
+            (self._stage_channel_ids, self.STAGE_NAME, self.guild.create_stage_channel),
+            (self._text_channel_ids, self.TEXT_NAME, self.guild.create_text_channel),
+        ):
+            # pooled channels are only created in the category itself, never in overflow categories
+            count = min(target_size - len(channel_ids), capacity.room(category))
+            if count > 0:
+                with capacity.pending(category, count):
+                    results = await self.rest_scheduler.gather(
+                        *(
+                            (bucket, lambda: create(name=name, category=category, overwrites=self.hidden_overwrites()))
+                            for _ in range(count)
+                        ),
+                        priority=Priority.BULK,
+                    )
+                for result in results:
+                    if isinstance(result, Exception):
+                        logger.error(f"[{self.guild}] Could not create pooled channel: {result}")
+                    else:
+                        channel_ids.append(result.id)
+            while len(channel_ids) > target_size:
+                channel = self._pop(channel_ids)
+                if channel is None:
+                    break
+                try:
+                    await self.rest_scheduler.run(
+                        channel_bucket(channel, DELETE_CHANNEL), channel.delete, priority=Priority.BULK
+                    )
+                except Exception as e:
+                    logger.error(f"[{self.guild}] Could not delete pooled channel {channel}: {e}")
@@ -0,0 +1,198 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import logging
+from collections import Counter
+from datetime import timezone
+from typing import Dict, List, NamedTuple, Optional
+
+from discord import Object, StageChannel, TextChannel, User
+
+from dynamic_channel.dyn_channel import DynChannel, owner_name_of
+from dynamic_channel.pool import ChannelPool, has_messages
+from dynamic_channel.scheduler import DELETE_CHANNEL, EDIT_CHANNEL, GET_MESSAGES, Priority, channel_bucket
+
+logger = logging.getLogger(__name__)
+
+ADOPT = "adopt"  # track an untracked stage which still has its owner and text channel
+FORGET = "forget"  # untrack a stage whose channels were deleted
+RENAME = "rename"  # give a tracked channel its proper name back
+DELETE = "delete"  # delete an untracked channel
+
+
+class Step(NamedTuple):
+    action: str
+    channel: Optional[object] = None
+    dyn_channel: Optional[DynChannel] = None
+    name: Optional[str] = None
+
+    def __str__(self):
+        if self.action in (ADOPT, FORGET):
+            return f"{self.action} {self.dyn_channel}"
+        if self.action == RENAME:
+            return f'{self.action} "{self.channel}" -> "{self.name}"'
+        return f'{self.action} "{self.channel}"'
+
+
+class Plan(List[Step]):
+    def summary(self) -> str:
+        counts = Counter(step.action for step in self)
+        return ", ".join(f"{action} {counts[action]}" for action in (ADOPT, FORGET, RENAME, DELETE))
+
+
+class Reconciler:
+    """Brings the tracked stages of a category and its live channels in line.
+
+    Live channels and tracked state are compared by ID in one pass. The result is a plan, which can be logged only
+    (dry run) or executed, with all REST requests in parallel. The caller has to make sure that no stages are created
+    or deleted meanwhile.
+    """
+
+    def __init__(self, dyn_category):
+        self.dyn_category = dyn_category
+
+    @property
+    def guild(self):
+        return self.dyn_category.guild
+
+    def _owner_id_of(self, stage_channel) -> Optional[int]:
+        """The ID of the member who may manage an untracked stage channel. discord.py < 2.0 leaves out the overwrites
+        of members who are not cached."""
+        for target, overwrite in stage_channel.overwrites.items():
+            if target is None or not overwrite.manage_channels or target.id == self.guild.me.id:
+                continue
+            # discord.py 2.0 has objects of type User for members who are not cached, roles are skipped
+            if self.guild.get_member(target.id) is not None or getattr(target, "type", None) is User:
+                return target.id
+        return None
+
+    @staticmethod
+    def _is_named_by_bot(channel) -> bool:
+        pooled_names = (ChannelPool.STAGE_NAME, ChannelPool.TEXT_NAME)
+        return owner_name_of(channel.name) is not None or channel.name in pooled_names
+
+    async def _deletable_text_channels(self, text_channels) -> List[TextChannel]:
+        """The text channels which are named like the bot's, or which nobody wrote in. Other text channels were set up
+        by someone else, e.g. the rules of the category."""
+        deletable = [c for c in text_channels if self._is_named_by_bot(c)]
+        others = [c for c in text_channels if not self._is_named_by_bot(c)]
+        results = await self.dyn_category.client.rest_scheduler.gather(
+            *((channel_bucket(c, GET_MESSAGES), lambda c=c: has_messages(c)) for c in others), priority=Priority.BULK
+        )
+        for channel, result in zip(others, results):
+            if isinstance(result, Exception):
+                logger.warning(f"[{self.guild}] Could not read the history of {channel}, keeping it: {result}")
+            elif not result:
+                deletable.append(channel)
+        return deletable
+
+    async def plan(self, purge=False) -> Plan:
+        """Plan the reconciliation. If purge is set, all untracked stage channels are deleted, even if there are
+        members in them. Otherwise stages are adopted if possible, and only empty stage channels which are named like
+        the bot's are deleted, together with their text channels. Other text channels are only deleted if they are
+        named like the bot's or nobody wrote in them."""
+        dyn_category = self.dyn_category
+        kept_ids = {(await dyn_category.control_channel).text_channel.id}
+        log_channel = await dyn_category.log_channel
+        if log_channel is not None:
+            kept_ids.add(log_channel.text_channel.id)
+        live_channels = [c for category in dyn_category.capacity.categories for c in category.channels]
+        live_ids = {c.id for c in live_channels}
+
+        plan = Plan()
+        tracked: Dict[int, DynChannel] = {}
+        for dyn_channel in dyn_category.dyn_channels:
+            if all(i in live_ids for i in dyn_channel.channel_ids):
+                for channel_id in dyn_channel.channel_ids:
+                    tracked[channel_id] = dyn_channel
+            else:
+                plan.append(Step(FORGET, dyn_channel=dyn_channel))
+
+        untracked = []
+        pooled = dyn_category.pool is not None and not purge
+        for channel in live_channels:
+            dyn_channel = tracked.get(channel.id)
+            if dyn_channel is not None:
+                name = dyn_channel.stage_name if channel.id == dyn_channel.stage_channel_id else dyn_channel.text_name
+                if channel.name != name:
+                    plan.append(Step(RENAME, channel=channel, name=name))
+            elif channel.id in kept_ids:
+                continue
+            elif pooled and channel.name in (ChannelPool.STAGE_NAME, ChannelPool.TEXT_NAME):
+                continue  # pooled, or about to be
+            else:
+                untracked.append(channel)
+
+        stage_channels = [c for c in untracked if isinstance(c, StageChannel)]
+        # by ID, several untracked text channels may share a name
+        text_channels = {c.id: c for c in untracked if isinstance(c, TextChannel)}
+        if purge:
+            plan += [Step(DELETE, channel=c) for c in stage_channels]
+            plan += [Step(DELETE, channel=c) for c in await self._deletable_text_channels(text_channels.values())]
+            return plan
+
+        text_channels_by_name: Dict[str, List[TextChannel]] = {}
+        for channel in text_channels.values():
+            text_channels_by_name.setdefault(channel.name, []).append(channel)
+        adopted_owner_ids = set()
+        for channel in stage_channels:
+            owner_name = owner_name_of(channel.name)
+            if owner_name is None:
+                # pooled stages are the bot's, too, if the pool was disabled since
+                if channel.name == ChannelPool.STAGE_NAME and not channel.members:
+                    plan.append(Step(DELETE, channel=channel))
+                continue
+            owner_id = self._owner_id_of(channel)
+            dyn_channel = DynChannel(dyn_category, owner_id, owner_name)
+            if channel.name != dyn_channel.stage_name:
+                continue
+            # the text channel of a stage shares its fate
+            same_name = text_channels_by_name.get(dyn_channel.text_name)
+            text_channel = text_channels.pop(same_name.pop().id) if same_name else None
+            if (
+                owner_id is not None
+                and text_channel is not None
+                and owner_id not in adopted_owner_ids
+                and dyn_category.dyn_channel_from_owner(Object(id=owner_id)) is None
+            ):
+                dyn_channel.stage_channel = channel
+                dyn_channel.text_channel = text_channel
+                dyn_channel.created_at = channel.created_at.replace(tzinfo=timezone.utc)
+                adopted_owner_ids.add(owner_id)
+                plan.append(Step(ADOPT, dyn_channel=dyn_channel))
+            elif not channel.members:
+                plan += [Step(DELETE, channel=c) for c in (channel, text_channel) if c is not None]
+
+        plan += [Step(DELETE, channel=c) for c in await self._deletable_text_channels(text_channels.values())]
+        return plan
+
+    async def execute(self, plan: Plan, priority=Priority.BULK):
+        dyn_category = self.dyn_category
+        for step in plan:
+            if step.action == ADOPT:
+                logger.info(f"[{self.guild}] Adopting untracked stage {step.dyn_channel}")
+                dyn_category._track(step.dyn_channel)
+            elif step.action == FORGET:
+                logger.info(f"[{self.guild}] Forgetting stage {step.dyn_channel}, its channels were deleted.")
+                dyn_category._untrack(step.dyn_channel)
+
+        rest_steps = [step for step in plan if step.action in (RENAME, DELETE)]
+        results = await dyn_category.client.rest_scheduler.gather(
+            *((channel_bucket(step.channel, self._route(step)), self._operation(step)) for step in rest_steps),
+            priority=priority,
+        )
+        for step, result in zip(rest_steps, results):
+            if isinstance(result, Exception):
+                logger.error(f"[{self.guild}] Could not {step}: {result}")
+
+        if any(step.action in (ADOPT, FORGET) for step in plan):
+            dyn_category.update_control_message()
+
+    @staticmethod
+    def _route(step: Step) -> str:
+        return EDIT_CHANNEL if step.action == RENAME else DELETE_CHANNEL
+
+    @staticmethod
+    def _operation(step: Step):
+        if step.action == RENAME:
+            return lambda: step.channel.edit(name=step.name)
+        return step.channel.delete
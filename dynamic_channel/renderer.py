@@ -0,0 +1,133 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# discord rejects messages longer than this
+MESSAGE_MAX_LENGTH = 2000
+
+
+class _Page:
+    def __init__(self):
+        self.dyn_channels: Dict = {}  # used as an ordered set
+        self.length = 0  # total length of the lines
+        self.text: Optional[str] = None  # cached text, None if outdated
+
+
+class ControlMessageRenderer:
+    """Renders the stage list of the control messages.
+
+    Every stage is rendered into a line once and the line is cached until the stage changes. Stages are assigned to
+    pages, one page per discord message, and keep their page as long as it has room for them. A change of one stage
+    therefore changes the text of one page only. The first page also carries the control message.
+    """
+
+    HEADER = "```\nStages\n"
+    CONTINUATION_HEADER = "```\n"
+    FOOTER = "```\n"
+
+    def __init__(self, bot_control_message: str, max_length: int = MESSAGE_MAX_LENGTH):
+        self.bot_control_message = bot_control_message
+        self.max_length = max_length
+
+        self._lines: Dict = {}  # cached line by dyn_channel
+        self._page_of: Dict = {}  # page index by dyn_channel
+        self._pages: List[_Page] = [_Page()]
+        # indices of pages which lost lines and may have room again, new lines go there before the last page
+        self._open: Dict[int, None] = {}
+
+    def _capacity(self, index: int) -> int:
+        """Maximal length of the lines of a page."""
+        if index == 0:
+            return self.max_length - len(self.HEADER) - len(self.FOOTER) - len(self.bot_control_message)
+        return self.max_length - len(self.CONTINUATION_HEADER) - len(self.FOOTER)
+
+    @staticmethod
+    def render_line(dyn_channel) -> str:
+        return f" - {dyn_channel}\n"
+
+    def update(self, dyn_channel):
+        """Render the line of a new or changed stage."""
+        line = self.render_line(dyn_channel)
+        old_line = self._lines.get(dyn_channel)
+        if line == old_line:
+            return
+        self._lines[dyn_channel] = line
+
+        index = self._page_of.get(dyn_channel)
+        if index is not None:
+            page = self._pages[index]
+            if page.length - len(old_line) + len(line) <= self._capacity(index):
+                page.length += len(line) - len(old_line)
+                page.text = None
+                return
+            # the line grew too long for its page, move it
+            self._remove_from_page(dyn_channel, old_line)
+        self._add_to_page(dyn_channel, line)
+
+    def remove(self, dyn_channel):
+        """Forget a deleted stage."""
+        line = self._lines.pop(dyn_channel, None)
+        if line is not None:
+            self._remove_from_page(dyn_channel, line)
+
+    def _fits(self, index: int, line: str) -> bool:
+        return self._pages[index].length + len(line) <= self._capacity(index)
+
+    def _add_to_page(self, dyn_channel, line: str):
+        index = None
+        while self._open:
+            candidate = next(iter(self._open))
+            if self._fits(candidate, line):
+                index = candidate
+                break
+            # about full, do not look at it again until it loses another line
+            del self._open[candidate]
+        if index is None:
+            index = len(self._pages) - 1
+            if not self._fits(index, line):
+                index += 1
+                if len(line) > self._capacity(index):
+                    raise ValueError(f"Line does not fit into a message: {line!r}")
+                self._pages.append(_Page())
+        page = self._pages[index]
+        page.dyn_channels[dyn_channel] = None
+        page.length += len(line)
+        page.text = None
+        self._page_of[dyn_channel] = index
+
+    def _remove_from_page(self, dyn_channel, line: str):
+        index = self._page_of.pop(dyn_channel)
+        page = self._pages[index]
+        del page.dyn_channels[dyn_channel]
+        page.length -= len(line)
+        page.text = None
+        self._open[index] = None
+
+        if index > 0 and not page.dyn_channels:
+            # fill the gap with the last page, so that only two messages change and there are no empty ones
+            last = self._pages.pop()
+            self._open.pop(len(self._pages), None)
+            if last is not page:
+                self._pages[index] = last
+                last.text = None
+                for moved in last.dyn_channels:
+                    self._page_of[moved] = index
+
+    def _render_page(self, index: int) -> str:
+        page = self._pages[index]
+        lines = "".join(self._lines[d] for d in page.dyn_channels)
+        if index > 0:
+            return self.CONTINUATION_HEADER + lines + self.FOOTER
+        if not lines:
+            return self.bot_control_message
+        return self.HEADER + lines + self.FOOTER + self.bot_control_message
+
+    def pages(self) -> List[str]:
+        """Get the texts of all pages. Only pages which changed since the last call are rendered again."""
+        for index, page in enumerate(self._pages):
+            if page.text is None:
+                page.text = self._render_page(index)
+        return [page.text for page in self._pages]
@@ -0,0 +1,135 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import asyncio
+import heapq
+import itertools
+import logging
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Lower values are served first."""
+
+    INTERACTIVE = 0  # a user is waiting for the result, e.g. creating their own stage
+    BULK = 1  # nobody is waiting, e.g. purges and expiry
+
+
+def guild_bucket(guild) -> Hashable:
+    """Rate limit bucket of guild routes, e.g. creating channels."""
+    return "guild", guild.id
+
+
+# routes of a channel, like discord.py, each has its own rate limit bucket
+EDIT_CHANNEL = "PATCH /channels/{channel_id}"
+DELETE_CHANNEL = "DELETE /channels/{channel_id}"
+GET_MESSAGES = "GET /channels/{channel_id}/messages"
+SEND_MESSAGE = "POST /channels/{channel_id}/messages"
+BULK_DELETE_MESSAGES = "POST /channels/{channel_id}/messages/bulk-delete"
+EDIT_MESSAGE = "PATCH /channels/{channel_id}/messages/{message_id}"
+DELETE_MESSAGE = "DELETE /channels/{channel_id}/messages/{message_id}"
+DELETE_REACTION = "DELETE /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/{user_id}"
+
+
+def channel_bucket(channel, route: str) -> Hashable:
+    """Rate limit bucket of a route of a channel, e.g. editing a channel or removing reactions from its messages."""
+    return "channel", channel.id, route
+
+
+class _PriorityGate:
+    """Like a semaphore, but waiters are woken up by priority (and in FIFO order within the same priority)."""
+
+    def __init__(self, capacity: int):
+        self._free = capacity
+        self._waiters: List = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: Priority):
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # we were handed a slot right before being cancelled, pass it on
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
+
+
+class RestScheduler:
+    """Central scheduler for REST operations.
+
+    Operations are queued per rate limit bucket. Buckets are per route, like discord.py's, so e.g. removing reactions
+    does not wait for message edits in the same channel. Operations in the same bucket run one after another, ordered
+    by priority. Operations in different buckets run in parallel, up to max_concurrency at a time. Interactive
+    operations overtake bulk operations, both within a bucket and when waiting for a free slot.
+    """
+
+    def __init__(self, max_concurrency: int = 50):
+        self.max_concurrency = max_concurrency
+        self._gate: Optional[_PriorityGate] = None
+        self._buckets: Dict[Hashable, List] = {}
+        self._counter = itertools.count()
+
+    @property
+    def pending(self) -> int:
+        """Number of queued operations which have not been started yet."""
+        return sum(len(queue) for queue in self._buckets.values())
+
+    async def run(
+        self, bucket: Hashable, coro_func: Callable[[], Awaitable[Any]], priority: Priority = Priority.INTERACTIVE
+    ) -> Any:
+        """Queue coro_func() in the given bucket and return its result once it ran."""
+        loop = asyncio.get_event_loop()
+        if self._gate is None:
+            self._gate = _PriorityGate(self.max_concurrency)
+
+        future = loop.create_future()
+        queue = self._buckets.get(bucket)
+        if queue is None:
+            queue = self._buckets[bucket] = []
+            loop.create_task(self._drain(bucket, queue))
+        heapq.heappush(queue, (priority, next(self._counter), coro_func, future))
+        return await future
+
+    async def gather(self, *operations, priority: Priority = Priority.INTERACTIVE) -> List[Any]:
+        """Run several (bucket, coro_func) operations in parallel. Exceptions are returned, not raised."""
+        return await asyncio.gather(
+            *(self.run(bucket, coro_func, priority=priority) for bucket, coro_func in operations),
+            return_exceptions=True,
+        )
+
+    async def _drain(self, bucket: Hashable, queue: List):
+        try:
+            while queue:
+                priority, _, coro_func, future = heapq.heappop(queue)
+                if future.done():  # cancelled by the caller in the meantime
+                    continue
+
+                await self._gate.acquire(priority)
+                try:
+                    result = await coro_func()
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                finally:
+                    self._gate.release()
+        finally:
+            del self._buckets[bucket]
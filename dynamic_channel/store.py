@@ -0,0 +1,183 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dyn_channels (
+    stage_channel_id INTEGER PRIMARY KEY,
+    text_channel_id INTEGER NOT NULL,
+    guild_id INTEGER NOT NULL,
+    category_id INTEGER NOT NULL,
+    owner_id INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    owner_name TEXT
+);
+CREATE TABLE IF NOT EXISTS overflow_categories (
+    category_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    primary_category_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS control_messages (
+    category_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL
+);
+"""
+
+
+class DynChannelRecord(NamedTuple):
+    stage_channel_id: int
+    text_channel_id: int
+    guild_id: int
+    category_id: int
+    owner_id: int
+    created_at: datetime
+    owner_name: Optional[str]  # None in databases from before owner names were stored
+
+
+class ControlMessageRecord(NamedTuple):
+    category_id: int
+    guild_id: int
+    channel_id: int
+    message_id: int
+
+
+class StateStore:
+    """Persists tracked dynamic channels, overflow categories and control messages in a local SQLite database.
+
+    The whole state is read once on instantiation. Writes are queued and committed in batches, at most once per
+    flush_interval seconds, in a background thread. The database runs in WAL mode, so several worker processes can
+    share it.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(dyn_channels)")}
+        if "owner_name" not in columns:
+            self._connection.execute("ALTER TABLE dyn_channels ADD COLUMN owner_name TEXT")
+
+        # state as of startup, by category ID. Entries are consumed by restoring them.
+        self._dyn_channels: Dict[int, List[DynChannelRecord]] = {}
+        for row in self._connection.execute("SELECT * FROM dyn_channels"):
+            record = DynChannelRecord(
+                *row[:5], created_at=datetime.fromtimestamp(row[5], timezone.utc), owner_name=row[6]
+            )
+            self._dyn_channels.setdefault(record.category_id, []).append(record)
+        # IDs of the overflow categories the bot created, by the ID of their primary category
+        self._overflow_category_ids: Dict[int, List[int]] = {}
+        for category_id, primary_category_id in self._connection.execute(
+            "SELECT category_id, primary_category_id FROM overflow_categories"
+        ):
+            self._overflow_category_ids.setdefault(primary_category_id, []).append(category_id)
+        self._control_messages: Dict[int, ControlMessageRecord] = {
+            row[0]: ControlMessageRecord(*row) for row in self._connection.execute("SELECT * FROM control_messages")
+        }
+        logger.info(
+            f"Loaded {sum(len(r) for r in self._dyn_channels.values())} dynamic channels and "
+            f"{len(self._control_messages)} control messages from {path}."
+        )
+
+        self._pending: List[Tuple[str, tuple]] = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+        self._flush_task = None
+
+    def pop_dyn_channels(self, category_id: int) -> List[DynChannelRecord]:
+        """Get the dynamic channels of a category as of startup. Returns an empty list on subsequent calls."""
+        return self._dyn_channels.pop(category_id, [])
+
+    def earliest_dyn_channel(self, category_id: int) -> Optional[datetime]:
+        """Get the creation time of the oldest dynamic channel of a category which was not restored yet."""
+        records = self._dyn_channels.get(category_id)
+        return min(r.created_at for r in records) if records else None
+
+    def overflow_category_ids(self, primary_category_id: int) -> List[int]:
+        return list(self._overflow_category_ids.get(primary_category_id, []))
+
+    def save_overflow_category(self, primary_category, category):
+        self._overflow_category_ids.setdefault(primary_category.id, []).append(category.id)
+        self._write(
+            "INSERT OR REPLACE INTO overflow_categories VALUES (?, ?, ?)",
+            (category.id, category.guild.id, primary_category.id),
+        )
+
+    def delete_overflow_category(self, primary_category_id: int, category_id: int):
+        category_ids = self._overflow_category_ids.get(primary_category_id, [])
+        if category_id in category_ids:
+            category_ids.remove(category_id)
+        self._write("DELETE FROM overflow_categories WHERE category_id = ?", (category_id,))
+
+    def control_message(self, category_id: int) -> Optional[ControlMessageRecord]:
+        return self._control_messages.get(category_id)
+
+    def control_messages(self) -> List[ControlMessageRecord]:
+        return list(self._control_messages.values())
+
+    def save_dyn_channel(self, dyn_channel):
+        self._write(
+            "INSERT OR REPLACE INTO dyn_channels VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                dyn_channel.stage_channel_id,
+                dyn_channel.text_channel_id,
+                dyn_channel.guild.id,
+                dyn_channel.category_id,
+                dyn_channel.owner_id,
+                dyn_channel.created_at.timestamp(),
+                dyn_channel.owner_name,
+            ),
+        )
+
+    def delete_dyn_channel(self, stage_channel_id: int):
+        self._write("DELETE FROM dyn_channels WHERE stage_channel_id = ?", (stage_channel_id,))
+
+    def save_control_message(self, category, message):
+        record = ControlMessageRecord(category.id, category.guild.id, message.channel.id, message.id)
+        self._control_messages[category.id] = record
+        self._write("INSERT OR REPLACE INTO control_messages VALUES (?, ?, ?, ?)", tuple(record))
+
+    def _write(self, sql: str, parameters: tuple):
+        self._pending.append((sql, parameters))
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_event_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.flush_interval)
+        finally:
+            self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Commit all pending writes."""
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._commit, batch)
+        except sqlite3.Error:
+            logger.exception(f"Could not write {len(batch)} changes to {self.path}.")
+
+    def _commit(self, batch: List[Tuple[str, tuple]]):
+        with self._connection:
+            for sql, parameters in batch:
+                self._connection.execute(sql, parameters)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        self._executor.shutdown()
+        self._connection.close()
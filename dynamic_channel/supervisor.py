@@ -0,0 +1,166 @@
+# SPDX-License-Identifier: GPL-3.0
+
+import logging
+import multiprocessing
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional
+
+from dynamic_channel.bot import DynChannelBot
+from dynamic_channel.log import GuildFilter, TextChannelHandler
+
+logger = logging.getLogger(__name__)
+
+
+def shard_ranges(shard_count: int, process_count: int) -> List[List[int]]:
+    """Split the shard IDs 0..shard_count-1 into process_count contiguous, similarly sized ranges."""
+    if not 0 < process_count <= shard_count:
+        raise ValueError(f"Cannot distribute {shard_count} shards over {process_count} processes.")
+    base, extra = divmod(shard_count, process_count)
+    ranges = []
+    start = 0
+    for i in range(process_count):
+        stop = start + base + (1 if i < extra else 0)
+        ranges.append(list(range(start, stop)))
+        start = stop
+    return ranges
+
+
+def _run_worker(shard_ids, shard_count, category_info, token, log_queue, loglevel, bot_options):
+    """Entry point of a worker process. All log records are sent to the supervisor, guild logs are also shipped to
+    the log channels of the worker's guilds."""
+    root_logger = logging.getLogger()
+    root_logger.handlers.clear()
+    root_logger.setLevel(loglevel)
+    root_logger.addHandler(QueueHandler(log_queue))
+    text_channel_handler = TextChannelHandler()
+    text_channel_handler.addFilter(GuildFilter())
+    root_logger.addHandler(text_channel_handler)
+
+    logger.info(f"Worker started for shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}.")
+    try:
+        DynChannelBot(category_info, shard_ids=shard_ids, shard_count=shard_count, **bot_options).run(token)
+    except Exception:
+        logger.exception(f"Worker for shards {shard_ids[0]}-{shard_ids[-1]} crashed.")
+        sys.exit(1)
+
+
+class _Worker:
+    def __init__(self, shard_ids):
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started_at = 0.0
+        self.restart_delay = 0.0
+        self.restart_at = 0.0
+
+    @property
+    def name(self):
+        return f"shards-{self.shard_ids[0]}-{self.shard_ids[-1]}"
+
+
+class ShardSupervisor:
+    """Run the bot in several worker processes, each of them serving a contiguous range of shards.
+
+    Crashed workers are restarted with exponential backoff. The log records of all workers are passed to the
+    supervisor's log handlers.
+    """
+
+    def __init__(
+        self,
+        token,
+        category_info,
+        shard_count: int,
+        process_count: int,
+        log_handlers: List[logging.Handler],
+        loglevel=logging.INFO,
+        min_restart_delay: float = 5,
+        max_restart_delay: float = 300,
+        stable_after: float = 600,
+        bot_options: Optional[Dict[str, Any]] = None,
+    ):
+        self.token = token
+        self.category_info = category_info
+        self.shard_count = shard_count
+        self.log_handlers = log_handlers
+        self.loglevel = loglevel
+        self.min_restart_delay = min_restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after  # a worker running for this long is considered healthy again
+        self.bot_options = bot_options or {}  # passed on to DynChannelBot in each worker
+
+        self._context = multiprocessing.get_context("spawn")
+        self._log_queue = None
+        self._workers = [_Worker(shard_ids) for shard_ids in shard_ranges(shard_count, process_count)]
+
+    def _start(self, worker: _Worker):
+        bot_options = dict(self.bot_options)
+        if bot_options.get("metrics_port") is not None:
+            # every worker serves its own metrics, on consecutive ports
+            bot_options["metrics_port"] += self._workers.index(worker)
+        if bot_options.get("journal"):
+            # a journal is appended to by one process only, workers keep their shards across restarts
+            bot_options["journal"] += f".{self._workers.index(worker)}"
+        worker.process = self._context.Process(
+            target=_run_worker,
+            name=worker.name,
+            args=(
+                worker.shard_ids,
+                self.shard_count,
+                self.category_info,
+                self.token,
+                self._log_queue,
+                self.loglevel,
+                bot_options,
+            ),
+            daemon=True,
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        logger.info(f"Started worker {worker.name} (pid {worker.process.pid}).")
+
+    def _check(self, worker: _Worker):
+        now = time.monotonic()
+        if worker.process is None:
+            if now >= worker.restart_at:
+                self._start(worker)
+            return
+
+        if worker.process.is_alive():
+            return
+
+        exitcode = worker.process.exitcode
+        worker.process = None
+        if now - worker.started_at >= self.stable_after:
+            worker.restart_delay = 0.0
+        worker.restart_delay = min(max(2 * worker.restart_delay, self.min_restart_delay), self.max_restart_delay)
+        worker.restart_at = now + worker.restart_delay
+        logger.error(
+            f"Worker {worker.name} exited with code {exitcode}. Restarting in {worker.restart_delay:.0f} seconds."
+        )
+
+    def _stop(self):
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                logger.info(f"Stopping worker {worker.name} (pid {worker.process.pid}).")
+                worker.process.terminate()
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout=10)
+
+    def run(self, poll_interval: float = 1):
+        """Start all workers and supervise them until interrupted."""
+        self._log_queue = self._context.Queue()
+        listener = QueueListener(self._log_queue, *self.log_handlers, respect_handler_level=True)
+        listener.start()
+        try:
+            logger.info(f"Supervising {len(self._workers)} workers serving {self.shard_count} shards.")
+            while True:
+                for worker in self._workers:
+                    self._check(worker)
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            logger.info("Interrupted. Shutting down.")
+        finally:
+            self._stop()
+            listener.stop()